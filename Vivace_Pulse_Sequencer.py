@@ -6,17 +6,18 @@ import numpy as np
 
 from BaseDriver import LabberDriver, Error
 
-from vivace import pulsed, version as vivace_version, utils as vivace_utils, __version__ as api_ver
+from vivace import version as vivace_version, utils as vivace_utils, __version__ as api_ver
 import input_handling
 import logger
-import utils
 import previews
 import pulses
-import templates
 import luts
 import template_matching
 import scheduling
 import conditionals
+import compilation
+import configuration
+import session
 import subprocess
 
 
@@ -29,13 +30,16 @@ class Driver(LabberDriver):
     it with data extracted from different parts of the instrument.
     """
 
-    N_IN_PORTS = 8
-    N_OUT_PORTS = 8
+    N_IN_PORTS = compilation.CompiledSequence.N_IN_PORTS
+    N_OUT_PORTS = compilation.CompiledSequence.N_OUT_PORTS
 
-    MAX_VARIABLES = 10
+    MAX_VARIABLES = compilation.CompiledSequence.MAX_VARIABLES
 
     # Used to separate definition indices for normal and DRAG templates
-    DRAG_INDEX_OFFSET = 1000
+    DRAG_INDEX_OFFSET = compilation.CompiledSequence.DRAG_INDEX_OFFSET
+
+    # The number of compiled sequences to keep around for configurations that are revisited
+    COMPILE_CACHE_SIZE = 8
 
     # In order to use the driver with actual hardware, dry_run needs to be False
     dry_run = None
@@ -56,18 +60,23 @@ class Driver(LabberDriver):
 
         # IP address used to connect to board
         self.address = self.getAddress()
+        # Sessions that open connections to Vivace, indexed by whether they are dry runs, and the one used most recently
+        self.sessions = {}
+        self.session = None
 
         # Get the relevant version numbers
         self.fetch_version_numbers()
 
         self.sampling_freq = None
+        self.config = None
         self.averages = None
         self.trigger_period = None
         self.iterations = None
         self.custom_vars = None
         self.templates = {}
+        self.template_identifiers = []
         self.drag_templates = []
-        self.drag_parameters = []
+        self.drag_parameters = {}
         self.template_defs = None
         self.port_settings = None
         self.pulse_definitions = None
@@ -77,12 +86,14 @@ class Driver(LabberDriver):
         self.fp_matrix = None
         self.carrier_changes = None
         self.samples_per_iteration = None
+        self.template_matching_defs = None
         self.template_matchings = None
         self.match_results = None
 
         # Sampling parameters
         self.sampling_ports = None
         self.sampling_duration = None
+        self.event_table = None
 
         # Measurement output
         self.time_array = None
@@ -91,19 +102,34 @@ class Driver(LabberDriver):
         # This list is used to keep track of the specific options used when getting traces in Labber
         self.previously_outputted_trace_configs = []
 
+        # Digests of the contents of vector quants, indexed by quant name, for telling when they are set to new values
+        self.vector_digests = {}
+
+        # Compiled sequences, indexed by the fingerprint of the configuration they were compiled from
+        self.compile_cache = compilation.CompileCache(self.COMPILE_CACHE_SIZE)
+        # The most recently used compiled sequence, which new configurations are compiled on top of
+        self.compiled_sequence = None
+        # The compiled sequence that previews are drawn from, which is kept apart from the one used by measurements,
+        # and whether a quant that affects the board may have changed since it was compiled
+        self.preview_sequence = None
+        self.preview_outdated = True
+
         self.lgr.new_log = True
 
     def reset_instrument(self):
         """
-        Reinitialise the driver's state. Should be equivalent to restarting the instrument.
+        Reinitialise the driver's state. Should be equivalent to restarting the instrument,
+        except that previously compiled sequences are kept in the compile cache,
+        and connections to Vivace are kept open along with what has been set up on the board.
         """
         self.averages = None
         self.trigger_period = None
         self.iterations = None
         self.custom_vars = None
         self.templates = {}
+        self.template_identifiers = []
         self.drag_templates = []
-        self.drag_parameters = []
+        self.drag_parameters = {}
         self.template_defs = None
         self.port_settings = None
         self.pulse_definitions = None
@@ -113,12 +139,14 @@ class Driver(LabberDriver):
         self.fp_matrix = None
         self.carrier_changes = None
         self.samples_per_iteration = None
+        self.template_matching_defs = None
         self.template_matchings = None
         self.match_results = None
 
         # Sampling parameters
         self.sampling_ports = None
         self.sampling_duration = None
+        self.event_table = None
 
         # Measurement output
         self.time_array = None
@@ -126,6 +154,8 @@ class Driver(LabberDriver):
 
         self.previously_outputted_trace_configs = []
 
+        self.preview_outdated = True
+
         # Prepare to start a new log file
         self.lgr.new_log = True
 
@@ -134,6 +164,7 @@ class Driver(LabberDriver):
 
     def performClose(self, bError=False, options={}):
         """Perform the close instrument connection operation"""
+        self.lgr.flush()
 
     def performSetValue(self, quant, value, sweepRate=0.0, options={}):
         """
@@ -143,10 +174,14 @@ class Driver(LabberDriver):
         """
         set_commands = quant.set_cmd.replace(' ', '').split(',')
 
+        # Format the input first, so that it can be compared with the stored value, which is already formatted
+        value = input_handling.handle_input(quant, value)
+        digest = configuration.get_vector_digest(value) if isinstance(value, dict) else None
+
         # If a new value is set that affects the outcome of a measurement, we need to
         # reset our stored variables to force a re-run of our measurements
         if 'not_affecting_board' not in set_commands:
-            if input_handling.is_value_new(self, quant, value):
+            if input_handling.is_value_new(self, quant, value, digest):
                 self.reset_instrument()
 
         # Version numbers should be kept constant
@@ -176,7 +211,10 @@ class Driver(LabberDriver):
                 self.setValue('Ping result', f'Ping failed at "{self.address}"')
             return value
 
-        return input_handling.handle_input(quant, value)
+        # Only remember the digest of a vector once it has been accepted
+        if digest is not None:
+            self.vector_digests[quant.name] = digest
+        return value
 
     def fetch_version_numbers(self):
         """
@@ -198,7 +236,7 @@ class Driver(LabberDriver):
         self.setValue('Vivace API version', self.vivace_api_ver)
         self.dry_run = not self.getValue('Vivace connection enabled')
         try:
-            with pulsed.Pulsed(ext_ref_clk=True, dry_run=self.dry_run, address=self.address) as q:
+            with self.get_session(self.dry_run).connect() as q:
                 self.vivace_fw_ver = vivace_version.get_version_firmware(q)
                 self.setValue('Vivace firmware version', self.vivace_fw_ver)
                 self.vivace_server_ver = vivace_version.get_version_server(q)
@@ -232,7 +270,7 @@ class Driver(LabberDriver):
             options['delay'] = 0
             circumstance = (quant.name, window_idx, options)
             # Add the circumstance information to the debug log
-            self.lgr.add_line(f'Current circumstance: {circumstance}')
+            self.lgr.add_line('Current circumstance: {}', circumstance)
             if circumstance in self.previously_outputted_trace_configs:
                 self.reset_instrument()
                 self.perform_measurement()
@@ -263,7 +301,7 @@ class Driver(LabberDriver):
             options['delay'] = 0
             circumstance = (quant.name, curr_iter, options)
             # Add the circumstance information to the debug log
-            self.lgr.add_line(f'Current circumstance: {circumstance}')
+            self.lgr.add_line('Current circumstance: {}', circumstance)
             if circumstance in self.previously_outputted_trace_configs:
                 self.reset_instrument()
                 self.perform_measurement()
@@ -288,17 +326,17 @@ class Driver(LabberDriver):
             return quant.getTraceDict(comp_vector, x=range(len(comp_vector)), x0=0, dt=1)
 
         if quant.get_cmd == 'template_preview':
-            # Set up instrument to perform error checking and obtain sampling rate
-            with pulsed.Pulsed(ext_ref_clk=True, dry_run=True, address=self.address) as q:
-                self.setup_instrument(q)
             return previews.get_template_preview(self, quant)
 
         if quant.get_cmd == 'sequence_preview':
-            # Set up instrument to form the full pulse sequence
-            with pulsed.Pulsed(ext_ref_clk=True, dry_run=True, address=self.address) as q:
-                self.setup_instrument(q)
             return previews.get_sequence_preview(self, quant)
 
+        if quant.get_cmd == 'sweep_preview':
+            return previews.get_sweep_preview(self, quant)
+
+        if quant.get_cmd == 'multi_port_preview':
+            return previews.get_multi_port_preview(self, quant)
+
         return quant.getValue()
 
     def get_trace(self, quant):
@@ -339,33 +377,39 @@ class Driver(LabberDriver):
         Store the resulting output in a global variable.
         """
         self.dry_run = not self.getValue('Vivace connection enabled')
-        with pulsed.Pulsed(ext_ref_clk=True, dry_run=self.dry_run, address=self.address) as q:
-            self.setup_instrument(q)
-
-            # Set up our actual LUTs on the board
-            luts.apply_LUTs(self, q)
-
-            # Set up the full pulse on the board
-            scheduling.setup_sequence(self, q)
-
-            # Schedule template matching
-            scheduling.setup_template_matches(self, q)
-
-            # Start measuring
-            total_time = self.trigger_period * (self.iterations + 1)
-            self.lgr.add_line(f'q.perform_measurement(time: {total_time}, repeat_count: 1, averages: {self.averages})')
-            output = q.perform_measurement(total_time, 1, self.averages)
-            if not q.dry_run:
-                # Store the results
-                (t_array, result) = output
-                self.time_array = list(t_array)
-                self.sampling_results = result
-                self.match_results = self.get_template_matching_results(q)
-            else:
-                self.sampling_results = 'Dummy result'
-                # Dummy matching results
-                self.match_results = [[range(1, (5 * self.iterations) + 1),
-                                       range(1, (5 * self.iterations) + 1)]]
+        vivace_session = self.get_session(self.dry_run)
+        try:
+            with vivace_session.connect() as q:
+                self.setup_instrument(vivace_session, q)
+
+                # Set up our actual LUTs on the board
+                luts.apply_LUTs(self, q)
+
+                # Set up the full pulse on the board
+                scheduling.setup_sequence(self, q)
+
+                # Schedule template matching
+                scheduling.setup_template_matches(self, q)
+
+                # Start measuring
+                total_time = self.trigger_period * (self.iterations + 1)
+                self.lgr.add_line('q.perform_measurement(time: {}, repeat_count: 1, averages: {})', total_time, self.averages)
+                output = q.perform_measurement(total_time, 1, self.averages)
+
+                if not q.dry_run:
+                    # Store the results
+                    (t_array, result) = output
+                    self.time_array = list(t_array)
+                    self.sampling_results = result
+                    self.match_results = self.get_template_matching_results(q)
+        finally:
+            self.lgr.flush()
+
+        if q.dry_run:
+            self.sampling_results = 'Dummy result'
+            # Dummy matching results
+            self.match_results = [[range(1, (5 * self.iterations) + 1),
+                                   range(1, (5 * self.iterations) + 1)]]
 
     def get_template_matching_results(self, q):
         """
@@ -374,8 +418,8 @@ class Driver(LabberDriver):
         """
         matchings = []
         for m in self.template_matchings:
-            self.lgr.add_line(f'q.get_template_matching_data({m[2]})')
-            self.lgr.add_line(f'q.get_template_matching_data({m[3]})')
+            self.lgr.add_line('q.get_template_matching_data({})', m[2])
+            self.lgr.add_line('q.get_template_matching_data({})', m[3])
             i_results = q.get_template_matching_data(m[2])
             q_results = q.get_template_matching_data(m[3])
             # Add the matching results of the two templates used
@@ -393,42 +437,85 @@ class Driver(LabberDriver):
 
         return matchings
 
-    def setup_instrument(self, q):
+    def get_session(self, dry_run):
         """
-        Fetch all user-given data from the instrument, and process it appropriately.
-        Store pulse definitions, envelope templates, and LUTs, for use by other methods.
+        Get the session that opens connections to Vivace with the given dry run setting,
+        creating it if it does not exist yet.
+        """
+        if dry_run not in self.sessions:
+            self.sessions[dry_run] = session.VivaceSession(self.address, dry_run, self.lgr)
+        return self.sessions[dry_run]
+
+    def setup_instrument(self, vivace_session, q):
+        """
+        Compile the user-given data in the instrument into pulse definitions, envelope templates and LUT values,
+        unless the current configuration has been compiled before, in which case the cached result is reused.
+        A new configuration is compiled on top of the previously used sequence, so that only the parts
+        affected by the quants that changed in between are rebuilt.
+        Then set up the compiled sequence's templates, sampling, template matches and conditionals on the board
+        through the given connection, skipping the biases and LUTs that the session says are already there.
         """
         # Get debug information
         self.get_debug_settings()
 
         self.sampling_freq = q.sampling_freq
-        # Store any custom variables the user sets up
-        self.custom_vars = self.get_custom_variables()
-        # Get some general parameters such as no. of averages, trigger period etc.
-        self.get_general_settings()
-        # Get template definitions
-        self.template_defs = templates.get_template_defs(self)
-        # Port settings
-        self.port_settings = self.get_port_settings()
+        # Take a snapshot of every quant that affects the board
+        self.config = configuration.ConfigSnapshot.from_driver(self)
+        compiled = self.get_compiled_sequence(self.config, self.sampling_freq, self.compiled_sequence)
+        compiled.restore(self)
+        self.compiled_sequence = compiled
+        self.session = vivace_session
+
         # Set DC biases for all ports
         self.set_dc_biases(q)
-        # Pulse definitions
-        self.pulse_definitions = pulses.get_all_pulse_defs(self, q)
+        # Set up the envelope templates
+        pulses.setup_templates(self, q)
         # Sampling
-        self.sample_windows = pulses.get_sample_windows(self, q)
-        # Copy pulse definitions on specified ports
-        self.copy_defs(q)
-        # Sort our definitions chronologically
-        self.pulse_definitions = sorted(self.pulse_definitions,
-                                        key=lambda x: x['Time'][0] + x['Time'][1])
-        self.validate_pulse_definitions()
-        # Get the values that will go in the LUTs
-        self.amp_matrix, self.fp_matrix, self.carrier_changes = luts.get_LUT_values(self)
-        # Get template matching data
-        self.template_matchings = template_matching.get_template_matching_definitions(self, q)
+        pulses.setup_sampling(self, q)
+        # Set up template matching
+        self.template_matchings = template_matching.setup_template_matchings(self, q)
         # Prepare conditional pulses
         conditionals.setup_conditionals(self, q)
 
+    def get_compiled_sequence(self, config, sampling_freq, previous):
+        """
+        Get the compiled sequence of the given configuration snapshot from the compile cache.
+        If it has not been compiled before, compile it on top of the given previous sequence and cache it.
+        """
+        fingerprint = (config.fingerprint, sampling_freq)
+        compiled = self.compile_cache.get(fingerprint)
+        if compiled is None:
+            compiled = compilation.CompiledSequence(config, sampling_freq, self.lgr)
+            compiled.compile(previous)
+            self.compile_cache.put(fingerprint, compiled)
+        else:
+            self.lgr.add_line('Reusing compiled sequence {}', config.fingerprint)
+        return compiled
+
+    def get_preview_sequence(self):
+        """
+        Get a compiled sequence of the current configuration for drawing previews from.
+        The sequence is neither loaded into the driver nor set up on the board, so previewing does not disturb
+        the sequence used by measurements. Previews and measurements share the compile cache, so switching
+        between them, or changing quants that only affect the preview, does not compile anything again.
+        """
+        if self.preview_sequence is not None and not self.preview_outdated:
+            return self.preview_sequence
+
+        self.get_debug_settings()
+        # Previews do not connect to the board, so a dry run gives the sampling rate if no measurement has
+        if self.sampling_freq is None:
+            with self.get_session(True).connect() as q:
+                self.sampling_freq = q.sampling_freq
+        config = configuration.ConfigSnapshot.from_driver(self)
+        previous = self.preview_sequence if self.preview_sequence is not None else self.compiled_sequence
+        try:
+            self.preview_sequence = self.get_compiled_sequence(config, self.sampling_freq, previous)
+        finally:
+            self.lgr.flush()
+        self.preview_outdated = False
+        return self.preview_sequence
+
     def get_debug_settings(self):
         """
         Fetch the user-specified debug-related settings and pass them on to the logger.
@@ -447,168 +534,16 @@ class Driver(LabberDriver):
 
             self.lgr.overwrite = self.getValue('Overwrite previous log')
 
-    def get_custom_variables(self):
-        """
-        Stores user-defined custom variables in a dict, with variable names as keys.
-        Returns this dict.
-        """
-        custom_vars = {}
-        for i in range(1, self.MAX_VARIABLES+1):
-            name = self.getValue(f'Custom variable {i} - name')
-            if name.startswith('INVALID:'):
-                raise ValueError(f'Custom variable {i} has an invalid name!')
-            if name != '':
-                if name in custom_vars:
-                    raise ValueError(f'More than one custom variable has the name "{name}"!')
-                value = self.getValue(f'Custom variable {i} - value')
-                custom_vars[name] = value
-
-        return custom_vars
-
-    def get_general_settings(self):
-        """
-        Get instrument parameters from the 'General settings' section.
-        These are saved in global variables.
-        """
-        self.averages = int(self.getValue('Average'))
-        self.trigger_period = self.getValue('Trigger period')
-        if self.trigger_period == 0:
-            raise ValueError('Trigger period cannot be 0!')
-        self.iterations = int(self.getValue('Iterations'))
-
-    def get_port_settings(self):
+    def set_dc_biases(self, q):
         """
-        Get each port's settings.
-        Port settings are represented by an array of dictionaries, each representing a single output port's settings.
-            The 'Mode' key contains the port's mode (Define, Disabled, Copy)
-            If a port is in copy mode, also save the port it is copying from in a 'Sibling' key.
-        Return a list of these dictionaries.
+        Set the DC bias of every output port on the board whose bias is not already set.
         """
-        port_settings = [{} for _ in range(self.N_OUT_PORTS)]
-
-        # Get the mode for each port
-        for port in range(1, self.N_OUT_PORTS+1):
-            p = port - 1
-            mode = self.getValue(f'Port {port} - mode')
-            port_settings[p]['Mode'] = mode
-            if mode == 'Copy':
-                port_settings[p]['Sibling'] = int(self.getValue(f'Port {port} - copy sequence from'))
-
-        return port_settings
-
-    def set_dc_biases(self, q):
         if not q.dry_run:
             for port in range(1, self.N_OUT_PORTS+1):
-                bias = self.getValue(f'Port {port} - DC bias')
+                bias = self.config[f'Port {port} - DC bias']
                 bias = bias / 1.25
-                self.lgr.add_line(f'q.set_output_bias(bias={bias}, port={port})')
+                if self.session.is_loaded(('output bias', port), bias):
+                    continue
+                self.lgr.add_line('q.set_output_bias(bias={}, port={})', bias, port)
                 q.set_output_bias(bias, port)
-
-    def validate_pulse_definitions(self):
-        """
-        Ensure that pulse definitions on different carrier generators of the same port
-        interact in a safe way. Pulses can only overlap if they have the same start and end time,
-        and their combined amplitude cannot exceed 1.
-        """
-        for p in range(self.N_OUT_PORTS):
-            prev_start = -1
-            prev_duration = 0
-            prev_carrier = -1
-            prev_amp = 0
-            for it in range(self.iterations):
-                for pulse in self.pulse_definitions:
-                    overlap_error = False
-                    if pulse['Port'] != p+1:
-                        continue
-                    start = pulse['Time']
-                    curr_start = utils.get_absolute_time(self, start[0], start[1], it)
-                    temp_def = self.template_defs[pulse['Template_no']-1]
-                    curr_duration = self.get_template_def_duration(temp_def, it)
-
-                    # Ensure that pulses start within the trigger period
-                    if start[0] + start[1] * it < 0:
-                        raise ValueError(f'A pulse on port {p+1} has a negative start time in iteration {it+1}!')
-                    if start[0] + start[1] * it + curr_duration > self.trigger_period:
-                        raise ValueError(f'A pulse on port {p+1} ends after the end '
-                                         f'of the trigger period in iteration {it+1}!')
-
-                    curr_carrier = pulse['Carrier']
-                    curr_amp = pulse['Amp'][it]
-                    if curr_start == prev_start:
-                        if 'DRAG_idx' not in pulse and abs(curr_amp + prev_amp) > 1:
-                            raise ValueError(f'The combined amplitude of the overlapping pulses at time '
-                                             f'{start[0] + start[1]*it} on port {p + 1} exceeds 1 or -1!')
-
-                        if (curr_carrier == prev_carrier or
-                                curr_duration != prev_duration):
-                            overlap_error = True
-                    elif curr_start - (prev_start+prev_duration) < -1e-9:
-                        overlap_error = True
-                    if overlap_error:
-                        raise ValueError(f"Two pulses overlap incorrectly at time {start[0] + start[1]*it} "
-                                         f"on port {p + 1} during iteration {it+1}! "
-                                         f"Overlapping pulses must use different carrier generators and "
-                                         f"have identical start times and durations.")
-                    prev_carrier = curr_carrier
-                    prev_start = curr_start
-                    prev_duration = curr_duration
-                    prev_amp = curr_amp
-
-    def get_template_def_duration(self, tempdef, iteration):
-        """
-        Compute and return the total duration of a template definition for a given iteration.
-        """
-        if 'Base' in tempdef:  # Long drive
-            return tempdef['Base'] + tempdef['Delta'] * iteration
-        else:
-            return tempdef['Duration']
-
-    def copy_defs(self, q):
-        """
-        For each port that is set to copy from another port, create pulse definitions
-        on that port based on the target port's definitions.
-        """
-        # Identify which ports are in copy mode
-        for p, settings in enumerate(self.port_settings):
-            port = p + 1
-            mode = settings['Mode']
-            if mode != 'Copy':
-                # Port is not in copy mode
-                continue
-
-            target = settings['Sibling']
-            # Only copy from ports that have pulses defined to them
-            if not self.getValue(f'Port {target} - mode') == 'Define':
-                raise ValueError(f'Output port {port} is set to copy from port {target}, '
-                                 f'which is either undefined or a copy!')
-
-            amp_shift = self.getValue(f'Port {port} - amplitude scale multiplier')
-            phase_shift = self.getValue(f'Port {port} - phase shift')
-
-            # Copy pulse defs
-            idx = 0
-            while idx < len(self.pulse_definitions):
-                pulse = self.pulse_definitions[idx]
-                # Sample pulse definitions do not have a Port value, so they should be ignored
-                if pulse['Port'] == target and 'DRAG_idx' not in pulse:
-                    # Copy every pulse, but update the output port and apply shifts.
-                    p_copy = pulse.copy()
-                    p_copy['ID'] = pulses.get_next_pulse_id(self)
-                    p_copy['Port'] = port
-                    p_copy['Phase'] = [phase + phase_shift for phase in pulse['Phase']]
-                    p_copy['Amp'] = [amp * amp_shift for amp in pulse['Amp']]
-                    self.pulse_definitions.insert(idx + 1, p_copy)
-
-                    # Set up the old target pulse's template on the new port
-                    p_ti = pulse['Template_identifier']
-                    new_template_identifier = templates.TemplateIdentifier(port, p_ti.carrier, p_ti.def_idx,
-                                                                           p_ti.cond_on,
-                                                                           p_ti.cond1, p_ti.cond2,
-                                                                           p_ti.cond1_quad, p_ti.cond2_quad)
-                    p_copy['Template_identifier'] = new_template_identifier
-                    pulses.setup_template(self, q, new_template_identifier)
-
-                    # Step past the newly added pulse
-                    idx += 2
-                else:
-                    idx += 1
+                self.session.set_loaded(('output bias', port), bias)
@@ -0,0 +1,90 @@
+# Authored by Johan Blomberg and Gustav Grännsjö, 2020
+
+"""
+Benchmark for compiling pulse sequences, which does not require Labber or a connection to Vivace.
+A synthetic configuration with a given number of iterations and pulses is compiled from scratch,
+and the time per iteration and pulse is printed. If compile time scales linearly in
+iterations * pulses, the time per iteration and pulse stays roughly constant across the table.
+
+Usage: python benchmark_compile.py [ITERATIONS ...] [--pulses PULSES ...]
+"""
+
+import argparse
+import time
+
+import compilation
+import configuration
+import logger
+
+SAMPLING_FREQ = 4e9
+# Time between the starts of two consecutive pulses on a port
+PULSE_SPACING = 100e-9
+
+
+def get_benchmark_config(iterations, n_pulses):
+    """
+    Get a configuration snapshot with the given number of iterations, and the given number of pulses
+    on each of two ports. Every other pulse on a port uses a different frequency, so that each pulse
+    causes a carrier change that needs to be phase synced. A third port copies the first.
+    """
+    values = {
+        'Iterations': iterations,
+        'Trigger period': n_pulses * PULSE_SPACING + 2e-6,
+        'Envelope template count': '1',
+        'Envelope template 1: shape': 'Sin2',
+        'Envelope template 1: duration': 20e-9,
+        'Sampling on port 1': True,
+        'Sampling - start times': '0',
+        'Sampling - duration': 1e-6,
+        'Number of matches': '0',
+        'Port 3 - mode': 'Copy',
+        'Port 3 - copy sequence from': '1',
+        'Port 3 - amplitude scale multiplier': 0.5,
+    }
+    for port in (1, 2):
+        values[f'Port {port} - mode'] = 'Define'
+        values[f'Pulses for port {port}'] = '2'
+        for def_idx in (1, 2):
+            start_times = [f'{(2 * k + def_idx - 1) * PULSE_SPACING:.3e}' for k in range(n_pulses // 2)]
+            values[f'Port {port} - def {def_idx} - template'] = '1'
+            values[f'Port {port} - def {def_idx} - sine generator'] = '1'
+            values[f'Port {port} - def {def_idx} - start times'] = ', '.join(start_times)
+            values[f'Port {port} - def {def_idx} - amp'] = 0.4
+            values[f'Port {port} - def {def_idx} - freq'] = 100e6 * def_idx
+            values[f'Port {port} - def {def_idx} - phase'] = 0.1 * def_idx
+    return configuration.ConfigSnapshot(values)
+
+
+def time_compile(config, repeats):
+    """
+    Compile the given configuration from scratch a number of times, and return the fastest time in seconds.
+    """
+    best = None
+    for _ in range(repeats):
+        compiled = compilation.CompiledSequence(config, SAMPLING_FREQ, logger.Logger())
+        start = time.perf_counter()
+        compiled.compile()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark compiling ViPS pulse sequences.')
+    parser.add_argument('iterations', nargs='*', type=int, default=[10, 20, 40])
+    parser.add_argument('--pulses', nargs='+', type=int, default=[20, 40],
+                        help='the number of pulses on each defined port')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f'{"iterations":>10} {"pulses":>8} {"compile time (ms)":>18} {"us per iteration and pulse":>27}')
+    for n_pulses in args.pulses:
+        for iterations in args.iterations:
+            config = get_benchmark_config(iterations, n_pulses)
+            elapsed = time_compile(config, args.repeats)
+            per_unit = elapsed / (iterations * n_pulses) * 1e6
+            print(f'{iterations:>10} {n_pulses:>8} {elapsed * 1e3:>18.1f} {per_unit:>27.2f}')
+
+
+if __name__ == '__main__':
+    main()
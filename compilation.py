@@ -0,0 +1,557 @@
+# Authored by Johan Blomberg and Gustav Grännsjö, 2020
+
+"""
+A collection of classes for compiling a ViPS configuration into a pulse sequence,
+and for caching the compiled form so that revisiting a configuration does not require it to be compiled again.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+import dependencies
+import utils
+import pulses
+import templates
+import luts
+import scheduling
+import template_matching
+
+
+class CompiledSequence:
+    """
+    Objects of this class hold everything that ViPS derives from the instrument's settings
+    before any calls are made to the board: template definitions, pulse definitions,
+    sample windows, LUT values, template matching definitions and the event table of the sequence.
+    All settings are read from a configuration snapshot, so compiling does not require Labber.
+    An instance of this class is passed around as "vips" to the compilation methods in other files.
+    """
+
+    N_IN_PORTS = 8
+    N_OUT_PORTS = 8
+
+    MAX_VARIABLES = 10
+
+    # Used to separate definition indices for normal and DRAG templates
+    DRAG_INDEX_OFFSET = 1000
+
+    # The attributes that are loaded into the driver when the sequence is used
+    FIELDS = ('averages',
+              'trigger_period',
+              'iterations',
+              'custom_vars',
+              'template_defs',
+              'template_identifiers',
+              'drag_templates',
+              'drag_parameters',
+              'port_settings',
+              'pulse_definitions',
+              'sample_windows',
+              'pulse_id_counter',
+              'amp_matrix',
+              'fp_matrix',
+              'carrier_changes',
+              'samples_per_iteration',
+              'template_matching_defs',
+              'sampling_ports',
+              'sampling_duration',
+              'event_table')
+
+    # The attributes that each compile stage produces, which are carried over from
+    # the previous sequence when a stage does not need to be rebuilt
+    STAGE_FIELDS = {
+        'custom_vars': ('custom_vars',),
+        'general': ('averages', 'trigger_period', 'iterations'),
+        'template_defs': ('template_defs',),
+        'port_settings': ('port_settings',),
+        'pulse_defs': ('port_pulse_defs',),
+        'sample_windows': ('sample_windows', 'sampling_ports', 'sampling_duration', 'samples_per_iteration'),
+        'copies': ('copied_pulse_defs',),
+        'timelines': ('pulse_definitions', 'template_identifiers', 'amp_matrix', 'fp_matrix', 'carrier_changes'),
+        'matchings': ('template_matching_defs',),
+        'events': ('event_table',),
+    }
+
+    def __init__(self, config, sampling_freq, lgr):
+        self.config = config
+        self.sampling_freq = sampling_freq
+        self.lgr = lgr
+
+        self.averages = None
+        self.trigger_period = None
+        self.iterations = None
+        self.custom_vars = None
+        self.template_defs = None
+        self.template_identifiers = []
+        self.drag_templates = []
+        self.drag_parameters = {}
+        self.port_settings = None
+        # Each port's pulse definitions and copies, as they were created
+        self.port_pulse_defs = None
+        self.copied_pulse_defs = None
+        self.pulse_definitions = None
+        self.sample_windows = None
+        self.pulse_id_counter = 0
+        self.amp_matrix = None
+        self.fp_matrix = None
+        self.carrier_changes = None
+        self.samples_per_iteration = None
+        self.template_matching_defs = None
+
+        # Sampling parameters
+        self.sampling_ports = None
+        self.sampling_duration = None
+
+        # The calls to the board that set up the sequence, in chronological order
+        self.event_table = None
+
+    def restore(self, vips):
+        """
+        Load this compiled sequence into the given driver instance.
+        """
+        for field in self.FIELDS:
+            setattr(vips, field, getattr(self, field))
+
+    def compile(self, previous=None):
+        """
+        Process the user-given data in the configuration snapshot.
+        Store pulse definitions, envelope templates, and LUT values, for use by other methods.
+        Nothing is set up on the board at this stage.
+        If a previously compiled sequence is given, only the stages that depend on quants whose values differ
+        between the two configurations are rebuilt. Everything else is carried over from the previous sequence.
+        """
+        if previous is not None and previous.sampling_freq == self.sampling_freq:
+            changed = dependencies.get_changed_groups(self.config.get_changed_quants(previous.config))
+            # Carry over pulse IDs and DRAG templates, since unchanged pulses keep referring to them
+            self.pulse_id_counter = previous.pulse_id_counter
+            self.drag_templates = list(previous.drag_templates)
+            self.drag_parameters = dict(previous.drag_parameters)
+        else:
+            previous = None
+            changed = None
+
+        rebuilt_stages = []
+        for stage in dependencies.STAGE_DEPENDENCIES:
+            if not dependencies.needs_rebuild(changed, stage):
+                for field in self.STAGE_FIELDS[stage]:
+                    setattr(self, field, getattr(previous, field))
+                continue
+
+            rebuilt = getattr(self, f'build_{stage}')(previous, changed)
+            rebuilt_stages.append(stage)
+            if changed is not None:
+                # Stages whose output turned out the same do not affect the stages that depend on them
+                if rebuilt:
+                    changed[stage] = rebuilt
+                else:
+                    changed.pop(stage, None)
+
+        if previous is not None:
+            self.lgr.add_line('Rebuilt compile stages: {}', ', '.join(rebuilt_stages))
+
+    def build_custom_vars(self, previous, changed):
+        """
+        Store any custom variables the user sets up.
+        """
+        self.custom_vars = self.get_custom_variables()
+        if previous is not None and self.custom_vars == previous.custom_vars:
+            return set()
+        return {None}
+
+    def build_general(self, previous, changed):
+        """
+        Get some general parameters such as no. of averages, trigger period etc.
+        The number of averages is only used when measuring, so it does not affect any other stage.
+        """
+        self.get_general_settings()
+        if (previous is not None
+                and self.trigger_period == previous.trigger_period
+                and self.iterations == previous.iterations):
+            return set()
+        return {None}
+
+    def build_template_defs(self, previous, changed):
+        """
+        Get template definitions. Only the templates whose settings have changed are rebuilt,
+        along with Long drive templates if the custom variables have changed,
+        and templates that use a custom template whose data has changed.
+        """
+        if (previous is None
+                or dependencies.is_fully_changed(changed, 'templates')
+                or dependencies.is_fully_changed(changed, 'general')):
+            self.template_defs = templates.get_template_defs(self)
+            return {None}
+
+        def_indices = set(changed.get('templates', ()))
+        for def_idx in range(1, len(previous.template_defs) + 1):
+            shape = self.config[f'Envelope template {def_idx}: shape']
+            if shape == 'Long drive' and 'custom_vars' in changed:
+                def_indices.add(def_idx)
+            if shape.startswith('Custom') and int(shape[-1]) in changed.get('custom_templates', ()):
+                def_indices.add(def_idx)
+
+        self.template_defs = list(previous.template_defs)
+        for def_idx in def_indices:
+            self.template_defs[def_idx - 1] = templates.get_template_def(self, def_idx)
+        return def_indices
+
+    def build_port_settings(self, previous, changed):
+        """
+        Get each port's settings, and the numbers of the ports whose settings have changed.
+        """
+        self.port_settings = self.get_port_settings()
+        if previous is None:
+            return {None}
+        return {p + 1 for p in range(self.N_OUT_PORTS) if self.port_settings[p] != previous.port_settings[p]}
+
+    def build_pulse_defs(self, previous, changed):
+        """
+        Get the pulse definitions of each port's definition section. Only the sections whose settings
+        have changed, or that use a template whose definition has changed, are rebuilt.
+        """
+        if (previous is None
+                or 'custom_vars' in changed
+                or dependencies.is_fully_changed(changed, 'general')
+                or dependencies.is_fully_changed(changed, 'template_defs')):
+            # Every DRAG pulse is recreated, so there are no DRAG templates to carry over
+            self.drag_templates = []
+            self.drag_parameters = {}
+            self.port_pulse_defs = [pulses.get_port_pulse_defs(self, port) for port in range(1, self.N_OUT_PORTS+1)]
+            return {None}
+
+        ports = set(changed.get('ports', ())) | changed.get('port_settings', set())
+        changed_templates = changed.get('template_defs', set())
+        for port in range(1, self.N_OUT_PORTS+1):
+            if self.port_settings[port - 1]['Mode'] != 'Define':
+                continue
+            for def_idx in range(1, int(self.config[f'Pulses for port {port}']) + 1):
+                if int(self.config[f'Port {port} - def {def_idx} - template']) in changed_templates:
+                    ports.add(port)
+
+        # DRAG templates made from a changed template can no longer be reused
+        for parameters in list(self.drag_parameters):
+            if parameters[0] in changed_templates:
+                del self.drag_parameters[parameters]
+
+        self.port_pulse_defs = list(previous.port_pulse_defs)
+        for port in sorted(ports):
+            self.port_pulse_defs[port - 1] = pulses.get_port_pulse_defs(self, port)
+        return ports
+
+    def build_sample_windows(self, previous, changed):
+        """
+        Get the sample windows.
+        """
+        self.sample_windows = pulses.get_sample_windows(self)
+        return {None}
+
+    def build_copies(self, previous, changed):
+        """
+        Copy pulse definitions on ports that are set to copy from another port.
+        Only ports whose settings, or whose target port's pulses, have changed are rebuilt.
+        """
+        if previous is None or dependencies.is_fully_changed(changed, 'pulse_defs'):
+            self.copied_pulse_defs = [self.get_copied_defs(port) for port in range(1, self.N_OUT_PORTS+1)]
+            return {None}
+
+        changed_ports = set(changed.get('ports', ())) | changed.get('port_settings', set())
+        changed_sections = changed.get('pulse_defs', set())
+        ports = set()
+        self.copied_pulse_defs = list(previous.copied_pulse_defs)
+        for p, settings in enumerate(self.port_settings):
+            port = p + 1
+            if port in changed_ports or settings.get('Sibling') in changed_sections:
+                self.copied_pulse_defs[p] = self.get_copied_defs(port)
+                ports.add(port)
+        return ports
+
+    def build_timelines(self, previous, changed):
+        """
+        Sort the pulse definitions chronologically, validate them and get the values that will go in the LUTs.
+        Ports whose pulses are unchanged keep their previous LUTs. Ports whose pulses only differ in
+        amplitude keep their frequency/phase LUTs and phase synced pulses, and only have their
+        amplitude scale LUT rebuilt. The LUTs of all other ports are rebuilt from scratch.
+        Only ports whose pulses have changed are validated again.
+        """
+        raw_definitions = self.get_raw_pulse_definitions()
+        self.template_identifiers = pulses.get_template_identifiers(raw_definitions)
+        raw_timelines = luts.get_port_timelines(self, self.sort_pulse_definitions(raw_definitions))
+
+        rebuild_all = (previous is None
+                       or 'phase_sync' in changed
+                       or dependencies.is_fully_changed(changed, 'general'))
+        if rebuild_all:
+            self.amp_matrix = [luts.LUTIndex() for _ in range(self.N_OUT_PORTS)]
+            self.fp_matrix = [luts.LUTIndex() for _ in range(self.N_OUT_PORTS)]
+            self.carrier_changes = [[] for _ in range(self.N_OUT_PORTS)]
+        else:
+            prev_raw_timelines = luts.get_port_timelines(
+                previous, previous.sort_pulse_definitions(previous.get_raw_pulse_definitions()))
+            prev_timelines = luts.get_port_timelines(previous, previous.pulse_definitions)
+            self.amp_matrix = list(previous.amp_matrix)
+            self.fp_matrix = list(previous.fp_matrix)
+            self.carrier_changes = list(previous.carrier_changes)
+
+        # The LUTs phase sync pulses in place, so they are given copies of the unsynced pulses to work on
+        timelines = []
+        changed_ports = []
+        amp_ports = []
+        full_ports = []
+        for p, raw_timeline in enumerate(raw_timelines):
+            if rebuild_all:
+                full_ports.append(p)
+            else:
+                prev_raw_timeline = prev_raw_timelines[p]
+                if [pulse['ID'] for pulse in raw_timeline] == [pulse['ID'] for pulse in prev_raw_timeline]:
+                    # Nothing has changed on this port
+                    timelines.append(prev_timelines[p])
+                    continue
+                if not self.have_same_carriers(raw_timeline, prev_raw_timeline):
+                    full_ports.append(p)
+                else:
+                    # Reuse the phase synced values, which only depend on times, frequencies and phases
+                    timelines.append([pulse.copy(Phase=prev_pulse['Phase'])
+                                      for pulse, prev_pulse in zip(raw_timeline, prev_timelines[p])])
+                    if any(not np.array_equal(pulse['Amp'], prev_pulse['Amp'])
+                           for pulse, prev_pulse in zip(raw_timeline, prev_raw_timeline)):
+                        amp_ports.append(p)
+            changed_ports.append(p + 1)
+            if p in full_ports:
+                timelines.append([pulse.copy() for pulse in raw_timeline])
+
+        self.pulse_definitions = self.sort_pulse_definitions([pulse for timeline in timelines for pulse in timeline])
+        self.validate_pulse_definitions(changed_ports)
+
+        for p in amp_ports:
+            self.amp_matrix[p] = luts.get_port_amp_values(self, timelines[p])
+        for p in full_ports:
+            if len(timelines[p]) < 1:
+                self.amp_matrix[p], self.fp_matrix[p], self.carrier_changes[p] = luts.LUTIndex(), luts.LUTIndex(), []
+                continue
+            self.amp_matrix[p], self.fp_matrix[p], self.carrier_changes[p] = \
+                luts.get_port_LUT_values(self, timelines[p])
+
+        if rebuild_all:
+            return {None}
+        return set(changed_ports)
+
+    def build_matchings(self, previous, changed):
+        """
+        Get template matching data.
+        """
+        self.template_matching_defs = template_matching.get_template_matching_definitions(self)
+        return {None}
+
+    def build_events(self, previous, changed):
+        """
+        Get the event table, which holds every call to the board that sets up the sequence, in chronological order.
+        """
+        self.event_table = scheduling.get_event_table(self)
+        return {None}
+
+    def get_raw_pulse_definitions(self):
+        """
+        Get every pulse definition and copy in the order they were created, before any phase syncing.
+        """
+        return [pulse for defs in self.port_pulse_defs + self.copied_pulse_defs for pulse in defs]
+
+    @staticmethod
+    def sort_pulse_definitions(pulse_definitions):
+        """
+        Sort the given pulse definitions chronologically.
+        """
+        return sorted(pulse_definitions, key=lambda x: x['Ticks'][0] + x['Ticks'][1])
+
+    @staticmethod
+    def have_same_carriers(timeline, other):
+        """
+        Check whether two chronological lists of pulses on a port only differ in their amplitudes,
+        in which case they result in the same frequency/phase LUT and carrier changes.
+        """
+        if len(timeline) != len(other):
+            return False
+        for pulse, other_pulse in zip(timeline, other):
+            if pulse['Ticks'] != other_pulse['Ticks'] or pulse['Carrier'] != other_pulse['Carrier']:
+                return False
+            if (not np.array_equal(pulse['Freq'], other_pulse['Freq'])
+                    or not np.array_equal(pulse['Phase'], other_pulse['Phase'])):
+                return False
+        return True
+
+    def get_custom_variables(self):
+        """
+        Stores user-defined custom variables in a dict, with variable names as keys.
+        Returns this dict.
+        """
+        custom_vars = {}
+        for i in range(1, self.MAX_VARIABLES+1):
+            name = self.config[f'Custom variable {i} - name']
+            if name.startswith('INVALID:'):
+                raise ValueError(f'Custom variable {i} has an invalid name!')
+            if name != '':
+                if name in custom_vars:
+                    raise ValueError(f'More than one custom variable has the name "{name}"!')
+                value = self.config[f'Custom variable {i} - value']
+                custom_vars[name] = value
+
+        return custom_vars
+
+    def get_general_settings(self):
+        """
+        Get instrument parameters from the 'General settings' section.
+        These are saved in global variables.
+        """
+        self.averages = int(self.config['Average'])
+        self.trigger_period = self.config['Trigger period']
+        if self.trigger_period == 0:
+            raise ValueError('Trigger period cannot be 0!')
+        self.iterations = int(self.config['Iterations'])
+
+    def get_port_settings(self):
+        """
+        Get each port's settings.
+        Port settings are represented by an array of dictionaries, each representing a single output port's settings.
+            The 'Mode' key contains the port's mode (Define, Disabled, Copy)
+            If a port is in copy mode, also save the port it is copying from in a 'Sibling' key.
+        Return a list of these dictionaries.
+        """
+        port_settings = [{} for _ in range(self.N_OUT_PORTS)]
+
+        # Get the mode for each port
+        for port in range(1, self.N_OUT_PORTS+1):
+            p = port - 1
+            mode = self.config[f'Port {port} - mode']
+            port_settings[p]['Mode'] = mode
+            if mode == 'Copy':
+                port_settings[p]['Sibling'] = int(self.config[f'Port {port} - copy sequence from'])
+
+        return port_settings
+
+    def validate_pulse_definitions(self, ports):
+        """
+        Ensure that pulse definitions on different carrier generators of the given ports
+        interact in a safe way. Pulses can only overlap if they have the same start and end time,
+        and their combined amplitude cannot exceed 1.
+        Every iteration is checked at once, going through each port's pulses in the order they are
+        set up in: iteration by iteration, in the order of the pulse definitions. The first problem is reported.
+        """
+        iterations = np.arange(self.iterations)
+        for p in sorted(port - 1 for port in ports):
+            port_pulses = [pulse for pulse in self.pulse_definitions if pulse['Port'] == p+1]
+            if len(port_pulses) == 0 or self.iterations == 0:
+                continue
+
+            # Arrays of shape (iterations, pulses) in sample ticks, flattened to the order the pulses are set up in
+            ticks = np.array([pulse['Ticks'] for pulse in port_pulses]).T
+            rel_starts = (ticks[0] + ticks[1] * iterations[:, np.newaxis]).ravel()
+            starts = utils.get_absolute_ticks(self, ticks, iterations[:, np.newaxis]).ravel()
+            durations = np.stack([utils.get_duration_ticks(self, self.template_defs[pulse['Template_no']-1], iterations)
+                                  for pulse in port_pulses], axis=1).ravel()
+            carriers = np.tile([pulse['Carrier'] for pulse in port_pulses], self.iterations)
+            amps = np.stack([np.array(pulse['Amp'], dtype=float) for pulse in port_pulses], axis=1).ravel()
+            is_drag = np.tile(['DRAG_idx' in pulse for pulse in port_pulses], self.iterations)
+
+            # Each pulse is compared to the one set up before it
+            prev_starts = np.concatenate(([-1], starts[:-1]))
+            prev_durations = np.concatenate(([0], durations[:-1]))
+            prev_carriers = np.concatenate(([-1], carriers[:-1]))
+            prev_amps = np.concatenate(([0], amps[:-1]))
+
+            # Ensure that pulses start within the trigger period
+            negative_start = rel_starts < 0
+            late_end = rel_starts + durations > utils.get_ticks(self, self.trigger_period)
+            same_start = starts == prev_starts
+            amp_overflow = same_start & ~is_drag & (np.abs(amps + prev_amps) > 1)
+            overlap = np.where(same_start,
+                               (carriers == prev_carriers) | (durations != prev_durations),
+                               starts < prev_starts + prev_durations)
+
+            problems = np.flatnonzero(negative_start | late_end | amp_overflow | overlap)
+            if len(problems) == 0:
+                continue
+            idx = problems[0]
+            it = idx // len(port_pulses)
+            start = port_pulses[idx % len(port_pulses)]['Time']
+            if negative_start[idx]:
+                raise ValueError(f'A pulse on port {p+1} has a negative start time in iteration {it+1}!')
+            if late_end[idx]:
+                raise ValueError(f'A pulse on port {p+1} ends after the end '
+                                 f'of the trigger period in iteration {it+1}!')
+            if amp_overflow[idx]:
+                raise ValueError(f'The combined amplitude of the overlapping pulses at time '
+                                 f'{start[0] + start[1]*it} on port {p + 1} exceeds 1 or -1!')
+            raise ValueError(f"Two pulses overlap incorrectly at time {start[0] + start[1]*it} "
+                             f"on port {p + 1} during iteration {it+1}! "
+                             f"Overlapping pulses must use different carrier generators and "
+                             f"have identical start times and durations.")
+
+    def get_copied_defs(self, port):
+        """
+        If the given port is set to copy from another port, create pulse definitions
+        on that port based on the target port's definitions.
+        Return a list of the copied pulse definitions, which is empty if the port is not in copy mode.
+        """
+        copies = []
+        settings = self.port_settings[port - 1]
+        if settings['Mode'] != 'Copy':
+            # Port is not in copy mode
+            return copies
+
+        target = settings['Sibling']
+        # Only copy from ports that have pulses defined to them
+        if not self.config[f'Port {target} - mode'] == 'Define':
+            raise ValueError(f'Output port {port} is set to copy from port {target}, '
+                             f'which is either undefined or a copy!')
+
+        amp_shift = self.config[f'Port {port} - amplitude scale multiplier']
+        phase_shift = self.config[f'Port {port} - phase shift']
+
+        # Copy pulse defs
+        for pulse in self.port_pulse_defs[target - 1]:
+            # DRAG pulses (and their siblings on other ports) are not copied
+            if pulse['Port'] == target and 'DRAG_idx' not in pulse:
+                # View every pulse on the new port. The shifts are applied when its values are first used.
+                p_copy = pulses.CopiedPulseDefinition(pulse, amp_shift, phase_shift,
+                                                      ID=pulses.get_next_pulse_id(self),
+                                                      Port=port)
+
+                # Use the old target pulse's template on the new port
+                p_ti = pulse['Template_identifier']
+                new_template_identifier = templates.TemplateIdentifier(port, p_ti.carrier, p_ti.def_idx,
+                                                                       p_ti.cond_on,
+                                                                       p_ti.cond1, p_ti.cond2,
+                                                                       p_ti.cond1_quad, p_ti.cond2_quad)
+                p_copy['Template_identifier'] = new_template_identifier
+                copies.append(p_copy)
+        return copies
+
+
+class CompileCache:
+    """
+    A bounded cache of compiled sequences, indexed by the fingerprint of the configuration
+    they were compiled from. When the cache is full, the least recently used sequence is evicted.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.sequences = OrderedDict()
+
+    def get(self, fingerprint):
+        """
+        Return the compiled sequence stored under the given fingerprint, or None if there is none.
+        """
+        compiled = self.sequences.get(fingerprint)
+        if compiled is not None:
+            self.sequences.move_to_end(fingerprint)
+        return compiled
+
+    def put(self, fingerprint, compiled):
+        """
+        Store a compiled sequence under the given fingerprint, evicting the oldest entry if needed.
+        """
+        self.sequences[fingerprint] = compiled
+        self.sequences.move_to_end(fingerprint)
+        while len(self.sequences) > self.max_size:
+            self.sequences.popitem(last=False)
+
+    def clear(self):
+        self.sequences.clear()
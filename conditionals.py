@@ -55,8 +55,8 @@ def setup_conditionals(vips, q):
     for condition in all_conditionals:
         (gt_templates, lt_templates) = all_conditionals[condition]
 
-        vips.lgr.add_line(f'q.setup_condition(matches={list(condition)}, true_templates={gt_templates}, '
-                          f'false_templates={lt_templates})')
+        vips.lgr.add_line('q.setup_condition(matches={}, true_templates={}, false_templates={})',
+                          list(condition), gt_templates, lt_templates)
         try:
             q.setup_condition(list(condition), gt_templates, lt_templates)
         except RuntimeError:
@@ -0,0 +1,189 @@
+# Authored by Johan Blomberg and Gustav Grännsjö, 2020
+
+"""
+A collection of functions and classes for taking snapshots of the instrument's configuration.
+The quants are read from the instrument definition file, which is generated by
+generate_vivace_pulse_sequencer_ini.py, so the snapshot always covers the same quants as the instrument.
+"""
+
+import hashlib
+import os
+from collections import namedtuple
+from collections.abc import Mapping
+from types import MappingProxyType
+
+import numpy as np
+
+INI_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Vivace_Pulse_Sequencer.ini')
+
+# The schema entry of a single quant: its name, its datatype and its default value
+QuantSchema = namedtuple('QuantSchema', ['name', 'datatype', 'default'])
+
+_schema = None
+
+
+def get_schema():
+    """
+    Get the schema entries of all quants in the instrument definition that affect what is set up on the board.
+    Quants marked as 'not_affecting_board', read-only quants, buttons and output quants are left out.
+    The definition file is only read once, after which the result is reused.
+    """
+    global _schema
+    if _schema is not None:
+        return _schema
+
+    schema = []
+    with open(INI_PATH, encoding='utf-8') as ini:
+        section = None
+        for line in ini:
+            line = line.strip()
+            if line.startswith('['):
+                if section is not None:
+                    schema.append(section)
+                name = line[1:-1]
+                # The first section holds the instrument's general settings, not a quant
+                section = {'name': name, 'combo_def_1': None} if name != 'General settings' else None
+            elif section is not None and ': ' in line and not line.startswith('#'):
+                key, value = line.split(': ', 1)
+                section[key] = value
+    if section is not None:
+        schema.append(section)
+
+    entries = []
+    for section in schema:
+        if ('not_affecting_board' in section.get('set_cmd', '')
+                or 'get_cmd' in section
+                or section.get('permission') == 'READ'
+                or section.get('datatype') == 'BUTTON'):
+            continue
+        datatype = section['datatype']
+        default = section.get('def_value', section['combo_def_1'])
+        entries.append(QuantSchema(section['name'], datatype, convert_value(datatype, default)))
+
+    _schema = tuple(entries)
+    return _schema
+
+
+def convert_value(datatype, value):
+    """
+    Convert a quant value to the Python type that corresponds to the given datatype.
+    None is converted to the datatype's empty value.
+    """
+    if datatype == 'DOUBLE':
+        return float(value) if value is not None else 0.0
+    if datatype == 'BOOLEAN':
+        if isinstance(value, str):
+            return value == 'True'
+        return bool(value)
+    if datatype in ('COMBO', 'STRING'):
+        return str(value) if value is not None else ''
+    if datatype == 'VECTOR':
+        if value is None:
+            value = {'y': np.zeros(0), 't0': 0.0, 'dt': 1.0}
+        # Store read-only copies of the vector's arrays
+        vector = {}
+        for key, item in value.items():
+            if isinstance(item, (np.ndarray, list)):
+                item = np.array(item)
+                item.setflags(write=False)
+            vector[key] = item
+        return MappingProxyType(vector)
+    return value
+
+
+def get_vector_digest(vector):
+    """
+    Get a digest of the contents of a vector quant value. Numerical arrays are hashed as float64 values,
+    so vectors with equal contents have the same digest regardless of how they were given.
+    """
+    digest = hashlib.sha1()
+    for key in sorted(vector):
+        item = vector[key]
+        digest.update(key.encode())
+        if isinstance(item, (np.ndarray, list)):
+            item = np.asarray(item)
+            if item.dtype.kind in 'biuf':
+                item = item.astype(np.float64, copy=False)
+            digest.update(str(item.dtype).encode())
+            digest.update(np.ascontiguousarray(item).tobytes())
+        elif isinstance(item, (int, float)) and not isinstance(item, bool):
+            digest.update(repr(float(item)).encode())
+        else:
+            digest.update(repr(item).encode())
+    return digest.hexdigest()
+
+
+class ConfigSnapshot(Mapping):
+    """
+    An immutable snapshot of the values of every board-affecting quant in the instrument,
+    indexed by quant name. Each value has been converted to the type given by its quant's datatype.
+    Compilation reads all of its settings from a snapshot, so it does not need a connection to Labber.
+    """
+    __slots__ = ('_values', 'fingerprint')
+
+    def __init__(self, values):
+        """
+        Take a snapshot of the given values. Quants without a given value use their default.
+        """
+        snapshot = {}
+        scalars = []
+        digest = hashlib.sha1()
+        for quant in get_schema():
+            value = convert_value(quant.datatype, values.get(quant.name, quant.default))
+            snapshot[quant.name] = value
+
+            # Vector quants hold their data in numpy arrays, which need to be hashed by content
+            if quant.datatype == 'VECTOR':
+                digest.update(quant.name.encode())
+                digest.update(get_vector_digest(value).encode())
+            else:
+                scalars.append(value)
+        # The schema's order is fixed, so the remaining values can be hashed in one go
+        digest.update(repr(scalars).encode())
+
+        object.__setattr__(self, '_values', MappingProxyType(snapshot))
+        object.__setattr__(self, 'fingerprint', digest.hexdigest())
+
+    @classmethod
+    def from_driver(cls, vips):
+        """
+        Take a snapshot of the current quant values in the given driver, in a single pass over the schema.
+        """
+        return cls({quant.name: vips.getValue(quant.name) for quant in get_schema()})
+
+    def __setattr__(self, key, value):
+        raise AttributeError('Configuration snapshots cannot be modified!')
+
+    def __getitem__(self, name):
+        return self._values[name]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def get_changed_quants(self, other):
+        """
+        Get the names of the quants whose values differ between this snapshot and another one.
+        """
+        return [name for name, value in self._values.items() if not are_values_equal(value, other[name])]
+
+
+def are_values_equal(value, other):
+    """
+    Check whether two converted quant values are equal. Vector values are compared by content.
+    """
+    if isinstance(value, MappingProxyType):
+        if value is other:
+            return True
+        if not isinstance(other, MappingProxyType) or value.keys() != other.keys():
+            return False
+        for key, item in value.items():
+            if isinstance(item, np.ndarray):
+                if not np.array_equal(item, other[key]):
+                    return False
+            elif item != other[key]:
+                return False
+        return True
+    return value == other
@@ -0,0 +1,82 @@
+# Authored by Johan Blomberg and Gustav Grännsjö, 2020
+
+"""
+A description of how the stages of compilation depend on the instrument's quants and on each other.
+Quants are sorted into groups, and each compile stage lists the groups and earlier stages it is built from.
+When a quant changes, only the stages that depend on its group, directly or through another stage, are rebuilt.
+"""
+
+import re
+
+# The quant groups and earlier stages that each compile stage is built from.
+# The stages are listed in the order they are built in, which is also the order their settings are validated in.
+STAGE_DEPENDENCIES = {
+    'custom_vars': ('custom_vars',),
+    'general': ('general',),
+    'template_defs': ('templates', 'custom_templates', 'custom_vars', 'general'),
+    'port_settings': ('ports',),
+    'pulse_defs': ('ports', 'port_settings', 'template_defs', 'custom_vars', 'general'),
+    'sample_windows': ('sampling', 'custom_vars', 'general'),
+    'copies': ('ports', 'port_settings', 'pulse_defs'),
+    'timelines': ('pulse_defs', 'copies', 'template_defs', 'phase_sync', 'general'),
+    'matchings': ('matching', 'custom_templates', 'sample_windows', 'general'),
+    'events': ('timelines', 'template_defs', 'sample_windows', 'general'),
+}
+
+# Patterns that sort quants into groups, tried in order.
+# Groups that are split up by port or template number capture that number.
+QUANT_GROUPS = (
+    (re.compile(r'Custom variable \d+ - '), 'custom_vars'),
+    (re.compile(r'(Average|Trigger period|Iterations)$'), 'general'),
+    (re.compile(r'Phase sync behaviour$'), 'phase_sync'),
+    (re.compile(r'Envelope template count$'), 'templates'),
+    (re.compile(r'Envelope template (\d+): '), 'templates'),
+    (re.compile(r'Custom template (\d+)$'), 'custom_templates'),
+    (re.compile(r'Port (\d+) - DC bias$'), 'biases'),
+    (re.compile(r'Port (\d+) - '), 'ports'),
+    (re.compile(r'Pulses for port (\d+)$'), 'ports'),
+    (re.compile(r'Sampling'), 'sampling'),
+    (re.compile(r'(Number of matches|Template matching )'), 'matching'),
+)
+
+
+def get_quant_group(name):
+    """
+    Get the group that the given quant belongs to, as a tuple of the group's name and
+    the port or template number the quant is specific to. The number is None if the quant affects the whole group.
+    Quants that no compile stage depends on belong to the 'other' group.
+    """
+    for pattern, group in QUANT_GROUPS:
+        match = pattern.match(name)
+        if match is not None:
+            index = int(match.group(1)) if match.lastindex and match.group(1).isdigit() else None
+            return group, index
+    return 'other', None
+
+
+def get_changed_groups(changed_quants):
+    """
+    Sort the names of the given changed quants into their groups.
+    Return a dictionary with group names as keys, and sets of the affected port or template numbers as values.
+    A None in a set means that the whole group is affected.
+    """
+    changed = {}
+    for name in changed_quants:
+        group, index = get_quant_group(name)
+        changed.setdefault(group, set()).add(index)
+    return changed
+
+
+def is_fully_changed(changed, key):
+    """
+    Check whether every part of the given group or stage has changed.
+    A changed value of None means that everything is being rebuilt.
+    """
+    return changed is None or None in changed.get(key, ())
+
+
+def needs_rebuild(changed, stage):
+    """
+    Check whether the given compile stage depends on anything that has changed.
+    """
+    return changed is None or any(key in changed for key in STAGE_DEPENDENCIES[stage])
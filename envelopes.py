@@ -2,27 +2,59 @@
 
 """
 A collection of functions for generating specific envelope shapes.
+Generated envelopes are cached, so the same shape is only computed once per process.
 """
 
+import functools
+
 import numpy as np
 from scipy.stats import norm
 
+# The number of envelopes of each shape that are kept in the cache
+ENVELOPE_CACHE_SIZE = 64
+# How many sigma the Gaussian flanks of long drives are cut off at
+FLANK_CUTOFF = 3.2
+
+
+def cached_envelope(generator):
+    """
+    Decorate an envelope generator so that its results are cached by its arguments.
+    The least recently used envelopes are evicted once the cache is full.
+    The cached arrays are shared between callers, and are therefore made read-only.
+    """
+    @functools.lru_cache(maxsize=ENVELOPE_CACHE_SIZE)
+    def cached(*args):
+        envelope = generator(*args)
+        envelope.setflags(write=False)
+        return envelope
 
+    @functools.wraps(generator)
+    def wrapper(*args):
+        return cached(*args)
+    wrapper.cache_info = cached.cache_info
+    wrapper.cache_clear = cached.cache_clear
+    return wrapper
+
+
+@cached_envelope
 def sin2(nr_samples):
     x = np.linspace(0.0, 1.0, nr_samples)
     return np.sin(np.pi * x)**2
 
 
+@cached_envelope
 def sin_p(p, nr_samples):
     x = np.linspace(0.0, 1.0, nr_samples)
     return np.sin(np.pi * x)**p
 
 
+@cached_envelope
 def sinc(lim, nr_samples):
     x = np.linspace(-lim, lim, nr_samples)
     return np.sinc(x)
 
 
+@cached_envelope
 def triangle(nr_samples):
     if nr_samples % 2 == 0:
         t1 = np.linspace(0.0, 1.0, nr_samples // 2)
@@ -34,6 +66,7 @@ def triangle(nr_samples):
         return np.concatenate((t1, [1], t2))
 
 
+@cached_envelope
 def cool(nr_samples):
     x = np.linspace(0.0, 1.0, nr_samples)
     s = np.sin(4 * np.pi * x)
@@ -41,8 +74,25 @@ def cool(nr_samples):
     return t * s
 
 
+@cached_envelope
 def gaussian(nr_samples, trunc):
     x = np.linspace(-trunc, trunc, nr_samples)
     y = norm.pdf(x, 0, 1)
     # Normalise
     return y / y.max()
+
+
+@cached_envelope
+def gaussian_rise(nr_samples):
+    x = np.linspace(-FLANK_CUTOFF, 0, nr_samples)
+    y = norm.pdf(x, 0, 1)
+    y = y / y.max()
+    y[0] = 0  # For symmetry's sake
+    return y
+
+
+@cached_envelope
+def gaussian_fall(nr_samples):
+    x = np.linspace(0, FLANK_CUTOFF, nr_samples)
+    y = norm.pdf(x, 0, 1)
+    return y / y.max()
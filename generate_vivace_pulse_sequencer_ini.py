@@ -505,10 +505,35 @@ def section_preview():
                 'Output pulses that overlap with these sample windows will be hidden.')
     gen.set_cmd('not_affecting_board')
 
+    gen.create_quant('Preview resolution', 'Preview resolution', 'DOUBLE', group, section)
+    gen.tooltip('The largest number of time steps the preview is drawn with. Longer previews are drawn as '
+                'the minimum and maximum of the sequence within each step. Set to 0 to always draw every sample.')
+    gen.default(50000)
+    gen.limits(low=0)
+    gen.set_cmd('int', 'not_affecting_board')
+
     gen.create_quant('Pulse sequence preview', '', 'VECTOR', group, section)
     gen.get_cmd('sequence_preview')
     gen.permission('READ')
 
+    gen.create_quant('Sweep preview resolution', 'Sweep preview resolution', 'DOUBLE', group, section)
+    gen.tooltip('The largest number of time steps each iteration of the sweep preview is drawn with. '
+                'Set to 0 to always draw every sample.')
+    gen.default(1000)
+    gen.limits(low=0)
+    gen.set_cmd('int', 'not_affecting_board')
+
+    gen.create_quant('Pulse sequence sweep preview', '', 'VECTOR', group, section)
+    gen.tooltip('The preview of every iteration of the sequence on the preview port, one after the other.')
+    gen.get_cmd('sweep_preview')
+    gen.permission('READ')
+
+    gen.create_quant('Multi-port sequence preview', '', 'VECTOR', group, section)
+    gen.tooltip(f'The preview of the preview iteration on each of the {N_OUT_PORTS} output ports, one after the other, '
+                'followed by the number of sample windows and the number of template matchings in progress.')
+    gen.get_cmd('multi_port_preview')
+    gen.permission('READ')
+
 
 def section_debug():
     section = 'Debug'
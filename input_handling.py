@@ -4,10 +4,23 @@
 A collection of functions for processing various kinds of user input in ViPS.
 """
 
+import functools
 import re
 import math
 
-import numpy as np
+import configuration
+
+# Patterns for the parts of a time string. The first part of a string may leave out its sign.
+VARIABLE_PATTERNS = {first: re.compile(('[+-]?' if first else '[+-]') + r'[A-Za-z_]+[0-9A-Za-z_]*(\*i)?')
+                     for first in (True, False)}
+NUMBER_PATTERNS = {first: re.compile(('[+-]?' if first else '[+-]') + r'(([0-9]*\.[0-9]+)|([0-9]+))(e-?[0-9]+)?(\*?i)?',
+                                     re.I)
+                   for first in (True, False)}
+# Valid variable names, or an empty string
+VARIABLE_NAME_PATTERN = re.compile('|([A-Za-z_]+[0-9A-Za-z_]*)')
+
+# The number of distinct time strings whose compiled forms are kept
+TIME_STRING_CACHE_SIZE = 1024
 
 
 def handle_input(quant, value):
@@ -22,8 +35,7 @@ def handle_input(quant, value):
         # Strip the input down to the essential part
         value = value.replace('INVALID:', '')
         value = value.replace(' ', '')
-        valid = re.compile('|([A-Za-z_]+[0-9A-Za-z_]*)')
-        match = valid.fullmatch(value)
+        match = VARIABLE_NAME_PATTERN.fullmatch(value)
         if not match:
             return f'INVALID: {value}'
         return value
@@ -82,9 +94,7 @@ def validate_time_string(value, is_list):
         if len(s) == 0:
             return f'INVALID: {value}'
         while len(s) > 0:
-            prefix = '[+-]?' if first else '[+-]'
-            var_rex = re.compile(prefix + r'[A-Za-z_]+[0-9A-Za-z_]*(\*i)?')
-            var_match = var_rex.match(s)
+            var_match = VARIABLE_PATTERNS[first].match(s)
             if var_match:
                 # Remove the matched part from input
                 match_str = var_match.group()
@@ -98,8 +108,7 @@ def validate_time_string(value, is_list):
                 continue
 
             # No variable match, check for numeric value
-            num_rex = re.compile(prefix + r'(([0-9]*\.[0-9]+)|([0-9]+))(e-?[0-9]+)?(\*?i)?', re.I)
-            num_match = num_rex.match(s)
+            num_match = NUMBER_PATTERNS[first].match(s)
             if num_match:
                 # Remove the matched part from input
                 match_str = num_match.group()
@@ -135,9 +144,12 @@ def validate_time_string(value, is_list):
     return result
 
 
-def is_value_new(vips, quant, value):
+def is_value_new(vips, quant, value, digest=None):
     """
     Check if the given value differs from the value stored in the given quant.
+    The value should already have been processed by handle_input, since that is the form the stored value is in.
+    Values are compared by equality, so equal values given as different objects do not count as new.
+    Vector values are compared by a digest of their contents, which can be given to avoid hashing the value again.
     """
     current_value = vips.getValue(quant.name)
 
@@ -145,37 +157,42 @@ def is_value_new(vips, quant, value):
     if quant.datatype == 2 and isinstance(value, float):
         current_value = vips.getValueIndex(quant.name)
 
-    # If it is a vector, we need to do a different equality test (because numpy does not work with == checks)
     if isinstance(value, dict):
-        if len(current_value['y']) != len(value['y']):
-            return True
-        # If the vectors are of the same length and use plain time axes, we need to run an elementwise comparison
-        if 'x' in current_value and 'x' in value:
-            if not (np.allclose(current_value['y'], value['y'])
-                    and np.allclose(current_value['x'], value['x'])):
-                return True
-        # If the new vector is not in the same format, it counts as changed
-        elif 'x' in current_value or 'x' in value:
-            return True
-        # The vectors are in base-delta time format, compare these values along with y values
-        else:
-            if not (np.allclose(current_value['y'], value['y'])
-                    and np.isclose(current_value['t0'], value['t0'])
-                    and np.isclose(current_value['dt'], value['dt'])):
-                return True
+        if digest is None:
+            digest = configuration.get_vector_digest(value)
+        current_digest = vips.vector_digests.get(quant.name)
+        if current_digest is None:
+            current_digest = configuration.get_vector_digest(current_value)
+        return digest != current_digest
+
     # Use a little leniency when checking floats due to rounding errors in python
-    elif isinstance(value, float):
-        if not math.isclose(current_value, value):
-            return True
-    elif current_value is not value:
-        return True
-    return False
+    if isinstance(value, float) and isinstance(current_value, (int, float)):
+        return not math.isclose(current_value, value)
+    return current_value != value
 
 
 def compute_time_string(vips, string):
     """
     Parses a string containing numeric and variable values,
     and returns the summed up base and delta values separately.
+    The string is only parsed the first time it is seen, after which only its variables are looked up.
+    """
+    base, delta, variables = compile_time_string(string)
+    for name, base_coefficient, delta_coefficient in variables:
+        if name not in vips.custom_vars:
+            raise ValueError(f'Variable "{name}" is not defined!')
+        value = vips.custom_vars[name]
+        base += base_coefficient * value
+        delta += delta_coefficient * value
+    return base, delta
+
+
+@functools.lru_cache(maxsize=TIME_STRING_CACHE_SIZE)
+def compile_time_string(string):
+    """
+    Parse a time string into a linear form: the summed up numeric base and delta values,
+    and a tuple with the name of every variable in the string along with its base and delta coefficients.
+    The compiled forms are cached by string.
     """
     if string.startswith('INVALID:'):
         raise ValueError('Invalid format of time string!')
@@ -186,6 +203,8 @@ def compute_time_string(vips, string):
     latest_sign = 1
     base = 0.0
     delta = 0.0
+    # The base and delta coefficients of each variable, in the order they first appear
+    coefficients = {}
     for part in parts:
         if part == '+':
             latest_sign = 1
@@ -197,8 +216,7 @@ def compute_time_string(vips, string):
         # Literal number
         if part[0].isdigit():
             # Check if this is a delta value
-            i_found = re.search('i', part)
-            if i_found:
+            if 'i' in part:
                 part = part.replace('*', '')
                 part = part.replace('i', '')
                 delta += float(part) * latest_sign
@@ -210,25 +228,22 @@ def compute_time_string(vips, string):
         # Variable
         if part[0].isalpha() or part[0] == '_':
             # Check if this is a delta value
-            i_found = re.search(r'\*i', part)
-            if i_found:
-                part = part.replace('*i', '')
-                if part in vips.custom_vars:
-                    delta += vips.custom_vars[part] * latest_sign
-                    continue
-                else:
-                    raise ValueError(f'Variable "{part}" is not defined!')
-
-            if part in vips.custom_vars:
-                base += vips.custom_vars[part] * latest_sign
-                continue
+            is_delta = part.endswith('*i')
+            name = part[:-2] if is_delta else part
+            base_coefficient, delta_coefficient = coefficients.get(name, (0, 0))
+            if is_delta:
+                delta_coefficient += latest_sign
             else:
-                raise ValueError(f'Variable "{part}" is not defined!')
+                base_coefficient += latest_sign
+            coefficients[name] = (base_coefficient, delta_coefficient)
+            continue
 
         # Failsafe, should never happen
         raise ValueError('Something went wrong when parsing a time string!')
 
-    return base, delta
+    variables = tuple((name, base_coefficient, delta_coefficient)
+                      for name, (base_coefficient, delta_coefficient) in coefficients.items())
+    return base, delta, variables
 
 
 def parse_list_of_doubles(string):
@@ -1,9 +1,16 @@
 # Authored by Johan Blomberg and Gustav Grännsjö, 2020
 
+import hashlib
+import numbers
 import os
 from pathlib import Path
 import time
 
+import numpy as np
+
+# Arrays and lists of numbers with more elements than this are summarised in the log instead of printed in full
+ARRAY_SUMMARY_LENGTH = 16
+
 
 class Logger:
     """
@@ -27,21 +34,43 @@ class Logger:
     USER_DIR = os.path.expanduser('~')
     DEBUG_PATH = 'Vivace_Sequencer_Debug'
     INITIAL_TIME = None
+    # The number of lines that are kept in memory before they are written to the log file
+    BUFFER_SIZE = 1000
+
+    def __init__(self):
+        # Timestamped lines that have not been written to the log file yet
+        self.buffer = []
 
-    def add_line(self, string):
+    def add_line(self, string, *args):
         """
-        Add the given string as a line to the string that will be written to the log file.
-        Also writes the current version of that string to the log file.
+        Add a line to the log. If any arguments are given, the string is a format string for them,
+        and it is only formatted if logging is enabled, so that logging costs nothing when it is disabled.
+        Large arrays among the arguments are summarised instead of printed in full.
+        Lines are kept in memory and written to the log file in bulk, whenever enough of them
+        have been added, when a new log is started, or when flush() is called.
         """
         if self.enable:
             if self.new_log:
+                self.flush()
                 self.initialise_log_file()
                 self.INITIAL_TIME = time.time()
                 self.new_log = False
 
+            if args:
+                string = string.format(*[format_value(arg) for arg in args])
+            self.buffer.append((time.time() - self.INITIAL_TIME, string))
+            if len(self.buffer) >= self.BUFFER_SIZE:
+                self.flush()
+
+    def flush(self):
+        """
+        Write every line in memory to the log file.
+        """
+        if len(self.buffer) > 0:
             directory = os.path.join(self.USER_DIR, self.DEBUG_PATH)
             with open(os.path.join(directory, f'{self.working_file_name}.txt'), 'a') as f:
-                f.write(str(time.time() - self.INITIAL_TIME) + ": " + string + '\n')
+                f.write(''.join(f'{timestamp}: {string}\n' for timestamp, string in self.buffer))
+            self.buffer = []
 
     def initialise_log_file(self):
         """
@@ -75,3 +104,22 @@ class Logger:
             for trigger in q.seq:
                 parts = str(trigger).split(',', 1)
                 self.add_line(parts[1])
+
+
+def format_value(value):
+    """
+    Format a value for the log. Arrays and lists of numbers with more than ARRAY_SUMMARY_LENGTH elements
+    are summarised by their shape, a hash of their contents and their smallest and largest values.
+    """
+    if isinstance(value, (list, tuple)) and len(value) > ARRAY_SUMMARY_LENGTH:
+        if all(isinstance(x, numbers.Number) for x in value):
+            value = np.array(value)
+    if not isinstance(value, np.ndarray) or value.size <= ARRAY_SUMMARY_LENGTH or value.dtype == object:
+        return str(value)
+
+    digest = hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest()[:12]
+    if np.iscomplexobj(value):
+        magnitudes = np.abs(value)
+        return f'array(shape={value.shape}, sha1={digest}, min abs={magnitudes.min()}, max abs={magnitudes.max()})'
+    return f'array(shape={value.shape}, sha1={digest}, min={value.min()}, max={value.max()})'
+
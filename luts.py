@@ -5,183 +5,352 @@ A collection of functions for setting up the Look-up tables for amplitude,
 frequency and phase used by Vivace.
 """
 
+import itertools
+import math
+
 import numpy as np
 
 import utils
 
+# The relative tolerance within which two LUT values are considered equal, the same as math.isclose()'s default
+LUT_REL_TOL = 1e-9
+# The number of buckets that each power of two is split into when indexing LUT values.
+# Each bucket is wider than the tolerance, so close values are always in the same or neighbouring buckets.
+LUT_BUCKETS_PER_OCTAVE = 2 ** 24
+
+
+class LUTIndex:
+    """
+    Objects of this class hold the values of a single LUT, in order, along with a hash index of them.
+    The index maps quantized values to their LUT indices, so that looking up the LUT index of a value
+    only compares it against the few values that are close to it, instead of against the entire LUT.
+    Values are either numbers or tuples of a pair of frequency/phase tuples, which are compared component-wise.
+    """
+
+    def __init__(self):
+        self.values = []
+        self.buckets = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, idx):
+        return self.values[idx]
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __repr__(self):
+        return repr(self.values)
+
+    @staticmethod
+    def flatten(value):
+        """
+        Get the numerical components of a LUT value as a tuple.
+        """
+        if isinstance(value, tuple):
+            return tuple(itertools.chain.from_iterable(value))
+        return (value,)
+
+    @staticmethod
+    def unflatten(components):
+        """
+        Get the LUT value with the given numerical components.
+        """
+        if len(components) == 1:
+            return components[0]
+        return tuple(zip(components[::2], components[1::2]))
+
+    @staticmethod
+    def get_bucket(x):
+        """
+        Get the bucket that the given number belongs to.
+        """
+        # Buckets are centred on round values, which are common, so that they are not near a bucket's edge.
+        # Rounding is symmetric around zero, so that negative values are bucketed the same way as positive ones.
+        mantissa, exponent = math.frexp(x)
+        return exponent, round(mantissa * LUT_BUCKETS_PER_OCTAVE)
+
+    def get_candidate_buckets(self, components):
+        """
+        Get every bucket that may hold a value within the tolerance of the given components.
+        """
+        component_buckets = []
+        for x in components:
+            margin = 2 * LUT_REL_TOL * abs(x)
+            component_buckets.append({self.get_bucket(x - margin), self.get_bucket(x), self.get_bucket(x + margin)})
+        return itertools.product(*component_buckets)
+
+    def find(self, value):
+        """
+        Get the lowest LUT index of a value that is close to the given one, or None if there is no such value.
+        """
+        components = self.flatten(value)
+        found = None
+        for bucket in self.get_candidate_buckets(components):
+            for idx in self.buckets.get(bucket, ()):
+                if found is not None and idx >= found:
+                    break
+                if all(math.isclose(a, b, rel_tol=LUT_REL_TOL)
+                       for a, b in zip(components, self.flatten(self.values[idx]))):
+                    found = idx
+                    break
+        return found
 
-def get_LUT_values(vips):
+    def find_all(self, components):
+        """
+        Get the LUT indices of the given values, as they would be given by find(), with -1 for values without one.
+        The values are given as a 2D array, with a row of numerical components for each value.
+        Each distinct value is only looked up once.
+        """
+        first_indices, positions = get_distinct_rows(components)
+        distinct = components[first_indices]
+        indices = []
+        for row, bucket, is_interior in zip(distinct.tolist(), *self.get_row_buckets(distinct)):
+            idx = self.find_in_bucket(row, bucket) if is_interior else self.find(self.unflatten(row))
+            indices.append(-1 if idx is None else idx)
+        return np.array(indices, dtype=np.int64)[positions]
+
+    def add(self, value):
+        """
+        Add the given value to the end of the LUT, unless a close value is already in it.
+        Return the LUT index of the value.
+        """
+        idx = self.find(value)
+        if idx is None:
+            idx = len(self.values)
+            self.values.append(value)
+            bucket = tuple(self.get_bucket(x) for x in self.flatten(value))
+            self.buckets.setdefault(bucket, []).append(idx)
+        return idx
+
+    def add_all(self, components):
+        """
+        Add values to the end of the LUT in order, skipping the ones that are close to a value already in it.
+        The values are given as a 2D array, with a row of numerical components for each value.
+        Return an array of the LUT indices of the values.
+        """
+        indices = []
+        for row, bucket, is_interior in zip(components.tolist(), *self.get_row_buckets(components)):
+            if not is_interior:
+                indices.append(self.add(self.unflatten(row)))
+                continue
+            idx = self.find_in_bucket(row, bucket)
+            if idx is None:
+                idx = len(self.values)
+                self.buckets.setdefault(bucket, []).append(idx)
+                self.values.append(self.unflatten(row))
+            indices.append(idx)
+        return np.array(indices, dtype=np.int64)
+
+    @staticmethod
+    def get_row_buckets(components):
+        """
+        Get the buckets of the given values, all at once. The values are given as a 2D array,
+        with a row of numerical components for each value. Also get whether each value is far enough from
+        the edges of its bucket that any value close to it is in the same bucket, in which case
+        it only needs to be compared against that bucket.
+        """
+        mantissas, exponents = np.frexp(components)
+        cells = np.rint(mantissas * LUT_BUCKETS_PER_OCTAVE).astype(np.int64)
+        margins = 2 * LUT_REL_TOL * np.abs(components)
+        interior = np.ones(len(components), dtype=bool)
+        for edge in (components - margins, components + margins):
+            edge_mantissas, edge_exponents = np.frexp(edge)
+            edge_cells = np.rint(edge_mantissas * LUT_BUCKETS_PER_OCTAVE).astype(np.int64)
+            interior &= ((edge_exponents == exponents) & (edge_cells == cells)).all(axis=1)
+
+        buckets = [tuple(zip(row_exponents, row_cells))
+                   for row_exponents, row_cells in zip(exponents.tolist(), cells.tolist())]
+        return buckets, interior.tolist()
+
+    def find_in_bucket(self, components, bucket):
+        """
+        Get the lowest LUT index of a value in the given bucket that is close to the given components,
+        or None if there is no such value.
+        """
+        for idx in self.buckets.get(bucket, ()):
+            if all(math.isclose(a, b, rel_tol=LUT_REL_TOL) for a, b in zip(components, self.flatten(self.values[idx]))):
+                return idx
+        return None
+
+
+def get_port_timelines(vips, pulse_definitions):
+    """
+    Divide the given pulse definitions by the output port they're on, keeping their order.
+    Return a list of pulse definition lists, indexed by port number.
+    """
+    port_timelines = [[] for _ in range(vips.N_OUT_PORTS)]
+    for pulse in pulse_definitions:
+        p_port_idx = pulse['Port'] - 1
+        port_timelines[p_port_idx].append(pulse)
+    return port_timelines
+
+
+def get_port_amp_values(vips, timeline):
+    """
+    Construct the list of amplitude scale values for a single port's chronological list of pulses,
+    in the order they are needed. This is the same list as get_port_LUT_values() gives,
+    but without having to redo the frequency/phase values.
     """
-    Constructs matrices of amplitude and frequency/phase values from the pulse definitions.
-    The matrices are indexed by port number, and will be the basis for the LUTs on the board.
+    # The amplitudes of every pulse in every iteration, in the order they are needed
+    amps = np.array([pulse['Amp'] for pulse in timeline], dtype=float).T.reshape(-1, 1)
+    amp_values, _ = get_LUT_index(amps)
+    return amp_values
+
+
+def get_LUT_index(values):
+    """
+    Construct a LUT index of the given values, with each value present once, in the order they first appear.
+    The values are given as a 2D array, with a row of numerical components for each value.
+    Return the LUT index, along with an array of the LUT indices of the given values.
+    """
+    # Exactly equal values are removed in bulk first, so that only distinct values need to be indexed
+    first_indices, positions = get_distinct_rows(values)
+    appearance_order = np.argsort(first_indices)
+    lut = LUTIndex()
+    distinct_indices = np.empty(len(first_indices), dtype=np.int64)
+    distinct_indices[appearance_order] = lut.add_all(values[first_indices[appearance_order]])
+    return lut, distinct_indices[positions]
+
+
+def get_distinct_rows(values):
+    """
+    Find the rows of the given 2D array that are not exactly equal to any earlier row.
+    Return the indices of these rows, and an array giving each row's position in the list of these indices.
+    """
+    # The sort is stable, so the first of each group of equal rows is the one that appears first
+    order = np.lexsort(values.T[::-1])
+    sorted_values = values[order]
+    is_first = np.ones(len(values), dtype=bool)
+    is_first[1:] = (sorted_values[1:] != sorted_values[:-1]).any(axis=1)
+
+    positions = np.empty(len(values), dtype=np.int64)
+    positions[order] = np.cumsum(is_first) - 1
+    return order[is_first], positions
+
+
+def get_port_LUT_values(vips, timeline):
+    """
+    Constructs lists of amplitude and frequency/phase values from a single port's chronological list of pulses.
+    These will be the basis for the port's LUTs on the board.
     If all pulses have fixed amp/freq/phase values, each value is only present once in the list.
     If a sweep pulse is defined, the list will be a complete chronological sequence of values,
     so that the board will only ever need to step once in the LUT between pulses.
-    Return two matrices: one for the amplitude scale values and one for tuples of frequency and phase values.
+    The phase of every pulse that causes a carrier change is phase synced in place, directly in the
+    given pulse definitions, so the timeline should hold the same objects as vips.pulse_definitions.
+    Every iteration is handled at once: each pulse is processed for all iterations in a single step,
+    with arrays holding the state of the carriers in every iteration.
+    Return the LUT indices of the amplitude scale values and of the tuples of frequency and phase values,
+    along with a list of the carrier changes. Each carrier change is a tuple of its time in sample ticks,
+    the frequency/phase tuples of both carriers, and the index of these values in the frequency/phase LUT.
     """
     # Get phase sync behaviour
-    sync_mode = vips.getValue('Phase sync behaviour')
+    sync_mode = vips.config['Phase sync behaviour']
 
-    # Copy the original pulse def list
-    pulse_defs_copy = [pulse for pulse in vips.pulse_definitions]
+    iterations = np.arange(vips.iterations)
+    n_steps = len(timeline) + 1
 
-    # Divide the pulses by the port they're on
-    port_timelines = [[] for _ in range(vips.N_OUT_PORTS)]
-    for pulse in pulse_defs_copy:
-        p_port_idx = pulse['Port'] - 1
-        port_timelines[p_port_idx].append(pulse)
+    # The frequency and phase currently saved for each carrier, in every iteration. A carrier without
+    # saved values holds zeroes, which are the dummy values used for carrier changes that do not use it.
+    saved = np.zeros((2, vips.iterations), dtype=bool)
+    saved_freq = np.zeros((2, vips.iterations))
+    saved_phase = np.zeros((2, vips.iterations))
 
-    amp_values = [[] for _ in range(vips.N_OUT_PORTS)]
-    freq_phase_values = [[] for _ in range(vips.N_OUT_PORTS)]
-    port_carrier_changes = [[] for _ in range(vips.N_OUT_PORTS)]
+    # The first carrier change will happen at the first pulse. Times are kept in sample ticks,
+    # so that the time elapsed between two of them is exact.
+    latest_change = utils.get_absolute_ticks(vips, timeline[0]['Ticks'], iterations)
+    # The frequencies and start times of the pulses that other pulses of the same frequency are synced to
+    reference_times = []
 
-    for port_idx, timeline in enumerate(port_timelines):
-        # Don't do anything for ports without definitions
-        if len(timeline) < 1:
+    # The carrier changes, as a list of arrays per column, along with the order they happen in
+    changes = []
+
+    def add_carrier_changes(mask, step):
+        changes.append((iterations[mask] * n_steps + step, latest_change[mask],
+                        saved_freq[0][mask], saved_phase[0][mask], saved_freq[1][mask], saved_phase[1][mask]))
+
+    for step, pulse in enumerate(timeline):
+        # If the pulse isn't using a carrier wave, it won't use LUT values
+        carrier = pulse['Carrier']
+        if carrier == 0:
             continue
 
-        carrier_changes = []
-
-        latest_fp1 = None
-        latest_fp2 = None
-        latest_change = None
-
-        # Step through each iteration to put together the LUTs in the order the values will be needed.
-        for i in range(vips.iterations):
-
-            # Add any left over values from previous iteration
-            if i > 0:
-                if latest_fp2 is None:
-                    latest_fp2 = (0, 0)
-                if latest_fp1 is None:
-                    latest_fp1 = (0, 0)
-                carrier_changes.append((latest_change,
-                                        (latest_fp1[0], latest_fp1[1]),
-                                        (latest_fp2[0], latest_fp2[1])))
-
-            # Reset for the new iteration
-            latest_fp1 = None
-            latest_fp2 = None
-            # The first carrier change will happen at the first pulse
-            first_pulse_start = timeline[0]['Time']
-            latest_change = utils.get_absolute_time(vips, first_pulse_start[0], first_pulse_start[1], i)
-            reference_times = {}
-
-            for pulse in timeline:
-                # Get some necessary parameters from the pulse's definition.
-                p_amp, p_freq, p_phase = utils.get_amp_freq_phase(pulse, i)
-                time = pulse['Time']
-                abs_time = utils.get_absolute_time(vips, time[0], time[1], i)
-
-                # Save the amplitude value if it is new
-                if p_amp not in amp_values[port_idx]:
-                    amp_values[port_idx].append(p_amp)
-
-                # If the pulse isn't using a carrier wave, it won't use LUT values
-                carrier = pulse['Carrier']
-                if carrier == 0:
-                    continue
-
-                if sync_mode == 'Sync to first pulse of same freq.':
-                    if p_freq in reference_times:
-                        ref_start = reference_times[p_freq]
-                    else:
-                        reference_times[p_freq] = abs_time
-                        ref_start = abs_time
-                else:
-                    # Sync all pulses' phase to the start of the iteration
-                    ref_start = 0
-
-                if carrier == 1:
-                    # If we have a free slot for carrier 1, save it and move on
-                    if latest_fp1 is None:
-                        # Calculate the phase difference between this pulse and the start of the carrier change
-                        carr_change_ps = ((abs_time - latest_change) * p_freq * 2)
-                        # Phase sync to the reference point, then subtract the "phase time" since carrier change
-                        ph = utils.phase_sync(p_freq, p_phase, abs_time - ref_start) - carr_change_ps
-                        for pul in vips.pulse_definitions:
-                            if pul['ID'] == pulse['ID']:
-                                pul['Phase'][i] = ph
-                                break
-                        latest_fp1 = (p_freq, ph)
-                        continue
-                    # If this pulse uses the same values as the last saved ones, we don't need a swap
-                    elif latest_fp1 == (p_freq, p_phase):
-                        continue
-                    # New freq/phase pair, we need a reset
-                    else:
-                        # If we never found any pulses for carrier 2 before we needed a swap, use dummy values
-                        if latest_fp2 is None:
-                            latest_fp2 = (0, 0)
-                        carrier_changes.append((latest_change,
-                                                (latest_fp1[0], latest_fp1[1]),
-                                                (latest_fp2[0], latest_fp2[1])))
-                        # Save the time that we will need access to these new freq/phase values.
-                        latest_change = utils.get_absolute_time(vips, time[0], time[1], i)
-
-                        # Update global pulse definition with new phase synced value
-                        ph = utils.phase_sync(p_freq, p_phase, abs_time - ref_start)
-                        for pul in vips.pulse_definitions:
-                            if pul['ID'] == pulse['ID']:
-                                pul['Phase'][i] = ph
-                                break
-                        latest_fp1 = (p_freq, ph)
-
-                        # Carrier 2 now has a free slot
-                        latest_fp2 = None
-                elif carrier == 2:  # Same for carrier 2
-                    if latest_fp2 is None:
-                        # Calculate the phase difference between this pulse and the start of the carrier change
-                        carr_change_ps = ((abs_time - latest_change) * p_freq * 2)
-                        # Phase sync to the reference point, then subtract the "phase time" since carrier change
-                        ph = utils.phase_sync(p_freq, p_phase, abs_time - ref_start) - carr_change_ps
-                        for pul in vips.pulse_definitions:
-                            if pul['ID'] == pulse['ID']:
-                                pul['Phase'][i] = ph
-                                break
-                        latest_fp2 = (p_freq, ph)
-                        continue
-                    elif latest_fp2 == (p_freq, p_phase):
-                        continue
-                    else:
-                        if latest_fp1 is None:
-                            latest_fp1 = (0, 0)
-                        carrier_changes.append((latest_change,
-                                                (latest_fp1[0], latest_fp1[1]),
-                                                (latest_fp2[0], latest_fp2[1])))
-                        latest_change = utils.get_absolute_time(vips, time[0], time[1], i)
-
-                        ph = utils.phase_sync(p_freq, p_phase, abs_time - ref_start)
-                        for pul in vips.pulse_definitions:
-                            if pul['ID'] == pulse['ID']:
-                                pul['Phase'][i] = ph
-                                break
-                        latest_fp2 = (p_freq, ph)
-
-                        latest_fp1 = None
-
-        # Lock in the final freq/phase values if there are any left
-        if latest_fp1 is not None or latest_fp2 is not None:
-            if latest_fp2 is None:
-                latest_fp2 = (0, 0)
-            if latest_fp1 is None:
-                latest_fp1 = (0, 0)
-            carrier_changes.append((latest_change,
-                                    (latest_fp1[0], latest_fp1[1]),
-                                    (latest_fp2[0], latest_fp2[1])))
-        port_carrier_changes[port_idx] = carrier_changes
-        # Extract unique fp pairs from the change list into a LUT
-        for (_, fp1, fp2) in carrier_changes:
-            # If this value has not already been recorded in the LUT, add it.
-            if not any([utils.are_fp_pairs_close((fp1, fp2), fpfp) for fpfp in freq_phase_values[port_idx]]):
-                freq_phase_values[port_idx].append((fp1, fp2))
-
-    return amp_values, freq_phase_values, port_carrier_changes
+        # Get some necessary parameters from the pulse's definition.
+        p_freq = np.array(pulse['Freq'], dtype=float)
+        p_phase = np.array(pulse['Phase'], dtype=float)
+        abs_time = utils.get_absolute_ticks(vips, pulse['Ticks'], iterations)
+
+        if sync_mode == 'Sync to first pulse of same freq.':
+            ref_start = abs_time.copy()
+            has_ref = np.zeros(vips.iterations, dtype=bool)
+            for ref_freq, ref_time in reference_times:
+                matches = ~has_ref & (ref_freq == p_freq)
+                ref_start[matches] = ref_time[matches]
+                has_ref |= matches
+            # This pulse is the reference for its frequency in the iterations where it is the first one to use it
+            if not has_ref.all():
+                reference_times.append((p_freq, abs_time))
+        else:
+            # Sync all pulses' phase to the start of the iteration
+            ref_start = 0
+
+        c = carrier - 1
+        other = 1 - c
+        # Where the carrier has a free slot, save the pulse's values in it and move on
+        free = ~saved[c]
+        # Where the pulse uses the same values as the last saved ones, we don't need a swap
+        same = saved[c] & (saved_freq[c] == p_freq) & (saved_phase[c] == p_phase)
+        # Everywhere else, there is a new freq/phase pair, so we need a reset
+        swap = saved[c] & ~same
+
+        # Phase sync to the reference point
+        synced_phase = utils.phase_sync(p_freq, p_phase, utils.ticks_to_time(vips, abs_time - ref_start))
+
+        # Calculate the phase difference between the free slot pulses and the start of the carrier change,
+        # and subtract this "phase time" since the carrier change
+        carr_change_ps = (utils.ticks_to_time(vips, abs_time - latest_change) * p_freq * 2)
+        p_phase[free] = (synced_phase - carr_change_ps)[free]
+
+        # Save the current values as a carrier change before swapping in the new ones.
+        # If we never found any pulses for the other carrier before we needed a swap, it holds dummy values.
+        add_carrier_changes(swap, step)
+        latest_change[swap] = abs_time[swap]
+        p_phase[swap] = synced_phase[swap]
+        # The other carrier now has a free slot
+        saved[other][swap] = False
+        saved_freq[other][swap] = 0
+        saved_phase[other][swap] = 0
+
+        # Update the pulse definition with the new phase synced values, and save them for the carrier
+        changed = free | swap
+        pulse['Phase'] = np.where(changed, p_phase, pulse['Phase'])
+        saved[c][changed] = True
+        saved_freq[c][changed] = p_freq[changed]
+        saved_phase[c][changed] = p_phase[changed]
+
+    # Add any left over values at the end of each iteration. The final iteration's values are only added
+    # if there are any, while every other iteration's values are always added before the next one begins.
+    left_over = iterations < vips.iterations - 1
+    left_over[-1] = saved[:, -1].any()
+    add_carrier_changes(left_over, n_steps - 1)
+
+    # Put the carrier changes in chronological order
+    order, *columns = (np.concatenate(column) for column in zip(*changes))
+    columns = np.stack(columns, axis=1)[np.argsort(order)]
+
+    # Extract unique fp pairs from the change list into a LUT
+    freq_phase_values, lut_indices = get_LUT_index(columns[:, 1:])
+    carrier_changes = [(int(t), (f1, p1), (f2, p2), idx)
+                       for (t, f1, p1, f2, p2), idx in zip(columns.tolist(), lut_indices.tolist())]
+
+    return get_port_amp_values(vips, timeline), freq_phase_values, carrier_changes
 
 
 def apply_LUTs(vips, q):
     """
     Set up amplitude and frequency/phase LUTs on the board.
+    LUTs that already hold the same values on the board are not set up again.
     """
     for p in range(vips.N_OUT_PORTS):
         port = p + 1
@@ -203,9 +372,12 @@ def apply_LUTs(vips, q):
                 phase = (abs(phase) % 2) * phase_sign
                 assert -2 <= phase <= 2, 'Phase somehow ended up outside the range [-2,2]!'
                 phase_values.append(phase * np.pi)
-            # Feed our values into the tables
+            # Feed our values into the tables, unless the board already has them
+            if vips.session.is_loaded(('freq lut', port, carrier), (freq_values, phase_values)):
+                continue
             if len(freq_values) > 0 and len(phase_values) > 0:
-                vips.lgr.add_line(f'q.setup_freq_lut(port={port}, carrier={carrier + 1}, freq={freq_values}, phase={phase_values})')
+                vips.lgr.add_line('q.setup_freq_lut(port={}, carrier={}, freq={}, phase={})',
+                                  port, carrier + 1, freq_values, phase_values)
                 try:
                     q.setup_freq_lut(port, carrier+1, freq_values, phase_values)
                 except ValueError as err:
@@ -218,10 +390,12 @@ def apply_LUTs(vips, q):
                         raise ValueError(f'There are more than the max number ({max_num}) of '
                                          f'frequency/phase values on port {port}!')
                     raise err
-        if len(vips.amp_matrix[p]) > 0:
-            vips.lgr.add_line(f'q.setup_scale_lut(port={port}, amp={vips.amp_matrix[p]})')
+                vips.session.set_loaded(('freq lut', port, carrier), (freq_values, phase_values))
+        amp_values = vips.amp_matrix[p].values
+        if len(amp_values) > 0 and not vips.session.is_loaded(('scale lut', port), amp_values):
+            vips.lgr.add_line('q.setup_scale_lut(port={}, amp={})', port, amp_values)
             try:
-                q.setup_scale_lut(port, vips.amp_matrix[p])
+                q.setup_scale_lut(port, amp_values)
             except ValueError as err:
                 err_str = err.args[0]
                 if err_str.startswith('scale can contain at most'):
@@ -232,3 +406,4 @@ def apply_LUTs(vips, q):
                     raise ValueError(f'The amplitude scale on port {port} '
                                      f'is outside the range [0, 1] at some point!')
                 raise err
+            vips.session.set_loaded(('scale lut', port), list(amp_values))
@@ -4,126 +4,546 @@
 A collection of functions for ViPS's preview functionality.
 """
 
+import functools
+from collections import namedtuple
+from fractions import Fraction
+
 import numpy as np
 
 from vivace import pulsed
 import utils
-import templates
+import pulses
+
+# The level that sample windows are drawn at in the sequence preview
+SAMPLE_WINDOW_LEVEL = -0.1
+# The largest number of points of a flat part of a pulse that is expanded at once
+PLATEAU_CHUNK_SIZE = 2 ** 16
+# How many sample axes of different lengths are kept for evaluating carriers
+SAMPLE_AXIS_CACHE_SIZE = 64
+# How far off the extrema of a plateau may be when they are found without expanding its points
+PLATEAU_TOLERANCE = 1e-6
+
+# A flat part of an envelope in a preview, which is n_points long. Its points are the sum of
+# amp * cos(2 * pi * freq * k + pi * phase) over its carriers' (amp, freq, phase) values,
+# where k counts the plateau's samples from 0 and freq is in cycles per sample.
+Plateau = namedtuple('Plateau', ['n_points', 'carriers'])
 
 
 def get_template_preview(vips, quant):
     """
     Construct a wave based on the envelope template
     indicated by the given quant, and return it.
+    The template is taken from the driver's preview sequence, which is only compiled if the configuration has changed.
     """
-    template_defs = templates.get_template_defs(vips)
+    compiled = vips.get_preview_sequence()
     # The template number X is the first character in the second word in "Template X: Preview"
     template_no = int(quant.name.split()[1][0])
-    template_def = template_defs[template_no - 1]
-    x, y = utils.template_def_to_points(vips, template_def, 0)
+    template_def = compiled.template_defs[template_no - 1]
+    segments = utils.template_def_to_segments(compiled, template_def, 0)
 
     # Long drives can have length 0, which is returned as None
-    if len(x) > 0:
-        return quant.getTraceDict(y, x=x, t0=x[0], dt=(x[1] - x[0]))
-    else:
+    n_points = sum(utils.get_segment_length(segment) for segment in segments)
+    if n_points == 0:
         return None
 
+    resolution = int(vips.getValue('Preview resolution'))
+    if resolution <= 0 or n_points <= 2 * resolution:
+        x, y = utils.template_def_to_points(compiled, template_def, 0)
+        return quant.getTraceDict(y, x=x, t0=x[0], dt=(x[1] - x[0]))
+
+    pieces = get_preview_pieces(segments, 0, 1, 0, 0)
+    y, steps = render_preview_envelope(pieces, [], 0, n_points, resolution)
+    x = steps / compiled.sampling_freq
+    return quant.getTraceDict(y, x=x, t0=x[0], dt=(n_points / resolution / 2 / compiled.sampling_freq))
+
 
 def get_sequence_preview(vips, quant):
     """
     Construct a waveform from the pulse sequence information in the instrument
     and return a TraceDict with its information.
+    If the previewed part of the sequence has more samples than the preview resolution allows,
+    it is drawn as the minimum and maximum of the waveform within each time step instead.
+    The sequence is taken from the driver's preview sequence, which is only compiled if the configuration has changed.
     """
-    period = vips.getValue('Trigger period')
+    compiled = vips.get_preview_sequence()
     preview_port = int(vips.getValue('Preview port'))
     preview_iter = int(vips.getValue('Preview iteration') - 1)
     preview_samples = vips.getValue('Preview sample windows')
-    use_slice = vips.getValue('Enable preview slicing')
+    resolution = int(vips.getValue('Preview resolution'))
+    # Display nothing if the requested index is too high
+    if preview_iter >= compiled.iterations:
+        return None
+
+    preview_range = get_preview_range(vips, compiled)
+    if preview_range is None:
+        return None
+    start, end, slice_start, slice_end = preview_range
+
+    pieces, windows = get_preview_segments(compiled, preview_port, [preview_iter], preview_samples)[0]
+
+    n_points = end - start + 1
+    sampling_freq = int(compiled.sampling_freq)
+    if resolution <= 0 or n_points <= 2 * resolution:
+        preview_points = render_preview_points(pieces, windows, start, n_points)
+        times = np.linspace(slice_start, slice_end, n_points)
+        return quant.getTraceDict(preview_points, x=times, t0=times[0], dt=(times[1] - times[0]))
+
+    preview_points, steps = render_preview_envelope(pieces, windows, start, n_points, resolution)
+    times = (start + steps) / sampling_freq
+    return quant.getTraceDict(preview_points, x=times, t0=times[0], dt=(n_points / resolution / 2 / sampling_freq))
+
+
+def get_sweep_preview(vips, quant):
+    """
+    Construct the waveform of the preview port in every iteration of the sequence,
+    and return a TraceDict with the iterations' waveforms one after the other.
+    Each iteration is drawn like in get_sequence_preview(), but with the sweep preview resolution,
+    so every iteration has the same number of points. The pulses are constructed for all iterations at once.
+    """
+    compiled = vips.get_preview_sequence()
+    preview_port = int(vips.getValue('Preview port'))
+    preview_samples = vips.getValue('Preview sample windows')
+    resolution = int(vips.getValue('Sweep preview resolution'))
+
+    preview_range = get_preview_range(vips, compiled)
+    if preview_range is None:
+        return None
+    start, end, slice_start, slice_end = preview_range
+
+    segments = get_preview_segments(compiled, preview_port, np.arange(compiled.iterations), preview_samples)
+    preview_points, dt = render_preview_rows(segments, preview_range, resolution, compiled.sampling_freq)
+    return quant.getTraceDict(preview_points, t0=preview_range[2], dt=dt)
+
+
+def get_multi_port_preview(vips, quant):
+    """
+    Construct the waveforms of every output port in the preview iteration, and return a TraceDict with them
+    one after the other, followed by markers of the sample windows and of the template matchings.
+    Every port is drawn like in get_sequence_preview(), from the same compiled sequence, but without sample windows.
+    The markers give the number of sample windows and template matchings that are in progress at each time.
+    """
+    compiled = vips.get_preview_sequence()
+    preview_iter = int(vips.getValue('Preview iteration') - 1)
+    resolution = int(vips.getValue('Preview resolution'))
+    # Display nothing if the requested index is too high
+    if preview_iter >= compiled.iterations:
+        return None
+
+    preview_range = get_preview_range(vips, compiled)
+    if preview_range is None:
+        return None
+
+    rows = [get_preview_segments(compiled, port, [preview_iter], False)[0]
+            for port in range(1, compiled.N_OUT_PORTS + 1)]
+
+    # Mark the sample windows and template matchings, which happen at the same time in every port
+    window_duration = utils.get_ticks(compiled, compiled.sampling_duration)
+    windows = [(start_base + start_delta * preview_iter, window_duration)
+               for start_base, start_delta in (window['Ticks'] for window in compiled.sample_windows)]
+    matchings = [(utils.get_ticks(compiled, matching['Start']), len(matching['I templates'][0]))
+                 for matching in compiled.template_matching_defs]
+    rows.append((get_marker_pieces(windows), []))
+    rows.append((get_marker_pieces(matchings), []))
+
+    preview_points, dt = render_preview_rows(rows, preview_range, resolution, compiled.sampling_freq)
+    return quant.getTraceDict(preview_points, t0=preview_range[2], dt=dt)
+
+
+def get_marker_pieces(markers):
+    """
+    Get the pieces of a preview that marks the given (start, duration) tuples in sample ticks,
+    as Plateaus at 1 that add up where the markers overlap.
+    """
+    return merge_preview_pulses([(marker_start, [(marker_start, Plateau(duration, ((1.0, 0.0, 0.0),)))])
+                                 for marker_start, duration in markers if duration > 0])
+
+
+def render_preview_rows(rows, preview_range, resolution, sampling_freq):
+    """
+    Draw several previews over the same range from get_preview_range(), each from a tuple of its pieces and
+    sample windows. Each preview is drawn with every sample if it fits within twice the given resolution,
+    and as the minimum and maximum within each time step otherwise.
+    Return the previews one after the other in a single array, along with the time between their points.
+    """
+    start, end, slice_start, slice_end = preview_range
+    n_points = end - start + 1
+    if resolution <= 0 or n_points <= 2 * resolution:
+        rows = [render_preview_points(pieces, windows, start, n_points) for pieces, windows in rows]
+        return np.concatenate(rows), (slice_end - slice_start) / (n_points - 1)
+
+    rows = [render_preview_envelope(pieces, windows, start, n_points, resolution)[0] for pieces, windows in rows]
+    return np.concatenate(rows), n_points / resolution / 2 / sampling_freq
+
+
+def get_preview_range(vips, compiled):
+    """
+    Get the part of the trigger period that the sequence previews cover, which is the whole period unless sliced.
+    Return its first and last sample tick, along with its start and end in seconds, or None if the slice is empty.
+    """
+    period = compiled.trigger_period
+    sampling_freq = int(compiled.sampling_freq)
+    if not vips.getValue('Enable preview slicing'):
+        return 0, int(sampling_freq * period), 0, period
+
     slice_start = vips.getValue('Preview slice start')
     slice_end = min(vips.getValue('Preview slice end'), period)
-    # Display nothing if the requested index is too high
-    if preview_iter >= vips.iterations:
+    start = int(slice_start * sampling_freq)
+    end = int(slice_end * sampling_freq)
+    if end - start <= 0:
         return None
+    return start, end, slice_start, slice_end
 
-    # The preview will take the form of a list of points, with length determined by trigger period
-    sampling_freq = int(vips.sampling_freq)
-    preview_points = np.zeros(int(sampling_freq * period) + 1)
+
+def get_preview_segments(vips, port, iterations, show_windows):
+    """
+    Get the parts of the given port's sequence that are not zero in each of the given iterations.
+    For each iteration, return a list of the pieces of the port's pulses, as tuples of their start in sample ticks
+    and either their points or a Plateau, and a list of the sample windows to display, as tuples of their start
+    and end in sample ticks. Pulses that overlap are added together, so that no two pieces overlap.
+    """
+    # The times of the port's carrier resets, for finding the latest reset before each pulse
+    reset_ticks = np.array([change[0] for change in vips.carrier_changes[port - 1]], dtype=np.int64)
+
+    waves = [[] for _ in iterations]
     for pulse in vips.pulse_definitions:
-        pulse_port = pulse['Port']
-        if pulse_port != preview_port:
+        if pulse['Port'] != port:
             continue
 
-        # Make a digitised version of the pulse
-        time, wave = construct_preview_pulse(vips, pulse, preview_iter)
-
-        # Place it in the preview timeline
-        pulse_index = int(time * sampling_freq)
-        points_that_fit = len(preview_points[pulse_index:(pulse_index+len(wave))])
-        preview_points[pulse_index:(pulse_index + points_that_fit)] += wave[:points_that_fit]
-
-    # Display the sample windows
-    if preview_samples and preview_port in vips.sampling_ports:
-        for window in vips.sample_windows:
-            start_base, start_delta = window['Time']
-            start = start_base + start_delta * preview_iter
-            duration = vips.sampling_duration
-            wave = np.linspace(-0.1, -0.1, duration * sampling_freq)
-            window_index = int(start * sampling_freq)
-            points_that_fit = len(preview_points[window_index:(window_index+len(wave))])
-            preview_points[window_index:(window_index + len(wave))] = wave[:points_that_fit]
-
-    vips.reset_instrument()
-    if use_slice:
-        start_idx = int(slice_start * sampling_freq)
-        end_idx = int(slice_end * sampling_freq)
-        if end_idx - start_idx <= 0:
+        # Make digitised versions of the pulse in every iteration
+        for iteration_waves, (pulse_start, pieces) in zip(waves, construct_preview_pulse(vips, pulse, iterations,
+                                                                                          reset_ticks)):
+            if len(pieces) > 0:
+                iteration_waves.append((pulse_start, pieces))
+
+    segments = []
+    show_windows = show_windows and port in vips.sampling_ports
+    for iteration, iteration_waves in zip(iterations, waves):
+        windows = []
+        if show_windows:
+            duration = utils.get_ticks(vips, vips.sampling_duration)
+            for window in vips.sample_windows:
+                start_base, start_delta = window['Ticks']
+                window_start = start_base + start_delta * int(iteration)
+                windows.append((window_start, window_start + duration))
+        segments.append((merge_preview_pulses(iteration_waves), windows))
+    return segments
+
+
+def merge_preview_pulses(waves):
+    """
+    Put the pieces of the given pulses, as tuples of their start and pieces, into a single list in chronological order.
+    Pulses that overlap, such as pulses on both carriers or repeated pulses with zero-padding, are added together.
+    """
+    merged = []
+    merged_end = 0
+    for pulse_start, pieces in sorted(waves, key=lambda wave: wave[0]):
+        if len(merged) > 0 and pulse_start < merged_end:
+            merged[-1] = add_pieces(merged[-1], pieces)
+        else:
+            merged.append(pieces)
+        last_start, last_piece = pieces[-1]
+        merged_end = max(merged_end, last_start + get_piece_length(last_piece))
+    return [piece for pieces in merged for piece in pieces]
+
+
+def get_preview_pieces(segments, start, amp, freq, phase):
+    """
+    Turn the envelope segments of a pulse that starts at the given sample tick into the pieces of a preview,
+    with the given amplitude and carrier. The frequency is given in cycles per sample, and is 0 for no carrier.
+    Return a list of tuples of each piece's start in sample ticks and either its points or a Plateau.
+    """
+    pieces = []
+    offset = 0
+    for segment in segments:
+        if isinstance(segment, int):
+            piece = Plateau(segment, ((amp, freq, phase + 2 * freq * offset),))
+        else:
+            piece = segment * amp
+            if freq != 0:
+                k = get_sample_axis(offset + len(segment))[offset:]
+                piece = piece * np.cos(2 * np.pi * freq * k + np.pi * phase)
+        pieces.append((start + offset, piece))
+        offset += utils.get_segment_length(segment)
+    return pieces
+
+
+@functools.lru_cache(maxsize=SAMPLE_AXIS_CACHE_SIZE)
+def get_sample_axis(n_points):
+    """
+    Get the sample indices from 0 up to the given number of points, which the carriers of previews are evaluated at.
+    The axes are cached, since pulses with the same envelope length share them. The returned array is read-only.
+    """
+    axis = np.arange(n_points)
+    axis.setflags(write=False)
+    return axis
+
+
+def get_piece_length(piece):
+    """
+    Get the number of points in a preview piece, which is either an array of points or a Plateau.
+    """
+    return piece.n_points if isinstance(piece, Plateau) else len(piece)
+
+
+def cut_piece(piece, lo, hi):
+    """
+    Get the part of a preview piece from its point lo up to, but not including, its point hi.
+    """
+    if isinstance(piece, Plateau):
+        return Plateau(hi - lo, tuple((amp, freq, phase + 2 * freq * lo) for amp, freq, phase in piece.carriers))
+    return piece[lo:hi]
+
+
+def get_plateau_points(plateau, lo, hi):
+    """
+    Expand the points of a Plateau from its point lo up to, but not including, its point hi.
+    """
+    k = np.arange(lo, hi)
+    points = np.zeros(hi - lo)
+    for amp, freq, phase in plateau.carriers:
+        points += amp * np.cos(2 * np.pi * freq * k + np.pi * phase)
+    return points
+
+
+def get_plateau_extrema(plateau, step_offsets, min_size, max_size):
+    """
+    Get the minimum and maximum of the points of a Plateau within each of a number of steps, without expanding them.
+    The steps start at the given point indices of the Plateau, and are between min_size and max_size points long.
+    Return arrays of the minima and maxima, or None if they cannot be found within PLATEAU_TOLERANCE.
+    """
+    carriers = [(amp, freq, phase) for amp, freq, phase in plateau.carriers if amp != 0]
+    ratios = [Fraction(freq).limit_denominator(int(min_size)) for _, freq, _ in carriers]
+
+    if len(carriers) == 1:
+        # Over period points, a carrier with a frequency of ratio visits every phase that is a multiple
+        # of 1 / period cycles away from its phase at the start of the step. Within a step, the carrier
+        # only drifts away from those phases by the difference between its frequency and ratio.
+        (amp, freq, phase), ratio = carriers[0], ratios[0]
+        spacing = 1 / ratio.denominator
+        drift = abs(freq - ratio) * max_size
+        if 4 * np.pi ** 2 * drift * (spacing / 2 + drift) * abs(amp) >= PLATEAU_TOLERANCE:
             return None
+        cycles = freq * step_offsets + phase / 2
+        highest = np.cos(2 * np.pi * (np.mod(cycles + spacing / 2, spacing) - spacing / 2))
+        lowest = -np.cos(2 * np.pi * (np.mod(cycles + spacing / 2 - 0.5, spacing) - spacing / 2))
+        return (amp * lowest, amp * highest) if amp > 0 else (amp * highest, amp * lowest)
 
-        preview_points = preview_points[start_idx:end_idx+1]
-        times = np.linspace(slice_start, slice_end, len(preview_points))
-    else:
-        times = np.linspace(0, period, len(preview_points))
+    # Several carriers repeat together after the least common multiple of their periods.
+    # If that fits within a step, every step reaches the extrema of the Plateau's first period.
+    period = int(np.lcm.reduce([ratio.denominator for ratio in ratios]))
+    drift = sum(abs(amp) * abs(freq - ratio) for (amp, freq, _), ratio in zip(carriers, ratios)) * plateau.n_points
+    if period > min_size or 2 * np.pi * drift >= PLATEAU_TOLERANCE:
+        return None
+    points = get_plateau_points(plateau, 0, period)
+    return np.full(len(step_offsets), points.min()), np.full(len(step_offsets), points.max())
 
-    return quant.getTraceDict(preview_points, x=times, t0=times[0], dt=(times[1] - times[0]))
 
+def add_pieces(first, second):
+    """
+    Add together the pieces of two pulses that overlap.
+    The pieces are cut where either pulse changes from one piece to the next, so that Plateaus that overlap
+    stay Plateaus. Only the parts where an array of points overlaps a Plateau have the Plateau expanded.
+    """
+    bounds = sorted({piece_start for piece_start, _ in first + second}
+                    | {piece_start + get_piece_length(piece) for piece_start, piece in first + second})
+    pieces = []
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        parts = [cut_piece(piece, lo - piece_start, hi - piece_start)
+                 for piece_start, piece in first + second
+                 if piece_start <= lo and hi <= piece_start + get_piece_length(piece)]
+        if len(parts) == 0:
+            continue
+        piece = parts[0]
+        for part in parts[1:]:
+            if isinstance(piece, Plateau) and isinstance(part, Plateau):
+                piece = Plateau(hi - lo, piece.carriers + part.carriers)
+            else:
+                piece = expand_piece(piece) + expand_piece(part)
+        pieces.append((lo, piece))
+    return pieces
 
-def construct_preview_pulse(vips, pulse, iteration):
+
+def expand_piece(piece):
+    """
+    Get all points of a preview piece.
+    """
+    return get_plateau_points(piece, 0, piece.n_points) if isinstance(piece, Plateau) else piece
+
+
+def get_visible_ranges(piece_start, length, window_segments):
+    """
+    Get the ranges of a preview piece that are not hidden by sample windows,
+    as a list of (lo, hi) tuples of point indices within the piece.
     """
-    Construct a digitised pulse based on a pulse definition,
-    to be placed in the preview sequence.
+    ranges = [(0, length)]
+    for window_start, window_end in window_segments:
+        window_lo, window_hi = window_start - piece_start, window_end - piece_start
+        ranges = [(lo, hi) for old_lo, old_hi in ranges
+                  for lo, hi in ((old_lo, min(old_hi, window_lo)), (max(old_lo, window_hi), old_hi)) if lo < hi]
+    return ranges
+
+
+def render_preview_points(pieces, window_segments, start, n_points):
+    """
+    Draw every sample of a preview that starts at the given sample tick.
+    Sample windows are drawn as flat lines at -0.1, on top of any pulses.
+    """
+    preview_points = np.zeros(n_points)
+    for piece_start, piece in pieces:
+        offset = piece_start - start
+        lo, hi = max(-offset, 0), min(n_points - offset, get_piece_length(piece))
+        if lo < hi:
+            if isinstance(piece, Plateau):
+                preview_points[offset + lo:offset + hi] += get_plateau_points(piece, lo, hi)
+            else:
+                preview_points[offset + lo:offset + hi] += piece[lo:hi]
+    for window_start, window_end in window_segments:
+        lo, hi = max(window_start - start, 0), min(window_end - start, n_points)
+        if lo < hi:
+            preview_points[lo:hi] = SAMPLE_WINDOW_LEVEL
+    return preview_points
+
+
+def render_preview_envelope(pieces, window_segments, start, n_points, n_steps):
+    """
+    Draw a preview that starts at the given sample tick and spans the given number of samples,
+    as the minimum and maximum of the waveform within each of a number of equally long time steps.
+    Only the samples of the pulses and sample windows themselves are visited, so the cost does not
+    depend on the length of the preview. Steps that lie within a Plateau are drawn without expanding it
+    whenever its points repeat within a step.
+    Return the minima and maxima interleaved, along with the sample index that each point is drawn at.
+    """
+    # Sample k of the preview falls in step k * n_steps // n_points
+    step_starts = -(-np.arange(n_steps + 1) * n_points // n_steps)
+    step_sizes = np.diff(step_starts)
+    minima = np.full(n_steps, np.inf)
+    maxima = np.full(n_steps, -np.inf)
+    covered = np.zeros(n_steps, dtype=np.int64)
+
+    def add_points(offset, points):
+        steps = np.arange(offset, offset + len(points)) * n_steps // n_points
+        bounds = np.flatnonzero(np.diff(steps)) + 1
+        firsts = np.concatenate(([0], bounds))
+        step_idx = steps[firsts]
+        minima[step_idx] = np.minimum(minima[step_idx], np.minimum.reduceat(points, firsts))
+        maxima[step_idx] = np.maximum(maxima[step_idx], np.maximum.reduceat(points, firsts))
+        covered[step_idx] += np.diff(np.concatenate((firsts, [len(points)])))
+
+    def add_level(lo, hi, low, high):
+        # Every step that overlaps samples lo to hi reaches from low to high within them
+        first, last = lo * n_steps // n_points, (hi - 1) * n_steps // n_points + 1
+        minima[first:last] = np.minimum(minima[first:last], low)
+        maxima[first:last] = np.maximum(maxima[first:last], high)
+        covered[first:last] += np.minimum(step_starts[first + 1:last + 1], hi) - np.maximum(step_starts[first:last], lo)
+
+    def add_plateau(offset, plateau):
+        lo, hi = offset, offset + plateau.n_points
+        carriers = [(amp, freq, phase) for amp, freq, phase in plateau.carriers if amp != 0]
+        if all(freq == 0 for _, freq, _ in carriers):
+            level = sum(amp * np.cos(np.pi * phase) for amp, _, phase in carriers)
+            add_level(lo, hi, level, level)
+            return
+
+        # Steps that lie entirely within the Plateau can often be drawn without expanding it
+        first, last = np.searchsorted(step_starts, lo), np.searchsorted(step_starts, hi, 'right') - 1
+        if first < last:
+            sizes = step_sizes[first:last]
+            extrema = get_plateau_extrema(plateau, step_starts[first:last] - lo, sizes.min(), sizes.max())
+            if extrema is not None:
+                add_level(step_starts[first], step_starts[last], *extrema)
+                add_plateau_points(plateau, lo, 0, step_starts[first] - lo)
+                add_plateau_points(plateau, lo, step_starts[last] - lo, plateau.n_points)
+                return
+        add_plateau_points(plateau, lo, 0, plateau.n_points)
+
+    def add_plateau_points(plateau, offset, begin, end):
+        # Expand the Plateau's points from begin to end a chunk at a time, to keep memory use bounded
+        for chunk in range(begin, end, PLATEAU_CHUNK_SIZE):
+            add_points(offset + chunk, get_plateau_points(plateau, chunk, min(chunk + PLATEAU_CHUNK_SIZE, end)))
+
+    for piece_start, piece in pieces:
+        # Sample windows hide the parts of pulses that they overlap with
+        offset = piece_start - start
+        for lo, hi in get_visible_ranges(piece_start, get_piece_length(piece), window_segments):
+            lo, hi = max(lo, -offset), min(hi, n_points - offset)
+            if lo >= hi:
+                continue
+            if isinstance(piece, Plateau):
+                add_plateau(offset + lo, cut_piece(piece, lo, hi))
+            else:
+                add_points(offset + lo, piece[lo:hi])
+    for window_start, window_end in window_segments:
+        lo, hi = max(window_start - start, 0), min(window_end - start, n_points)
+        if lo < hi:
+            add_level(lo, hi, SAMPLE_WINDOW_LEVEL, SAMPLE_WINDOW_LEVEL)
+
+    # Steps that are not entirely covered by pulses and windows are also at 0 somewhere
+    gaps = covered < step_sizes
+    minima[gaps] = np.minimum(minima[gaps], 0)
+    maxima[gaps] = np.maximum(maxima[gaps], 0)
+
+    preview_points = np.empty(2 * n_steps)
+    preview_points[0::2] = minima
+    preview_points[1::2] = maxima
+    sample_idx = np.empty(2 * n_steps)
+    sample_idx[0::2] = step_starts[:-1]
+    sample_idx[1::2] = step_starts[:-1] + step_sizes / 2
+    return preview_points, sample_idx
+
+
+def construct_preview_pulse(vips, pulse, iterations, reset_ticks):
+    """
+    Construct digitised versions of a pulse definition in each of the given iterations,
+    to be placed in the preview sequence. The given sample ticks of the carrier resets on the pulse's port
+    are searched for the latest reset before the pulse in each iteration.
+    Return a list with a tuple for each iteration of the pulse's start in sample ticks from the start of
+    the trigger period, along with a list of its pieces from get_preview_pieces().
     """
     # Get pulse's envelope
     template_no = pulse['Template_no']
     template_def = vips.template_defs[template_no - 1]
+    iterations = np.asarray(iterations)
 
     # If we have DRAG pulses on this port, get the modified envelopes
     template_idx = pulse['Template_identifier'].def_idx
     if template_idx >= vips.DRAG_INDEX_OFFSET:
-        templ_x, _ = utils.template_def_to_points(vips, template_def, iteration)
-        templ_y = vips.drag_templates[template_idx - vips.DRAG_INDEX_OFFSET]
+        points = pulses.get_drag_template_points(vips, template_idx)
+    elif 'Base' in template_def:
+        # Long drives can change their duration between iterations, so they are split up in each iteration
+        points = None
     else:
-        templ_x, templ_y = utils.template_def_to_points(vips, template_def, iteration)
-    if len(templ_y) == 0:
-        return 0, []
+        segments = utils.template_def_to_segments(vips, template_def, 0)
+        points = segments[0] if len(segments) > 0 else []
+    if points is not None and len(points) == 0:
+        return [(0, [])] * len(iterations)
 
     # Get other relevant parameters
-    start_base, start_delta = pulse['Time']
-    time = start_base + start_delta * iteration
-    abs_time = utils.get_absolute_time(vips, start_base, start_delta, iteration)
-    p_amp, p_freq, p_phase = utils.get_amp_freq_phase(pulse, iteration)
-
-    # Calculate phase relative to latest carrier reset.
-    reset_time = -1
-    for (t, _, _) in vips.carrier_changes[pulse['Port'] - 1]:
-        if t > abs_time:
-            break
-        reset_time = t
-    p_phase = utils.phase_sync(p_freq, p_phase, abs_time - reset_time)
-
-    # Construct the pulse
-    if p_freq != 0 and pulse['Carrier'] != 0:
-        carrier = np.cos(2 * np.pi * p_freq * templ_x + np.pi * p_phase)
-        templ_y = templ_y * carrier
-    wave = templ_y * p_amp
-
-    return time, wave
+    start_base, start_delta = pulse['Ticks']
+    starts = start_base + start_delta * iterations
+    abs_starts = utils.get_absolute_ticks(vips, pulse['Ticks'], iterations)
+    p_amp, p_freq, p_phase = utils.get_amp_freq_phase(pulse, iterations)
+
+    # Calculate phase relative to latest carrier reset, which is a second before the sequence if there is none.
+    reset_idx = np.searchsorted(reset_ticks, abs_starts, side='right') - 1
+    reset_starts = np.full(len(iterations), -utils.get_ticks(vips, 1))
+    reset_starts[reset_idx >= 0] = reset_ticks[reset_idx[reset_idx >= 0]]
+    p_phase = utils.phase_sync(p_freq, p_phase, utils.ticks_to_time(vips, abs_starts - reset_starts))
+
+    # Only pulses with a carrier are modulated, with their frequency given in cycles per sample
+    modulated = (p_freq != 0) & (pulse['Carrier'] != 0)
+    p_freq = np.where(modulated, p_freq / vips.sampling_freq, 0)
+    p_phase = np.where(modulated, p_phase, 0)
+
+    if points is None:
+        return [(start, get_preview_pieces(utils.template_def_to_segments(vips, template_def, iteration),
+                                           start, amp, freq, phase))
+                for start, iteration, amp, freq, phase in zip(starts.tolist(), iterations.tolist(),
+                                                              p_amp, p_freq, p_phase)]
+
+    # Construct the pulse in every iteration at once
+    waves = points * p_amp[:, np.newaxis]
+    if modulated.any():
+        carrier = np.cos(2 * np.pi * p_freq[modulated, np.newaxis] * get_sample_axis(len(points))
+                         + np.pi * p_phase[modulated, np.newaxis])
+        waves[modulated] *= carrier
+    return [(start, [(start, wave)]) for start, wave in zip(starts.tolist(), waves)]
@@ -4,69 +4,176 @@
 A collection of functions for assembling pulse definitions based on ViPS input.
 """
 
+import hashlib
+from collections import OrderedDict
+
 import numpy as np
 
 import input_handling
+import templates
 import utils
 from templates import TemplateIdentifier
 
+# The board can only output pulses at multiples of this time
+OUTPUT_GRANULARITY = 2e-9
+# How far from a whole number of sample ticks a user-given time can be, to count as that number of ticks
+TIME_RESOLUTION = 1e-13
+
+# The most templates that can be in use on each carrier of an output port
+MAX_TEMPLATES_PER_CARRIER = 8
+# The board splits templates that are longer than this into multiple, unless they are long drives
+MAX_TEMPLATE_DURATION = 1024e-9
+
+# The number of derived pairs of DRAG envelopes that are kept in the cache
+DRAG_CACHE_SIZE = 64
+
+# Real and imaginary DRAG envelopes, indexed by the digest of the original envelope and the DRAG parameters
+_drag_points = OrderedDict()
+
+
+class PulseDefinition:
+    """
+    Objects of this class hold a single pulse definition. Its values are accessed by name like a dictionary's,
+    as in pulse['Amp'], but are stored in slots. The amplitude, frequency and phase of the pulse in every
+    iteration are stored in read-only float64 arrays, which copies of the pulse share.
+    The values are:
+        ID: A number that uniquely identifies the pulse.
+        Time: A tuple of the format (base, delta) indicating the pulse's start time.
+        Ticks: The pulse's start time in the same format, in sample ticks.
+        Port: The port that the pulse is output on.
+        Carrier: The carrier generator that the pulse uses, or 0 for none.
+        Template_no: The number of the template used for the pulse.
+        Template_identifier: The identifier of the template the pulse is output with on the board.
+        DRAG_idx: The template number of a DRAG pulse's template. Only DRAG pulses have this value.
+        Amp: The pulse's amplitude scale.
+        Freq: The pulse's carrier frequency.
+        Phase: The pulse's phase.
+    """
+    __slots__ = ('ID', 'Time', 'Ticks', 'Port', 'Carrier', 'Template_no', 'Template_identifier', 'DRAG_idx',
+                 'Amp', 'Freq', 'Phase')
+
+    # The values that hold an array with a value for every iteration
+    ITERATION_VALUES = ('Amp', 'Freq', 'Phase')
+
+    def __init__(self, **values):
+        for key, value in values.items():
+            self[key] = value
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.ITERATION_VALUES and not (isinstance(value, np.ndarray) and not value.flags.writeable):
+            value = np.array(value, dtype=np.float64)
+            value.setflags(write=False)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return hasattr(self, key)
+
+    def copy(self, **changes):
+        """
+        Get a copy of the pulse definition, with the given values changed.
+        """
+        pulse = PulseDefinition()
+        for key in PulseDefinition.__slots__:
+            if key in self:
+                setattr(pulse, key, getattr(self, key))
+        for key, value in changes.items():
+            pulse[key] = value
+        return pulse
+
+
+class CopiedPulseDefinition(PulseDefinition):
+    """
+    Objects of this class are pulse definitions on ports in copy mode. Each one is a view of a pulse on the port
+    that is copied from, with its own ID, port and template identifier, and with its amplitude scaled and its phase
+    shifted. Every other value is read from the copied pulse. The scaled amplitudes and shifted phases
+    are only computed when they are first used, after which they are stored in the view.
+    """
+    __slots__ = ('source', 'amp_scale', 'phase_shift')
+
+    def __init__(self, source, amp_scale, phase_shift, **values):
+        super().__init__(**values)
+        self.source = source
+        self.amp_scale = amp_scale
+        self.phase_shift = phase_shift
+
+    def __getattr__(self, key):
+        # Only called for values that are not stored in the view itself
+        if key == 'Amp':
+            self[key] = self.source['Amp'] * self.amp_scale
+        elif key == 'Phase':
+            self[key] = self.source['Phase'] + self.phase_shift
+        elif key in PulseDefinition.__slots__:
+            return getattr(self.source, key)
+        else:
+            raise AttributeError(key)
+        return getattr(self, key)
+
 
 def get_next_pulse_id(vips):
     """
-    Get a unique pulse ID, for use in pulse definition dictionaries.
+    Get a unique pulse ID, for use in pulse definitions.
     """
     vips.pulse_id_counter += 1
     return vips.pulse_id_counter - 1
 
 
-def get_all_pulse_defs(vips, q):
+def get_all_pulse_defs(vips):
     """
     Get the user-defined pulse sequence information for each port.
-    Return a list of the pulse definition dictionaries.
+    Return a list of the pulse definitions.
     """
     pulse_definitions = []
 
     # Go through every port definition section one after another
     for port in range(1, vips.N_OUT_PORTS+1):
+        pulse_definitions.extend(get_port_pulse_defs(vips, port))
+    return pulse_definitions
 
-        settings = vips.port_settings[port - 1]
-
-        # If no pulses are set up on the port, skip to the next
-        if settings['Mode'] != 'Define':
-            continue
 
-        # Check how many pulses are defined
-        n_pulses = int(vips.getValue(f'Pulses for port {port}'))
-        # Step through all pulse definitions
-        for p_def_idx in range(1, n_pulses + 1):
-            pulse_defs = create_pulse_defs(vips, port, p_def_idx, q)
-            pulse_definitions.extend(pulse_defs)
+def get_port_pulse_defs(vips, port):
+    """
+    Get the pulse definitions set up in the given port's definition section.
+    DRAG pulses defined in the section will also have their sibling pulses included.
+    Return a list of the pulse definitions, which is empty if the port is not in Define mode.
+    """
+    pulse_definitions = []
+    settings = vips.port_settings[port - 1]
+
+    # If no pulses are set up on the port, there is nothing to get
+    if settings['Mode'] != 'Define':
+        return pulse_definitions
+
+    # Check how many pulses are defined
+    n_pulses = int(vips.config[f'Pulses for port {port}'])
+    # Step through all pulse definitions
+    for p_def_idx in range(1, n_pulses + 1):
+        pulse_defs = create_pulse_defs(vips, port, p_def_idx)
+        pulse_definitions.extend(pulse_defs)
     return pulse_definitions
 
 
-def create_pulse_defs(vips, port, def_idx, q):
+def create_pulse_defs(vips, port, def_idx):
     """
-    Create and return a list of pulse definition dictionaries based on a single pulse definition in the instrument.
-    If the user has entered multiple start times, one dictionary will be returned for every start time.
-
-    Pulses are stored as dictionaries with the following entries:
-        Time: A tuple of the format (base, delta) indicating the pulse's start time.
-        Port: The port that the pulse is output on.
-        Template_no: The number of the template used for the pulse.
-        Amp: The pulse's amplitude scale.
-        Freq: The pulse's carrier frequency.
-        Phase: The pulse's phase.
+    Create and return a list of pulse definitions based on a single pulse definition in the instrument.
+    If the user has entered multiple start times, one pulse definition will be returned for every start time.
+    The pulse definitions are PulseDefinition objects.
     """
-    template_no = int(vips.getValue(f'Port {port} - def {def_idx} - template'))
-    carrier = get_carrier_index(vips.getValue(f'Port {port} - def {def_idx} - sine generator'))
+    template_no = int(vips.config[f'Port {port} - def {def_idx} - template'])
+    carrier = get_carrier_index(vips.config[f'Port {port} - def {def_idx} - sine generator'])
 
-    cond_on = vips.getValue(f'Port {port} - def {def_idx} - Condition comparator')
-    cond1 = vips.getValue(f'Port {port} - def {def_idx} - Template matching condition 1')
+    cond_on = vips.config[f'Port {port} - def {def_idx} - Condition comparator']
+    cond1 = vips.config[f'Port {port} - def {def_idx} - Template matching condition 1']
     cond1 = utils.combo_to_int(cond1)
-    cond1_quad = vips.getValue(f'Port {port} - def {def_idx} - Template matching condition 1 quadrature')
-    cond2 = vips.getValue(f'Port {port} - def {def_idx} - Template matching condition 2')
+    cond1_quad = vips.config[f'Port {port} - def {def_idx} - Template matching condition 1 quadrature']
+    cond2 = vips.config[f'Port {port} - def {def_idx} - Template matching condition 2']
     cond2 = utils.combo_to_int(cond2)
-    cond2_quad = vips.getValue(f'Port {port} - def {def_idx} - Template matching condition 2 quadrature')
+    cond2_quad = vips.config[f'Port {port} - def {def_idx} - Template matching condition 2 quadrature']
 
     if cond1 != 0 and cond1 == cond2:
         raise ValueError(f'Pulse {def_idx} on port {port}: both output conditions are set '
@@ -80,33 +187,25 @@ def create_pulse_defs(vips, port, def_idx, q):
                                              cond1, cond2,
                                              cond1_quad, cond2_quad)
 
-    # Non-DRAG pulses can have their template set up normally
-    if carrier != 3:
-        try:
-            setup_template(vips, q, template_identifier)
-        except ValueError as err:
-            if str(err).startswith('No template def'):
-                raise ValueError(f'Pulse definition {def_idx} on port {port} uses an undefined template!')
-            raise err
+    # Check that non-DRAG pulses use a defined template
+    if carrier != 3 and len(vips.template_defs[template_no - 1]) == 0:
+        raise ValueError(f'Pulse definition {def_idx} on port {port} uses an undefined template!')
 
-    sweep_param = vips.getValue(f'Port {port} - def {def_idx} - Sweep param')
+    sweep_param = vips.config[f'Port {port} - def {def_idx} - Sweep param']
     if sweep_param == 'Amplitude scale':
         amp = get_sweep_values(vips, port, def_idx)
     else:
-        amp = vips.getValue(f'Port {port} - def {def_idx} - amp')
-        amp = [amp] * vips.iterations
+        amp = np.full(vips.iterations, vips.config[f'Port {port} - def {def_idx} - amp'])
     if sweep_param == 'Carrier frequency':
         freq = get_sweep_values(vips, port, def_idx)
     else:
-        freq = vips.getValue(f'Port {port} - def {def_idx} - freq')
-        freq = [freq] * vips.iterations
+        freq = np.full(vips.iterations, vips.config[f'Port {port} - def {def_idx} - freq'])
     if sweep_param == 'Phase':
         phase = get_sweep_values(vips, port, def_idx)
     else:
-        phase = vips.getValue(f'Port {port} - def {def_idx} - phase')
-        phase = [phase] * vips.iterations
+        phase = np.full(vips.iterations, vips.config[f'Port {port} - def {def_idx} - phase'])
 
-    repeat_count = int(vips.getValue(f'Port {port} - def {def_idx} - repeat count'))
+    repeat_count = int(vips.config[f'Port {port} - def {def_idx} - repeat count'])
     if repeat_count > 1:
         # Get the pulse's duration
         template_def = vips.template_defs[template_no - 1]
@@ -117,7 +216,7 @@ def create_pulse_defs(vips, port, def_idx, q):
     else:
         duration = None
 
-    start_times = vips.getValue(f'Port {port} - def {def_idx} - start times')
+    start_times = vips.config[f'Port {port} - def {def_idx} - start times']
     start_times = start_times.split(',')
     n_start_times = len(start_times)
 
@@ -140,34 +239,46 @@ def create_pulse_defs(vips, port, def_idx, q):
             time = start_time
 
         # Pulses should only be output on even ns values
-        base_nano = round(time[0] * 1e9, 4)
-        delta_nano = round(time[1] * 1e9, 4)
-        if base_nano % 2 != 0 or delta_nano % 2 != 0:
+        ticks = get_start_ticks(vips, time)
+        if ticks is None:
             raise ValueError(f'The starting time of pulse {def_idx} on port {port} is an odd number of nanoseconds '
                              f'at some point. The board can currently only output pulses at '
                              f'even nanosecond values.')
 
         # Save this pulse definition for later use
         if carrier != 3:
-            pulse_defs.append({
-                'ID': get_next_pulse_id(vips),
-                'Time': time,
-                'Port': port,
-                'Carrier': carrier,
-                'Template_no': template_no,
-                'Template_identifier': template_identifier,
-                'Amp': amp.copy(),
-                'Freq': freq.copy(),
-                'Phase': phase.copy()})
+            pulse_defs.append(PulseDefinition(
+                ID=get_next_pulse_id(vips),
+                Time=time,
+                Ticks=ticks,
+                Port=port,
+                Carrier=carrier,
+                Template_no=template_no,
+                Template_identifier=template_identifier,
+                Amp=amp,
+                Freq=freq,
+                Phase=phase))
 
         # If the pulse is in DRAG mode, we need to calculate some extra parameters
         else:
             pulse_defs.extend(
-                calculate_drag(vips, def_idx, time, port, template_no, template_identifier, amp.copy(), freq.copy(), phase.copy(), q))
+                calculate_drag(vips, def_idx, time, ticks, port, template_no, template_identifier, amp, freq, phase))
 
     return pulse_defs
 
 
+def get_start_ticks(vips, time):
+    """
+    Convert a pulse's (base, delta) start time in seconds to a pair of whole numbers of sample ticks.
+    Return None if either part is not an even number of nanoseconds, which is all the board can output pulses at.
+    """
+    ticks = tuple(utils.get_ticks(vips, np.array(time)).tolist())
+    on_grid = all(abs(t - tick / vips.sampling_freq) <= TIME_RESOLUTION for t, tick in zip(time, ticks))
+    if not on_grid or any(tick % utils.get_ticks(vips, OUTPUT_GRANULARITY) != 0 for tick in ticks):
+        return None
+    return ticks
+
+
 def get_carrier_index(option):
     """
     Get an integer representing a pulse definition's carrier mode.
@@ -179,20 +290,21 @@ def get_carrier_index(option):
     return int(option)
 
 
-def calculate_drag(vips, def_idx, time, port, template_no, template_identifier, amp, freq, phase, q):
+def calculate_drag(vips, def_idx, time, ticks, port, template_no, template_identifier, amp, freq, phase):
     """
     Creates four DRAG pulses based on a pulse definition set to DRAG mode.
-    This will also result in the creation of four new templates on the board, which will be
-    stored in vips.drag_templates, at an index saved in each pulse definition's 'DRAG_idx' key.
+    This will also result in four new templates for the board, whose points are
+    stored in pairs of real and imaginary points in vips.drag_templates. Each pulse definition's 'DRAG_idx'
+    key holds its template number, from which get_drag_template_points() finds its points.
     Returns a list of the four pulse definitions.
     """
 
-    sibling_port = int(vips.getValue(f'Port {port} - def {def_idx} - DRAG sibling port'))
+    sibling_port = int(vips.config[f'Port {port} - def {def_idx} - DRAG sibling port'])
     times, points = utils.template_def_to_points(vips, vips.template_defs[template_no - 1], 0)
-    scale = vips.getValue(f'Port {port} - def {def_idx} - DRAG scale')
-    detuning = vips.getValue(f'Port {port} - def {def_idx} - DRAG detuning frequency')
-    phase_shift = vips.getValue(f'Port {port} - def {def_idx} - DRAG phase shift')
-    sibl_amp_multiplier = vips.getValue(f'Port {port} - def {def_idx} - DRAG amplitude scale multiplier')
+    scale = vips.config[f'Port {port} - def {def_idx} - DRAG scale']
+    detuning = vips.config[f'Port {port} - def {def_idx} - DRAG detuning frequency']
+    phase_shift = vips.config[f'Port {port} - def {def_idx} - DRAG phase shift']
+    sibl_amp_multiplier = vips.config[f'Port {port} - def {def_idx} - DRAG amplitude scale multiplier']
     # Extract conditional information from base template identifier
     condition_on = template_identifier.cond_on
     cond1 = template_identifier.cond1
@@ -200,73 +312,20 @@ def calculate_drag(vips, def_idx, time, port, template_no, template_identifier,
     cond2 = template_identifier.cond2
     cond2_quad = template_identifier.cond2_quad
 
-    if (template_no, template_identifier, scale, detuning) not in vips.drag_parameters:
-        beta = scale * vips.sampling_freq
-
-        # Add the original envelope's gradient (scaled) as a complex part
-        complex_points = points + 1j * beta * np.gradient(points)
-        complex_points = complex_points * np.exp(1j * 2 * np.pi * detuning * times)
-        re_points = np.real(complex_points)
-        im_points = np.imag(complex_points)
-
-        # Rescale points to be within [-0.5, +0.5]
-        biggest_outlier = 2 * max(max(abs(re_points)), max(abs(im_points)))
-        re_points = re_points / biggest_outlier
-        im_points = im_points / biggest_outlier
-
-        # Set up both templates on the board and store them
-        vips.lgr.add_line(f'q.setup_template(port={port}, points={re_points}, carrier=1, use_scale=True)')
-        vips.lgr.add_line(f'q.setup_template(port={port}, points={im_points}, carrier=2, use_scale=True)')
-        vips.lgr.add_line(f'q.setup_template(port={sibling_port}, points={re_points}, carrier=1, use_scale=True)')
-        vips.lgr.add_line(f'q.setup_template(port={sibling_port}, points={im_points}, carrier=2, use_scale=True)')
-        try:
-            base_re_template = q.setup_template(port, re_points, 1, True)
-            base_im_template = q.setup_template(port, im_points, 2, True)
-            sibl_re_template = q.setup_template(sibling_port, re_points, 1, True)
-            sibl_im_template = q.setup_template(sibling_port, im_points, 2, True)
-        except RuntimeError as error:
-            if error.args[0].startswith('Not enough templates on output'):
-                raise RuntimeError('There are more than 8 templates in use on a single carrier'
-                                   f'on port {port} or {sibling_port}!\n The limit was exceeded'
-                                   'while setting up a DRAG pulse on these ports.'
-                                   '(Templates longer than 1024 ns are split into multiple, '
-                                   'unless they are of type "Long drive")')
-
-        # We add 1000 to the base index to separate it from a normal definition index
-        param_idx = len(vips.drag_parameters)
-        base_re_idx = vips.DRAG_INDEX_OFFSET + param_idx * 4 + 0
-        base_im_idx = vips.DRAG_INDEX_OFFSET + param_idx * 4 + 1
-        sibl_re_idx = vips.DRAG_INDEX_OFFSET + param_idx * 4 + 2
-        sibl_im_idx = vips.DRAG_INDEX_OFFSET + param_idx * 4 + 3
-
-        # Prepare template identifiers to store the four templates under
-        base_re_ti = TemplateIdentifier(port,         1, base_re_idx, condition_on, cond1, cond2, cond1_quad, cond2_quad)
-        base_im_ti = TemplateIdentifier(port,         2, base_im_idx, condition_on, cond1, cond2, cond1_quad, cond2_quad)
-        sibl_re_ti = TemplateIdentifier(sibling_port, 1, sibl_re_idx, condition_on, cond1, cond2, cond1_quad, cond2_quad)
-        sibl_im_ti = TemplateIdentifier(sibling_port, 2, sibl_im_idx, condition_on, cond1, cond2, cond1_quad, cond2_quad)
-        vips.templates[base_re_ti] = base_re_template
-        vips.templates[base_im_ti] = base_im_template
-        vips.templates[sibl_re_ti] = sibl_re_template
-        vips.templates[sibl_im_ti] = sibl_im_template
-
-        # Also store the points that make up the templates, for preview purposes
-        vips.drag_templates.append(re_points)
-        vips.drag_templates.append(im_points)
-        vips.drag_templates.append(re_points)
-        vips.drag_templates.append(im_points)
-
-        # Add these parameters to the list
-        vips.drag_parameters.append((template_no, template_identifier, scale, detuning))
-
-    # We've already made the necessary templates, find their index
-    else:
-        match_idx = vips.drag_parameters.index((template_no, template_identifier, scale, detuning))
-
-        # We add 1000 to the base index to separate it from a normal definition index
-        base_re_idx = vips.DRAG_INDEX_OFFSET + match_idx * 4 + 0
-        base_im_idx = vips.DRAG_INDEX_OFFSET + match_idx * 4 + 1
-        sibl_re_idx = vips.DRAG_INDEX_OFFSET + match_idx * 4 + 2
-        sibl_im_idx = vips.DRAG_INDEX_OFFSET + match_idx * 4 + 3
+    # DRAG templates are reused by every DRAG pulse with the same template, identifier, scale and detuning
+    drag_key = (template_no, template_identifier, scale, detuning)
+    param_idx = vips.drag_parameters.get(drag_key)
+    if param_idx is None:
+        param_idx = len(vips.drag_templates)
+        # Store the points that make up the templates, for setting them up on the board and for previews
+        vips.drag_templates.append(get_drag_points(times, points, scale * vips.sampling_freq, detuning))
+        vips.drag_parameters[drag_key] = param_idx
+
+    # We add 1000 to the base index to separate it from a normal definition index
+    base_re_idx = vips.DRAG_INDEX_OFFSET + param_idx * 4 + 0
+    base_im_idx = vips.DRAG_INDEX_OFFSET + param_idx * 4 + 1
+    sibl_re_idx = vips.DRAG_INDEX_OFFSET + param_idx * 4 + 2
+    sibl_im_idx = vips.DRAG_INDEX_OFFSET + param_idx * 4 + 3
 
     # Create four pulse defs
     pulse_defs = []
@@ -278,99 +337,213 @@ def calculate_drag(vips, def_idx, time, port, template_no, template_identifier,
         if i == 0:
             d_idx = base_re_idx
             # Cosine, so we don't need to shift the carrier
-            d_phase = phase.copy()
+            d_phase = phase
             # Don't scale amplitude on the base port
             amp_multiplier = 1
         elif i == 1:
             d_idx = base_im_idx
             # Sine, i.e. a negative pi/2 offset
-            d_phase = [p - 0.5 for p in phase.copy()]
+            d_phase = phase - 0.5
             amp_multiplier = 1
         elif i == 2:
             d_idx = sibl_re_idx
             # Cosine
-            d_phase = [p + phase_shift for p in phase.copy()]
+            d_phase = phase + phase_shift
             # Amplitude on sibling ports may be rescaled by user
             amp_multiplier = sibl_amp_multiplier
         else:
             d_idx = sibl_im_idx
             # Sine
-            d_phase = [p - 0.5 + phase_shift for p in phase.copy()]
+            d_phase = phase - 0.5 + phase_shift
             amp_multiplier = sibl_amp_multiplier
 
         # Recreate the template identifier used before
         template_ident = TemplateIdentifier(d_port, d_carrier, d_idx, condition_on, cond1, cond2, cond1_quad, cond2_quad)
-        pulse_defs.append({
-            'ID': get_next_pulse_id(vips),
-            'Time': time,
-            'Port': d_port,
-            'Carrier': d_carrier,
-            'Template_no': template_no,
-            'Template_identifier': template_ident,
-            'DRAG_idx': d_idx,
-            'Amp': [a * amp_multiplier for a in amp.copy()],
-            'Freq': freq.copy(),
-            'Phase': d_phase}
-        )
+        pulse_defs.append(PulseDefinition(
+            ID=get_next_pulse_id(vips),
+            Time=time,
+            Ticks=ticks,
+            Port=d_port,
+            Carrier=d_carrier,
+            Template_no=template_no,
+            Template_identifier=template_ident,
+            DRAG_idx=d_idx,
+            Amp=amp * amp_multiplier,
+            Freq=freq,
+            Phase=d_phase))
 
     return pulse_defs
 
 
+def get_drag_points(times, points, beta, detuning):
+    """
+    Get the real and imaginary points of the DRAG templates derived from the given envelope.
+    Derivations are cached by the envelope's contents and the DRAG parameters, so that they are
+    not redone for DRAG templates that have been derived before. The returned arrays are read-only.
+    """
+    digest = hashlib.sha1(np.asarray(times, dtype=float).tobytes())
+    digest.update(np.asarray(points, dtype=float).tobytes())
+    key = (digest.hexdigest(), beta, detuning)
+    if key in _drag_points:
+        _drag_points.move_to_end(key)
+        return _drag_points[key]
+
+    # Add the original envelope's gradient (scaled) as a complex part
+    complex_points = points + 1j * beta * np.gradient(points)
+    complex_points = complex_points * np.exp(1j * 2 * np.pi * detuning * times)
+    re_points = np.real(complex_points)
+    im_points = np.imag(complex_points)
+
+    # Rescale points to be within [-0.5, +0.5]
+    biggest_outlier = 2 * max(max(abs(re_points)), max(abs(im_points)))
+    re_points = re_points / biggest_outlier
+    im_points = im_points / biggest_outlier
+    re_points.setflags(write=False)
+    im_points.setflags(write=False)
+
+    templates.add_to_cache(_drag_points, key, (re_points, im_points), DRAG_CACHE_SIZE)
+    return re_points, im_points
+
+
+def get_drag_template_points(vips, template_no):
+    """
+    Get the points of the DRAG template with the given template number.
+    Each DRAG pulse definition has four templates, which alternate between real and imaginary points.
+    """
+    drag_idx = template_no - vips.DRAG_INDEX_OFFSET
+    return vips.drag_templates[drag_idx // 4][drag_idx % 2]
+
+
+def get_template_identifiers(pulse_definitions):
+    """
+    Get the identifiers of the templates that the given pulses use, in the order they are first used.
+    These are the templates that need to be set up on the board, which is done by setup_templates().
+    """
+    return list(dict.fromkeys(pulse['Template_identifier'] for pulse in pulse_definitions))
+
+
+def setup_templates(vips, q):
+    """
+    Set up every template used by the pulses on the board.
+    Templates are pooled by their contents on each port and carrier, so templates with identical contents
+    and conditions share a single template on the board.
+    """
+    vips.templates = {}
+    board_templates = {}
+    shared = 0
+    for template_identifier in vips.template_identifiers:
+        key = get_template_key(vips, template_identifier)
+        if key in board_templates:
+            shared += 1
+        else:
+            board_templates[key] = setup_template(vips, q, template_identifier)
+        vips.templates[template_identifier] = board_templates[key]
+    vips.lgr.add_line('Shared board templates for {} of {} template identifiers', shared, len(vips.template_identifiers))
+
+
+def get_template_key(vips, template_identifier):
+    """
+    Get a key that identifies the specified template by where it is output and the contents it is set up with,
+    so that templates with identical contents can share a template on the board.
+    The key includes the template's port, carrier and output conditions, since the board sets these up per template.
+    Long drives have their duration updated throughout the sequence, so they only share a template
+    with long drives that have the same duration in every iteration.
+    """
+    template_no = template_identifier.def_idx
+    location = (template_identifier.port, template_identifier.carrier, template_identifier.get_condition())
+    if template_no >= vips.DRAG_INDEX_OFFSET:
+        points = get_drag_template_points(vips, template_no)
+        return location, points.tobytes()
+
+    template_def = vips.template_defs[template_no - 1]
+    if 'Base' in template_def:
+        if 'Flank Duration' in template_def:
+            return (location, template_def['Base'], template_def['Delta'], template_def['Flank Duration'],
+                    template_def['Rise Points'].tobytes(), template_def['Fall Points'].tobytes())
+        return location, template_def['Base'], template_def['Delta']
+    return location, template_def['Points'].tobytes()
+
+
 def setup_template(vips, q, template_identifier):
     """
     Set up the specified template on the specified port on the board.
-    Store the template globally in the format given by Vivace.
+    Return the template in the format given by Vivace.
     """
     template_no = template_identifier.def_idx
+    port = template_identifier.port
+    carrier = template_identifier.carrier
+
+    # DRAG templates are not based on a template definition, but on the points computed for them
+    if template_no >= vips.DRAG_INDEX_OFFSET:
+        points = get_drag_template_points(vips, template_no)
+        reserve_templates(vips, port, carrier, get_board_template_count(vips, points), True)
+        vips.lgr.add_line('q.setup_template(port={}, points={}, carrier={}, use_scale=True)', port, points, carrier)
+        return q.setup_template(port, points, carrier, True)
+
     template_def = vips.template_defs[template_no - 1]
-    # Check that the given template number has a definition
-    if len(template_def) == 0:
-        raise ValueError('No template def found!')
-    # If the requested template has not already been set up for this port, do it.
-    if template_identifier not in vips.templates:
-        port = template_identifier.port
-        carrier = template_identifier.carrier
+    # Only long drives have the 'Base' key
+    if 'Base' in template_def:
+        initial_length = template_def['Base']
+        # Set up gaussian rise and fall templates if defined.
+        if 'Flank Duration' in template_def:
+            initial_length -= 2 * template_def['Flank Duration']
+            reserve_templates(vips, port, carrier, 1 + get_board_template_count(vips, template_def['Rise Points'])
+                              + get_board_template_count(vips, template_def['Fall Points']))
+            vips.lgr.add_line('q.setup_template(port={}, points={}, carrier={}, use_scale=True)', port, template_def['Rise Points'], carrier)
+            rise_template = q.setup_template(port, template_def['Rise Points'], carrier, use_scale=True)
+            vips.lgr.add_line('q.setup_template(port={}, points={}, carrier={}, use_scale=True)', port, template_def['Fall Points'], carrier)
+            fall_template = q.setup_template(port, template_def['Fall Points'], carrier, use_scale=True)
+        else:
+            reserve_templates(vips, port, carrier, 1)
+        vips.lgr.add_line('q.setup_long_drive(port={}, carrier={}, duration={}, use_scale=True)', port, carrier, initial_length)
         try:
-            # Only long drives have the 'Base' key
-            if 'Base' in template_def:
-                initial_length = template_def['Base']
-                # Set up gaussian rise and fall templates if defined.
-                if 'Flank Duration' in template_def:
-                    initial_length -= 2 * template_def['Flank Duration']
-                    vips.lgr.add_line(f'q.setup_template(port={port}, points={template_def["Rise Points"]}, carrier={carrier}, use_scale=True)')
-                    rise_template = q.setup_template(port, template_def['Rise Points'], carrier, use_scale=True)
-                    vips.lgr.add_line(f'q.setup_template(port={port}, points={template_def["Fall Points"]}, carrier={carrier}, use_scale=True)')
-                    fall_template = q.setup_template(port, template_def['Fall Points'], carrier, use_scale=True)
-                vips.lgr.add_line(f'q.setup_long_drive(port={port}, carrier={carrier}, duration={initial_length}, use_scale=True)')
-                try:
-                    long_template = q.setup_long_drive(port,
-                                                       carrier,
-                                                       initial_length,
-                                                       use_scale=True)
-                except ValueError as err:
-                    if err.args[0].startswith('valid carriers'):
-                        raise ValueError('Long drive envelopes have to be on either sine generator 1 or 2!')
-                if 'Flank Duration' in template_def:
-                    vips.templates[template_identifier] = (rise_template, long_template, fall_template)
-                else:
-                    vips.templates[template_identifier] = long_template
-            else:
-                vips.lgr.add_line(f'q.setup_template(port={port}, points={template_def["Points"]}, carrier={carrier}, use_scale=True)')
-                vips.templates[template_identifier] = q.setup_template(port,
-                                                                       template_def['Points'],
-                                                                       carrier,
-                                                                       use_scale=True)
-        except RuntimeError as error:
-            if error.args[0].startswith('Not enough templates on output'):
-                raise RuntimeError(f'There are more than 8 templates in use on carrier {carrier}'
-                                   f'on port {port}!\n '
-                                   '(Templates longer than 1024 ns are split into multiple, '
-                                   'unless they are of type "Long drive")')
-
-
-def get_sample_windows(vips, q):
-    """
-    Set up the user-defined sample windows on the board.
+            long_template = q.setup_long_drive(port,
+                                               carrier,
+                                               initial_length,
+                                               use_scale=True)
+        except ValueError as err:
+            if err.args[0].startswith('valid carriers'):
+                raise ValueError('Long drive envelopes have to be on either sine generator 1 or 2!')
+            raise err
+        if 'Flank Duration' in template_def:
+            return rise_template, long_template, fall_template
+        return long_template
+
+    reserve_templates(vips, port, carrier, get_board_template_count(vips, template_def['Points']))
+    vips.lgr.add_line('q.setup_template(port={}, points={}, carrier={}, use_scale=True)', port, template_def['Points'], carrier)
+    return q.setup_template(port, template_def['Points'], carrier, use_scale=True)
+
+
+def get_board_template_count(vips, points):
+    """
+    Get the number of templates that the board splits a template with the given points into.
+    """
+    max_points = round(MAX_TEMPLATE_DURATION * vips.sampling_freq)
+    return max(1, -(-len(points) // max_points))
+
+
+def reserve_templates(vips, port, carrier, count, is_drag=False):
+    """
+    Count the given number of templates as set up on the given port and carrier,
+    and raise an error if that takes the port and carrier over the number of templates that the board has room for.
+    """
+    if vips.session.add_templates(port, carrier, count) <= MAX_TEMPLATES_PER_CARRIER:
+        return
+    if is_drag:
+        raise RuntimeError(f'There are more than {MAX_TEMPLATES_PER_CARRIER} templates in use on carrier {carrier} '
+                           f'on port {port}!\n The limit was exceeded '
+                           'while setting up a DRAG pulse on this port. '
+                           '(Templates longer than 1024 ns are split into multiple, '
+                           'unless they are of type "Long drive")')
+    raise RuntimeError(f'There are more than {MAX_TEMPLATES_PER_CARRIER} templates in use on carrier {carrier} '
+                       f'on port {port}!\n '
+                       '(Templates longer than 1024 ns are split into multiple, '
+                       'unless they are of type "Long drive")')
+
+
+def get_sample_windows(vips):
+    """
+    Get the user-defined sample windows.
     These are stored in a dictionary format, with the following entries:
         ID: The window's pulse ID.
         Time: The window's starting time, given as the tuple (base, delta).
@@ -381,28 +554,23 @@ def get_sample_windows(vips, q):
     # Check one port at a time
     sampling_ports = []
     for port in range(1, vips.N_IN_PORTS+1):
-        use_port = vips.getValue(f'Sampling on port {port}')
+        use_port = vips.config[f'Sampling on port {port}']
         if use_port:
             sampling_ports.append(port)
     if len(sampling_ports) == 0:
         raise ValueError('Sampling not set up on any port!')
 
-    duration = vips.getValue(f'Sampling - duration')
+    duration = vips.config[f'Sampling - duration']
     # The board can only sample for 4096 ns at a time, so if the user wants longer, we need to split up the calls.
     if duration > 4096e-9:
         raise ValueError('Sampling duration must be in [0.0, 4096.0] ns')
 
-    vips.lgr.add_line(f'q.set_store_duration({duration})')
-    q.set_store_duration(duration)
     vips.sampling_duration = duration
-
     # Save the ports we want to sample on
-    vips.lgr.add_line(f'q.set_store_ports({sampling_ports})')
-    q.set_store_ports(sampling_ports)
     vips.sampling_ports = sampling_ports
 
     # Get times and duration
-    start_times_string = vips.getValue(f'Sampling - start times')
+    start_times_string = vips.config[f'Sampling - start times']
     start_times = start_times_string.split(',')
     vips.samples_per_iteration = len(start_times)
 
@@ -414,7 +582,9 @@ def get_sample_windows(vips, q):
             raise ValueError(f'Invalid start time definition for sampling:\n{err}')
 
         # Sample window has to fit within trigger period
-        if time[0] + (vips.iterations - 1) * time[1] + duration > vips.trigger_period:
+        ticks = tuple(utils.get_ticks(vips, np.array(time)).tolist())
+        if (ticks[0] + (vips.iterations - 1) * ticks[1] + utils.get_ticks(vips, duration)
+                > utils.get_ticks(vips, vips.trigger_period)):
             raise ValueError('Sampling duration cannot exceed the length of the trigger period!')
 
         # Get a unique pulse def id
@@ -422,35 +592,43 @@ def get_sample_windows(vips, q):
 
         sample_definitions.append({
             'ID': p_id,
-            'Time': time})
+            'Time': time,
+            'Ticks': ticks})
 
     return sample_definitions
 
 
+def setup_sampling(vips, q):
+    """
+    Set up the sampling duration and the ports to sample on on the board.
+    """
+    vips.lgr.add_line('q.set_store_duration({})', vips.sampling_duration)
+    q.set_store_duration(vips.sampling_duration)
+    vips.lgr.add_line('q.set_store_ports({})', vips.sampling_ports)
+    q.set_store_ports(vips.sampling_ports)
+
+
 def get_sweep_values(vips, port, def_idx):
     """
-    Calculate and return a list of parameter values to sweep over based on the given pulse's sweep settings.
+    Calculate and return an array of parameter values to sweep over based on the given pulse's sweep settings.
     """
-    sweep_format = vips.getValue(f'Port {port} - def {def_idx} - Sweep format')
+    sweep_format = vips.config[f'Port {port} - def {def_idx} - Sweep format']
     # Custom is a special case, we just get the values directly
     if sweep_format == 'Custom':
-        step_values = vips.getValue(f'Port {port} - def {def_idx} - Sweep custom steps')
+        step_values = vips.config[f'Port {port} - def {def_idx} - Sweep custom steps']
         string_list = step_values.split(',')
         if len(string_list) != vips.iterations:
             raise ValueError(f'The number of custom values for pulse definition '
                              f'{def_idx} on port {port} does not match the number of iterations!')
-        values = []
-        for string in string_list:
-            values.append(float(string))
-        return values
+        return np.array([float(string) for string in string_list])
     # For linear, we need to calculate the full list of values
     if sweep_format == 'Linear: Start-End':
-        interval_start = vips.getValue(f'Port {port} - def {def_idx} - Sweep linear start')
-        interval_end = vips.getValue(f'Port {port} - def {def_idx} - Sweep linear end')
+        interval_start = vips.config[f'Port {port} - def {def_idx} - Sweep linear start']
+        interval_end = vips.config[f'Port {port} - def {def_idx} - Sweep linear end']
     else:  # Center-span
-        center = vips.getValue(f'Port {port} - def {def_idx} - Sweep linear center')
-        span = vips.getValue(f'Port {port} - def {def_idx} - Sweep linear span')
+        center = vips.config[f'Port {port} - def {def_idx} - Sweep linear center']
+        span = vips.config[f'Port {port} - def {def_idx} - Sweep linear span']
         interval_start = center - (span / 2)
         interval_end = center + (span / 2)
 
-    return list(np.linspace(interval_start, interval_end, vips.iterations))
+    return np.linspace(interval_start, interval_end, vips.iterations)
@@ -4,120 +4,208 @@
 A collection of functions for scheduling the emission of pulses and carriers in Vivace.
 """
 
-import math
+import numpy as np
 
 import utils
 
+# The kinds of events in an event table, each of which corresponds to a call to the board
+SELECT_FREQUENCY = 0
+SELECT_SCALE = 1
+UPDATE_DURATION = 2
+OUTPUT_PULSE = 3
+STORE = 4
+EVENT_KINDS = ('select_frequency', 'select_scale', 'update_total_duration', 'output_pulse', 'store')
 
-def setup_sequence(vips, q):
-    """
-    Issue commands to the board to set up the pulse sequence defined in the instrument.
-    """
-    # The time at which the latest emitted pulse began, for each port
-    # Used to avoid multiple LUT steps for pulses starting at the same time
-    prev_output_time = [-1] * vips.N_OUT_PORTS
-    schedule_fp_changes(vips, q)
-    for iter in range(vips.iterations):
-        vips.lgr.add_line(f'-- Iteration {iter} --')
-        for pulse in vips.pulse_definitions:
-            prev_output_time = setup_pulse(vips, iter, prev_output_time, pulse, q)
-        for window in vips.sample_windows:
-            setup_sample_window(vips, window, iter, q)
-
-
-def schedule_fp_changes(vips, q):
-    """
-    Called from setup_sequence().
-    Schedule the stepping in Vivace's Frequency/Phase LUTs.
-    """
-    for p, port_changes in enumerate(vips.carrier_changes):
-        for i, (t, fp1, fp2) in enumerate(port_changes):
-            # Step to the pulse's parameters in the LUTs
-            go_to_fp(vips, q, t, p + 1, (fp1, fp2))
+# The columns of an event table. Times and durations are in sample ticks, and are only converted to seconds
+# when the events are set up on the board. Templates are given by their index in vips.template_identifiers,
+# along with the part of a long drive with gaussian flanks that is used: 0, 1 or 2 for its rise, long part or fall,
+# and -1 for templates that are not split into parts. Unused template and LUT indices are -1.
+EVENT_DTYPE = np.dtype([('time', np.int64),
+                        ('port', np.int16),
+                        ('kind', np.int8),
+                        ('template', np.int32),
+                        ('part', np.int8),
+                        ('lut_idx', np.int32),
+                        ('duration', np.int64)])
 
+# The most events that a single pulse or sample window causes in an iteration
+EVENTS_PER_ITEM = 5
 
-def setup_pulse(vips, iteration, prev_output_time, pulse, q):
-    """
-    Called from setup_sequence(). This function handles all the setup of a single pulse definition.
-    Returns prev_output_time, which is the time at which this pulse begins
-    """
-    port = pulse['Port']
-    template_no = pulse['Template_no']
-    template_def = vips.template_defs[template_no - 1]
-    template = vips.templates[pulse['Template_identifier']]
-
-    # Check if template is a long drive. If so, we might need to update its duration
-    if 'Base' in template_def:
-        (dur_base, dur_delta) = template_def['Base'], template_def['Delta']
-        duration = dur_base + dur_delta * iteration
-        set_long_duration(vips, template_def, template, duration)
-    else:
-        duration = template_def['Duration']
-
-    # Get pulse parameters
-    start_base, start_delta = pulse['Time']
-    time = utils.get_absolute_time(vips, start_base, start_delta, iteration)
-    p_amp, p_freq, p_phase = utils.get_amp_freq_phase(pulse, iteration)
-
-    # Step to the pulse's parameters in the LUTs, unless it has already happened for a pulse of the same start time
-    if prev_output_time[port - 1] != time:
-        go_to_amp(vips, q, max(0, time - 2e-9), port, p_amp)
-
-    # Set up the actual pulse command on the board
-    output_pulse(vips, time, duration, template, template_def, q)
-    # Store the time at which this pulse began
-    prev_output_time[port - 1] = time
-    return prev_output_time
-
-
-def setup_sample_window(vips, window, iteration, q):
-    """
-    Called from setup_sequence(). Sets up a sample window in Vivace,
-    based on the given window definition.
-    """
-    start_base, start_delta = window['Time']
-    vips.lgr.add_line(f'q.store(time={utils.get_absolute_time(vips, start_base, start_delta, iteration)})')
-    q.store(utils.get_absolute_time(vips, start_base, start_delta, iteration))
+# How long before a pulse its amplitude scale is selected, in seconds
+SCALE_SELECT_LEAD = 2e-9
 
-
-def set_long_duration(vips, template_def, template, duration):
-    """
-    Give a command to the board to update the given long drive template's duration.
-    """
-    # If we are using gaussian flanks, the duration must be shortened
-    if isinstance(template, tuple):
-        long_duration = duration - 2 * template_def['Flank Duration']
-        vips.lgr.add_line(f'update_total_duration({long_duration})')
-        template[1].update_total_duration(long_duration)
-    else:
-        vips.lgr.add_line(f'update_total_duration({duration})')
-        template.update_total_duration(duration)
+# How far from a whole number of periods a carrier can be, for it to count as being back at the same phase
+CARRIER_PERIOD_TOLERANCE = 1e-6
 
 
-def output_pulse(vips, time, duration, template, template_def, q):
-    """
-    Called from setup_pulse(), this method handles the calls to the board
-    for outputting carrier pulses and envelope pulses for a specific pulse
-    definition.
+def setup_sequence(vips, q):
     """
-    # If we are doing a long drive with gaussian flanks, we need to output three templates
-    if isinstance(template, tuple):
-        flank_duration = template_def['Flank Duration']
-        # Rise
-        rise_template = template[0]
-        vips.lgr.add_line(f'q.output_pulse(time={time}, template={[rise_template]})')
-        q.output_pulse(time, [rise_template])
-        # Long
-        long_template = template[1]
-        vips.lgr.add_line(f'q.output_pulse(time={time + flank_duration}, template={[long_template]})')
-        q.output_pulse(time + flank_duration, [long_template])
-        # Fall
-        fall_template = template[2]
-        vips.lgr.add_line(f'q.output_pulse(time={time + (duration - flank_duration)}, template={[fall_template]})')
-        q.output_pulse(time + (duration - flank_duration), [fall_template])
-    else:
-        vips.lgr.add_line(f'q.output_pulse(time={time}, template={[template]})')
-        q.output_pulse(time, [template])
+    Issue commands to the board to set up the pulse sequence defined in the instrument,
+    by going through the events in its event table in chronological order.
+    """
+    templates = [vips.templates[template_identifier] for template_identifier in vips.template_identifiers]
+    times = utils.ticks_to_time(vips, vips.event_table['time']).tolist()
+    durations = utils.ticks_to_time(vips, vips.event_table['duration']).tolist()
+    events = vips.event_table[['port', 'kind', 'template', 'part', 'lut_idx']].tolist()
+    for time, duration, (port, kind, template_idx, part, lut_idx) in zip(times, durations, events):
+        if template_idx >= 0:
+            template = templates[template_idx] if part < 0 else templates[template_idx][part]
+
+        if kind == SELECT_FREQUENCY:
+            vips.lgr.add_line('q.select_frequency(time={}, idx={}, port={})', time, lut_idx, port)
+            q.select_frequency(time, lut_idx, port)
+        elif kind == SELECT_SCALE:
+            vips.lgr.add_line('q.select_scale(time={}, idx={}, port={})', time, lut_idx, port)
+            q.select_scale(time, lut_idx, port)
+        elif kind == UPDATE_DURATION:
+            vips.lgr.add_line('update_total_duration({})', duration)
+            template.update_total_duration(duration)
+        elif kind == OUTPUT_PULSE:
+            vips.lgr.add_line('q.output_pulse(time={}, template={})', time, [template])
+            q.output_pulse(time, [template])
+        else:
+            vips.lgr.add_line('q.store(time={})', time)
+            q.store(time)
+
+
+def get_event_table(vips):
+    """
+    Construct the event table of the pulse sequence: a structured array with a row for every call
+    that needs to be made to the board to set up the sequence, sorted chronologically.
+    Every pulse and sample window is handled for all iterations at once.
+    Events at the same time keep the order they would have if they were set up one iteration at a time:
+    frequency/phase LUT steps first, then each pulse's amplitude LUT step, duration update and output
+    in the order of vips.pulse_definitions, and then the sample windows.
+    LUT steps that would not change what is selected on the board are left out.
+    """
+    iterations = np.arange(vips.iterations)
+    n_pulses = len(vips.pulse_definitions)
+    n_items = n_pulses + len(vips.sample_windows)
+    template_indices = {template_identifier: idx for idx, template_identifier in enumerate(vips.template_identifiers)}
+
+    # Blocks of events, along with the order they are set up in if they happen at the same time.
+    # Frequency/phase LUT steps are in group 0, and everything else in group 1.
+    blocks = []
+
+    # Schedule the stepping in the frequency/phase LUTs
+    fp_order = 0
+    for p, port_changes in enumerate(vips.carrier_changes):
+        if len(port_changes) == 0:
+            continue
+        # The carrier changes already know where their values are in the LUT
+        times, _, _, lut_indices = zip(*port_changes)
+        order = fp_order + np.arange(len(port_changes))
+        blocks.append((0, order, get_events(times, p + 1, SELECT_FREQUENCY, lut_idx=lut_indices)))
+        fp_order += len(port_changes)
+
+    pulse_times = [utils.get_absolute_ticks(vips, pulse['Ticks'], iterations) for pulse in vips.pulse_definitions]
+
+    # The time at which the latest emitted pulse began, for each port and iteration.
+    # Used to avoid multiple LUT steps for pulses starting at the same time.
+    # A port's first pulse in an iteration follows its last pulse in the previous iteration.
+    prev_output_times = [np.full(vips.iterations, -1) for _ in range(vips.N_OUT_PORTS)]
+    for pulse, times in zip(vips.pulse_definitions, pulse_times):
+        prev_output_times[pulse['Port'] - 1][1:] = times[:-1]
+
+    for item, (pulse, times) in enumerate(zip(vips.pulse_definitions, pulse_times)):
+        port = pulse['Port']
+        order = (iterations * n_items + item) * EVENTS_PER_ITEM
+
+        # Step to the pulse's amplitude in the LUT, unless it has already happened for a pulse of the same start time
+        lut_indices = vips.amp_matrix[port - 1].find_all(np.array(pulse['Amp'], dtype=float).reshape(-1, 1))
+        steps = (prev_output_times[port - 1] != times) & (lut_indices >= 0)
+        select_times = np.maximum(0, times[steps] - utils.get_ticks(vips, SCALE_SELECT_LEAD))
+        blocks.append((1, order[steps], get_events(select_times, port, SELECT_SCALE, lut_idx=lut_indices[steps])))
+        prev_output_times[port - 1] = times
+
+        template_def = vips.template_defs[pulse['Template_no'] - 1]
+        template = template_indices[pulse['Template_identifier']]
+        durations = utils.get_duration_ticks(vips, template_def, iterations)
+        # DRAG pulses are set up on the board as a single template of precomputed points, even for long drives
+        if pulse['Template_identifier'].def_idx >= vips.DRAG_INDEX_OFFSET:
+            blocks.append((1, order + 2, get_events(times, port, OUTPUT_PULSE, template, duration=durations)))
+            continue
+        # Long drives can change their duration between iterations, so it needs to be updated before each output
+        if 'Base' in template_def:
+            # With gaussian flanks, we need to output three templates, and the long part is shortened
+            if 'Flank Duration' in template_def:
+                flank_duration = utils.get_ticks(vips, template_def['Flank Duration'])
+                long_durations = durations - 2 * flank_duration
+                blocks.append((1, order + 1, get_events(times, port, UPDATE_DURATION, template, 1, duration=long_durations)))
+                blocks.append((1, order + 2, get_events(times, port, OUTPUT_PULSE, template, 0,
+                                                        duration=flank_duration)))
+                blocks.append((1, order + 3, get_events(times + flank_duration, port, OUTPUT_PULSE, template, 1,
+                                                        duration=long_durations)))
+                blocks.append((1, order + 4, get_events(times + (durations - flank_duration), port, OUTPUT_PULSE,
+                                                        template, 2, duration=flank_duration)))
+                continue
+            blocks.append((1, order + 1, get_events(times, port, UPDATE_DURATION, template, duration=durations)))
+        blocks.append((1, order + 2, get_events(times, port, OUTPUT_PULSE, template, duration=durations)))
+
+    for w, window in enumerate(vips.sample_windows):
+        times = utils.get_absolute_ticks(vips, window['Ticks'], iterations)
+        order = (iterations * n_items + n_pulses + w) * EVENTS_PER_ITEM
+        blocks.append((1, order, get_events(times, 0, STORE, duration=utils.get_ticks(vips, vips.sampling_duration))))
+
+    if len(blocks) == 0:
+        return np.empty(0, dtype=EVENT_DTYPE)
+    events = np.concatenate([block_events for _, _, block_events in blocks])
+    groups = np.concatenate([np.full(len(block_events), group) for group, _, block_events in blocks])
+    orders = np.concatenate([order for _, order, _ in blocks])
+    events = events[np.lexsort((orders, groups, events['time']))]
+
+    redundant = get_redundant_selects(vips, events)
+    vips.lgr.add_line('Removed {} of {} events as redundant LUT steps', np.count_nonzero(redundant), len(events))
+    return events[~redundant]
+
+
+def get_redundant_selects(vips, events):
+    """
+    Find the LUT steps in the given chronological event table that do not change what is selected on the board.
+    An amplitude scale step is redundant if the same LUT index is already selected on its port.
+    A frequency/phase step restarts both carriers at the phases in the LUT, so it is only redundant
+    if the same LUT index is already selected, and both carriers have gone through a whole number of
+    periods since it was. The first step on each port is always kept.
+    Return a boolean array that is True for every redundant event.
+    """
+    redundant = np.zeros(len(events), dtype=bool)
+    for kind in (SELECT_SCALE, SELECT_FREQUENCY):
+        # Go through each port's steps of this kind in order
+        selects = np.flatnonzero(events['kind'] == kind)
+        selects = selects[np.argsort(events['port'][selects], kind='stable')]
+        ports = events['port'][selects]
+        lut_indices = events['lut_idx'][selects]
+        same = (ports[1:] == ports[:-1]) & (lut_indices[1:] == lut_indices[:-1])
+
+        if kind == SELECT_FREQUENCY:
+            # The frequencies of both carriers after each step
+            freqs = np.zeros((len(selects), 2))
+            for port in np.unique(ports):
+                port_freqs = np.array([(fp1[0], fp2[0]) for fp1, fp2 in vips.fp_matrix[port - 1]])
+                on_port = ports == port
+                freqs[on_port] = port_freqs[lut_indices[on_port]]
+            elapsed = utils.ticks_to_time(vips, np.diff(events['time'][selects]))
+            periods = elapsed[:, np.newaxis] * freqs[1:]
+            same &= (np.abs(periods - np.round(periods)) <= CARRIER_PERIOD_TOLERANCE).all(axis=1)
+
+        redundant[selects[1:][same]] = True
+    return redundant
+
+
+def get_events(times, port, kind, template=-1, part=-1, lut_idx=-1, duration=0):
+    """
+    Construct a block of events of the same kind, one at each of the given times.
+    Every other column is given either as a single value for all events, or as an array with a value per event.
+    """
+    events = np.empty(len(times), dtype=EVENT_DTYPE)
+    events['time'] = times
+    events['port'] = port
+    events['kind'] = kind
+    events['template'] = template
+    events['part'] = part
+    events['lut_idx'] = lut_idx
+    events['duration'] = duration
+    return events
 
 
 def setup_template_matches(vips, q):
@@ -134,32 +222,5 @@ def setup_template_matches(vips, q):
     for i in range(vips.iterations):
         for start_time in matches_by_time:
             abs_time = utils.get_absolute_time(vips, start_time, 0, i)
-            vips.lgr.add_line(f'q.match(at_time={abs_time}, match_defs={matches_by_time[start_time]})')
+            vips.lgr.add_line('q.match(at_time={}, match_defs={})', abs_time, matches_by_time[start_time])
             q.match(abs_time, matches_by_time[start_time])
-
-
-def go_to_amp(vips, q, time, port, amp):
-    """
-    Find the correct LUT index for the given amplitude value and
-    tell Vivace to select it in the given port's LUT.
-    """
-    p = port - 1
-
-    # Find index of desired value
-    for i, a in enumerate(vips.amp_matrix[p]):
-        if math.isclose(a, amp):
-            vips.lgr.add_line(f"q.select_scale(time={time}, idx={i}, port={port})")
-            q.select_scale(time, i, port)
-
-
-def go_to_fp(vips, q, time, port, fp1fp2):
-    """
-    Find the correct LUT index for the given frequency/phase value tuple
-    and tell Vivace to select it in the given port's LUT.
-    """
-    p = port - 1
-
-    for i, fpfp in enumerate(vips.fp_matrix[p]):
-        if utils.are_fp_pairs_close(fp1fp2, fpfp):
-            vips.lgr.add_line(f"q.select_frequency(time={time}, idx={i}, port={port})")
-            q.select_frequency(time, i, port)
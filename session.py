@@ -0,0 +1,67 @@
+# Authored by Johan Blomberg and Gustav Grännsjö, 2020
+
+"""
+A class for opening connections to Vivace, and for keeping track of
+the values that have already been uploaded to the board through them.
+"""
+
+import contextlib
+
+from vivace import pulsed
+
+
+class VivaceSession:
+    """
+    Objects of this class open a new connection to Vivace for each measurement, and keep a mirror of
+    the output biases and LUT contents that have been uploaded through earlier connections.
+    Setup functions check the mirror before calling Vivace, so that values which are already
+    on the board are not uploaded again. Everything else, such as templates, template matchings
+    and the trigger sequence, is set up again through each connection.
+    """
+
+    def __init__(self, address, dry_run, lgr):
+        self.address = address
+        self.dry_run = dry_run
+        self.lgr = lgr
+
+        # The biases and LUT contents last uploaded to the board, indexed by what they were uploaded to
+        self.state = {}
+        # The number of templates set up through the current connection, indexed by port and carrier
+        self.template_counts = {}
+
+    @contextlib.contextmanager
+    def connect(self):
+        """
+        Open a new connection to Vivace, which is closed when the with block using it is left.
+        If anything goes wrong while it is open, the mirror of the board is cleared,
+        since the board is left in an unknown state.
+        """
+        self.template_counts = {}
+        self.lgr.add_line('pulsed.Pulsed(ext_ref_clk=True, dry_run={}, address={})', self.dry_run, self.address)
+        try:
+            with pulsed.Pulsed(ext_ref_clk=True, dry_run=self.dry_run, address=self.address) as q:
+                yield q
+        except Exception:
+            self.state = {}
+            raise
+
+    def is_loaded(self, key, value):
+        """
+        Check whether the given value was the last one uploaded to the part of the board given by the key.
+        """
+        return key in self.state and self.state[key] == value
+
+    def set_loaded(self, key, value):
+        """
+        Record that the given value has been uploaded to the part of the board given by the key.
+        """
+        self.state[key] = value
+
+    def add_templates(self, port, carrier, count):
+        """
+        Record that the given number of templates are set up on the given port and carrier
+        through the current connection. Return the number of templates on it in total.
+        """
+        key = (port, carrier)
+        self.template_counts[key] = self.template_counts.get(key, 0) + count
+        return self.template_counts[key]
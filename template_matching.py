@@ -10,53 +10,52 @@ import templates
 import utils
 
 
-def get_template_matching_definitions(vips, q):
+def get_template_matching_definitions(vips):
     """
-    Fetch template matching data from the instrument and use it to
-    set up template matches in Vivace. Return a list of tuples containing each
-    match's time, I port match TrigEvent and Q port match TrigEvent.
+    Fetch template matching data from the instrument and construct the templates to match against.
+    Return a list of dictionaries containing each match's start time, duration, first sampling port,
+    whether the port pair is used, threshold, and the four templates that make up the I and Q matches.
     """
-    n_matches = int(vips.getValue('Number of matches'))
+    n_matches = int(vips.config['Number of matches'])
 
     matchings = []
 
     for m in range(1, n_matches+1):
         (sample_port_1, use_port_pair) = get_port_information(vips, m)
 
-        envelope = vips.getValue(f'Template matching {m} - template')
+        envelope = vips.config[f'Template matching {m} - template']
 
-        matching_start = vips.getValue(f'Template matching {m} - matching start time')
+        matching_start = vips.config[f'Template matching {m} - matching start time']
         padding_length = ((matching_start * 1e9) % 2) / 1e9
         matching_start = matching_start - padding_length
-        match_duration = vips.getValue(f'Template matching {m} - matching duration')
+        match_duration = vips.config[f'Template matching {m} - matching duration']
 
-        freq = vips.getValue(f'Template matching {m} - frequency')
-        phase = vips.getValue(f'Template matching {m} - template phase')
+        freq = vips.config[f'Template matching {m} - frequency']
+        phase = vips.config[f'Template matching {m} - template phase']
 
-        p2_phase_shift = vips.getValue(f'Template matching {m} - second port phase shift')
-        p1_amp_multiplier = vips.getValue(f'Template matching {m} - first port amplitude scale multiplier')
-        p2_amp_multiplier = vips.getValue(f'Template matching {m} - second port amplitude scale multiplier')
+        p2_phase_shift = vips.config[f'Template matching {m} - second port phase shift']
+        p1_amp_multiplier = vips.config[f'Template matching {m} - first port amplitude scale multiplier']
+        p2_amp_multiplier = vips.config[f'Template matching {m} - second port amplitude scale multiplier']
 
-        threshold = vips.getValue(f'Template matching {m} - threshold')
+        threshold = vips.config[f'Template matching {m} - threshold']
 
         window_duration = vips.sampling_duration
 
-        # Matching can only happen within sampling windows
-        for i in range(vips.iterations):
-            within_window = False
-            for window in vips.sample_windows:
-                abs_match_start = utils.get_absolute_time(vips, matching_start, 0, i)
-                abs_window_start = utils.get_absolute_time(vips, window['Time'][0], window['Time'][1], i)
-
-                if (abs_match_start >= abs_window_start
-                        and abs_match_start + match_duration <= abs_window_start + window_duration):
-                    within_window = True
-                    break
-
-            if not within_window:
-                # Matching was not within any sampling window
-                raise ValueError(f'Template matching {m}: The template matching needs to occur within a sampling '
-                                 f'window! It is first outside of a sampling window on iteration {i+1}.')
+        # Matching can only happen within sampling windows, which is checked for every iteration at once
+        iterations = np.arange(vips.iterations)
+        abs_match_start = utils.get_absolute_ticks(vips, (utils.get_ticks(vips, matching_start), 0), iterations)
+        match_end = abs_match_start + utils.get_ticks(vips, match_duration)
+        within_window = np.zeros(vips.iterations, dtype=bool)
+        for window in vips.sample_windows:
+            abs_window_start = utils.get_absolute_ticks(vips, window['Ticks'], iterations)
+            within_window |= ((abs_match_start >= abs_window_start)
+                              & (match_end <= abs_window_start + utils.get_ticks(vips, window_duration)))
+
+        outside = np.flatnonzero(~within_window)
+        if len(outside) > 0:
+            # Matching was not within any sampling window
+            raise ValueError(f'Template matching {m}: The template matching needs to occur within a sampling '
+                             f'window! It is first outside of a sampling window on iteration {outside[0]+1}.')
 
         # Construct matching template envelope
         n_points = round(match_duration * vips.sampling_freq)
@@ -86,14 +85,38 @@ def get_template_matching_definitions(vips, q):
         template_m2_p1 = envelope * carrier_m2_p1 * p1_amp_multiplier
         template_m2_p2 = envelope * carrier_m2_p2 * p2_amp_multiplier
 
-        vips.lgr.add_line(f'q.setup_template_matching_pair(port={sample_port_1}, template1={template_m1_p1}, '
-                          f'template2={template_m1_p2}, threshold={threshold}, port_pair={use_port_pair}')
-        vips.lgr.add_line(f'q.setup_template_matching_pair(port={sample_port_1}, template1={template_m2_p1}, '
-                          f'template2={template_m2_p2}, threshold={threshold}, port_pair={use_port_pair}')
-        matching_i = q.setup_template_matching_pair(sample_port_1, template_m1_p1, template_m1_p2, threshold / match_duration, use_port_pair)
-        matching_q = q.setup_template_matching_pair(sample_port_1, template_m2_p1, template_m2_p2, threshold / match_duration, use_port_pair)
+        matchings.append({
+            'Start': matching_start,
+            'Duration': match_duration,
+            'Port': sample_port_1,
+            'Use pair': use_port_pair,
+            'Threshold': threshold,
+            'I templates': (template_m1_p1, template_m1_p2),
+            'Q templates': (template_m2_p1, template_m2_p2)})
+
+    return matchings
+
 
-        matchings.append((matching_start, match_duration, matching_i, matching_q))
+def setup_template_matchings(vips, q):
+    """
+    Set up the template matches in Vivace. Return a list of tuples containing each
+    match's time, duration, I port match TrigEvent and Q port match TrigEvent.
+    """
+    matchings = []
+    for m in vips.template_matching_defs:
+        port = m['Port']
+        use_pair = m['Use pair']
+        threshold = m['Threshold']
+        (template_m1_p1, template_m1_p2) = m['I templates']
+        (template_m2_p1, template_m2_p2) = m['Q templates']
+        vips.lgr.add_line('q.setup_template_matching_pair(port={}, template1={}, template2={}, threshold={}, port_pair={}',
+                          port, template_m1_p1, template_m1_p2, threshold, use_pair)
+        vips.lgr.add_line('q.setup_template_matching_pair(port={}, template1={}, template2={}, threshold={}, port_pair={}',
+                          port, template_m2_p1, template_m2_p2, threshold, use_pair)
+        matching_i = q.setup_template_matching_pair(port, template_m1_p1, template_m1_p2, threshold / m['Duration'], use_pair)
+        matching_q = q.setup_template_matching_pair(port, template_m2_p1, template_m2_p2, threshold / m['Duration'], use_pair)
+
+        matchings.append((m['Start'], m['Duration'], matching_i, matching_q))
 
     return matchings
 
@@ -104,8 +127,8 @@ def get_port_information(vips, matching_no):
     everything is set up correctly.
     Return the number of the first port, and a boolean indicating if the second port is used.
     """
-    sample_port_1 = int(vips.getValue(f'Template matching {matching_no} - first sampling port'))
-    use_port_2 = vips.getValue(f'Template matching {matching_no} - match on two ports')
+    sample_port_1 = int(vips.config[f'Template matching {matching_no} - first sampling port'])
+    use_port_2 = vips.config[f'Template matching {matching_no} - match on two ports']
     sample_port_2 = sample_port_1 + 1 if use_port_2 else 0
 
     if sample_port_2 > 8:
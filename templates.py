@@ -5,46 +5,60 @@ A collection of functions for assembling representations of the
 envelope template definitions set up in ViPS.
 """
 
+from collections import OrderedDict
+
 import numpy as np
-from scipy.stats import norm
 from scipy.interpolate import interp1d
 
+import configuration
 import input_handling
 import envelopes
 
+# The number of custom template inputs, and of resampled custom templates, that are kept in the caches
+CUSTOM_TEMPLATE_CACHE_SIZE = 16
+
+# Fitted curves of custom template inputs, indexed by the digest of the input's contents
+_custom_curves = OrderedDict()
+# Resampled custom templates, indexed by the digest of the input's contents and the number of points
+_custom_points = OrderedDict()
+
 
 class TemplateIdentifier:
     """
     Objects of this class are used to uniquely identify template definitions
     set up in ViPS, before they are built in Vivace.
+    Identifiers are immutable, and their hash is computed once, since they are used as dictionary keys throughout.
     """
+    __slots__ = ('port', 'carrier', 'def_idx', 'cond_on', 'cond1', 'cond2', 'cond1_quad', 'cond2_quad',
+                 '_key', '_hash')
+
     def __init__(self, port, carrier, def_idx, cond_on, cond1, cond2, cond1_quad, cond2_quad):
-        self.port = port
-        self.carrier = carrier
-        self.def_idx = def_idx
-        self.cond_on = cond_on
-        self.cond1 = cond1
-        self.cond2 = cond2
-        self.cond1_quad = cond1_quad
-        self.cond2_quad = cond2_quad
-
-    def __get_tuple(self):
-        return (self.port,
-                self.carrier,
-                self.def_idx,
-                self.cond_on,
-                self.cond1,
-                self.cond2,
-                self.cond1_quad,
-                self.cond2_quad)
+        key = (port, carrier, def_idx, cond_on, cond1, cond2, cond1_quad, cond2_quad)
+        for name, value in zip(self.__slots__, key):
+            object.__setattr__(self, name, value)
+        object.__setattr__(self, '_key', key)
+        object.__setattr__(self, '_hash', hash(key))
+
+    def __setattr__(self, key, value):
+        raise AttributeError('Template identifiers cannot be modified!')
+
+    def get_condition(self):
+        """
+        Get the output condition of the template. Unconditional templates all have the same condition.
+        """
+        if self.cond_on == 'No':
+            return ('No',)
+        return self.cond_on, self.cond1, self.cond2, self.cond1_quad, self.cond2_quad
 
     def __eq__(self, other):
+        if self is other:
+            return True
         if isinstance(other, TemplateIdentifier):
-            return self.__get_tuple() == other.__get_tuple()
+            return self._hash == other._hash and self._key == other._key
         return False
 
     def __hash__(self):
-        return hash(self.__get_tuple())
+        return self._hash
 
 
 def get_template_defs(vips):
@@ -57,40 +71,49 @@ def get_template_defs(vips):
     Gaussian flanks are enabled.
     Return the template definitions in the form of a list.
     """
-    num_templates = vips.getValue('Envelope template count')
+    num_templates = vips.config['Envelope template count']
     template_defs = [{} for _ in range(15)]
     for def_idx in range(1, int(num_templates) + 1):
-        template_name = vips.getValue(f'Envelope template {def_idx}: shape')
-
-        # Long drive templates are a special case
-        if template_name == 'Long drive':
-            template = get_long_drive_definition(vips, def_idx, vips.sampling_freq)
-        else:
-            template = {}
-            # Other types share a lot of behaviour
-            duration = vips.getValue(f'Envelope template {def_idx}: duration')
-            template['Duration'] = duration
-            n_points = round(duration * vips.sampling_freq)
-            use_padding = vips.getValue(f'Envelope template {def_idx}: use zero-padding')
-            template['Points'] = get_template_points(vips, template_name, n_points, def_idx)
-
-            # Pad with leading zeroes if requested
-            if use_padding:
-                pad_length = vips.getValue(f'Envelope template {def_idx}: padding length')
-                pad_points = int(pad_length * 4)
-                template['Points'] = np.concatenate((np.zeros(pad_points), template['Points']))
-
-        template_defs[def_idx - 1] = template
+        template_defs[def_idx - 1] = get_template_def(vips, def_idx)
     return template_defs
 
 
+def get_template_def(vips, def_idx):
+    """
+    Get the definition of a single user-defined template, in the format described in get_template_defs().
+    Templates beyond the user's template count have an empty definition.
+    """
+    if def_idx > int(vips.config['Envelope template count']):
+        return {}
+    template_name = vips.config[f'Envelope template {def_idx}: shape']
+
+    # Long drive templates are a special case
+    if template_name == 'Long drive':
+        return get_long_drive_definition(vips, def_idx, vips.sampling_freq)
+
+    template = {}
+    # Other types share a lot of behaviour
+    duration = vips.config[f'Envelope template {def_idx}: duration']
+    template['Duration'] = duration
+    n_points = round(duration * vips.sampling_freq)
+    use_padding = vips.config[f'Envelope template {def_idx}: use zero-padding']
+    template['Points'] = get_template_points(vips, template_name, n_points, def_idx)
+
+    # Pad with leading zeroes if requested
+    if use_padding:
+        pad_length = vips.config[f'Envelope template {def_idx}: padding length']
+        pad_points = int(pad_length * 4)
+        template['Points'] = np.concatenate((np.zeros(pad_points), template['Points']))
+    return template
+
+
 def get_long_drive_definition(vips, definition_idx, sampling_frequency):
     """
     Construct and return a template definition for a long drive, based on the user-set parameters on
     definition number definition_idx in the instrument.
     """
     template = {}
-    dur_string = vips.getValue(f'Envelope template {definition_idx}: long drive duration')
+    dur_string = vips.config[f'Envelope template {definition_idx}: long drive duration']
     try:
         template['Base'], template['Delta'] = input_handling.compute_time_string(vips, dur_string)
     except ValueError as err:
@@ -102,27 +125,16 @@ def get_long_drive_definition(vips, definition_idx, sampling_frequency):
         raise ValueError(f'Template definition {definition_idx} will have a negative duration during some iteration!')
 
     # Check if we should add gaussian flanks
-    use_gaussian = vips.getValue(f'Envelope template {definition_idx}: use gaussian rise and fall')
+    use_gaussian = vips.config[f'Envelope template {definition_idx}: use gaussian rise and fall']
     if use_gaussian:
-        flank_duration = vips.getValue(f'Envelope template {definition_idx}: gaussian rise and fall duration')
+        flank_duration = vips.config[f'Envelope template {definition_idx}: gaussian rise and fall duration']
         if flank_duration * 2 > template['Base']:
             raise ValueError(f'The rise and fall durations in template {definition_idx} exceed the '
                              f'template\'s total duration!')
         template['Flank Duration'] = flank_duration
         flank_points = round(flank_duration * sampling_frequency)
-        # How many sigma we should cut off our gaussian at
-        cutoff = 3.2
-        # Rise
-        rise_x = np.linspace(-cutoff, 0, flank_points+1)
-        rise_y = norm.pdf(rise_x, 0, 1)
-        rise_y = rise_y / rise_y.max()
-        rise_y[0] = 0  # For symmetry's sake
-        template['Rise Points'] = rise_y[:-1]
-        # Fall
-        fall_x = np.linspace(0, cutoff, flank_points+1)
-        fall_y = norm.pdf(fall_x, 0, 1)
-        fall_y = fall_y / fall_y.max()
-        template['Fall Points'] = fall_y[:-1]
+        template['Rise Points'] = envelopes.gaussian_rise(flank_points+1)[:-1]
+        template['Fall Points'] = envelopes.gaussian_fall(flank_points+1)[:-1]
     return template
 
 
@@ -136,27 +148,48 @@ def get_template_points(vips, template_name, n_points, definition_idx):
     if template_name == 'Square':
         return np.ones(n_points+1)[:-1]
     if template_name == 'SinP':
-        p = vips.getValue(f'Envelope template {definition_idx}: sinP Value')
+        p = vips.config[f'Envelope template {definition_idx}: sinP Value']
         return envelopes.sin_p(p, n_points+1)[:-1]
     if template_name == 'Sin2':
         return envelopes.sin2(n_points+1)[:-1]
     if template_name == 'Sinc':
-        cutoff = vips.getValue(f'Envelope template {definition_idx}: sinc cutoff')
+        cutoff = vips.config[f'Envelope template {definition_idx}: sinc cutoff']
         return envelopes.sinc(cutoff, n_points+1)[:-1]
     if template_name == 'Triangle':
         return envelopes.triangle(n_points+1)[:-1]
     if template_name == 'Gaussian':
-        trunc = vips.getValue(f'Envelope template {definition_idx}: gaussian truncation')
+        trunc = vips.config[f'Envelope template {definition_idx}: gaussian truncation']
         return envelopes.gaussian(n_points+1, trunc)[:-1]
     if template_name == 'Cool':
         return envelopes.cool(n_points+1)[:-1]
     if template_name.startswith('Custom'):
         idx = template_name[-1]
         # Fetch the template's shape from the designated input
-        custom_template = vips.getValue(f'Custom template {idx}')
-        custom_values = custom_template['y']
-        if len(custom_values) == 0:
+        custom_template = vips.config[f'Custom template {idx}']
+        if len(custom_template['y']) == 0:
             raise ValueError(f'Input for custom template {idx} does not contain any data!')
+        return get_custom_template_points(custom_template, n_points)
+
+    raise ValueError('Selected envelope shape is not defined in driver!')
+
+
+def get_custom_template_points(custom_template, n_points):
+    """
+    Return an n_points long array of points resampled from the given custom template input.
+    The input is identified by a digest of its contents, so unchanged inputs are only normalised
+    and fitted once, and only resampled once for each number of points. The returned array is read-only.
+    """
+    digest = configuration.get_vector_digest(custom_template)
+    key = (digest, n_points)
+    if key in _custom_points:
+        _custom_points.move_to_end(key)
+        return _custom_points[key]
+
+    if digest in _custom_curves:
+        _custom_curves.move_to_end(digest)
+        custom_times, curve_fit = _custom_curves[digest]
+    else:
+        custom_values = custom_template['y']
         if 'x' in custom_template:
             custom_times = custom_template['x']
         else:
@@ -169,6 +202,18 @@ def get_template_points(vips, template_name, n_points, definition_idx):
 
         # Fit a curve to the fetched shape, and then set up the template based on this fitted curve
         curve_fit = interp1d(custom_times, custom_values)
-        return curve_fit(np.linspace(custom_times[0], custom_times[-1], n_points))
+        add_to_cache(_custom_curves, digest, (custom_times, curve_fit))
 
-    raise ValueError('Selected envelope shape is not defined in driver!')
+    points = curve_fit(np.linspace(custom_times[0], custom_times[-1], n_points))
+    points.setflags(write=False)
+    add_to_cache(_custom_points, key, points)
+    return points
+
+
+def add_to_cache(cache, key, value, size=CUSTOM_TEMPLATE_CACHE_SIZE):
+    """
+    Add a value to an ordered cache dictionary, evicting the least recently used value if it holds more than size values.
+    """
+    cache[key] = value
+    if len(cache) > size:
+        cache.popitem(last=False)
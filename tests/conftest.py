@@ -0,0 +1,10 @@
+# Authored by Johan Blomberg and Gustav Grännsjö, 2020
+
+"""
+Make the driver's modules importable from the tests, which live in a subdirectory of the driver.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
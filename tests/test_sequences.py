@@ -0,0 +1,480 @@
+# Authored by Johan Blomberg and Gustav Grännsjö, 2020
+
+"""
+Tests that compile a handful of small configurations and set them up on a recording stand-in for the board,
+comparing the calls that are made against fixed expected calls. Times are given in nanoseconds,
+frequencies in MHz and phases in units of pi. Templates are named in the order they are set up:
+T for regular templates, L for long drives and M for the pairs of template matchings.
+"""
+
+import math
+
+import compilation
+import conditionals
+import configuration
+import logger
+import luts
+import pulses
+import scheduling
+import template_matching
+
+SAMPLING_FREQ = 4e9
+
+# The board calls that set up templates and conditions, the ones that set up LUTs,
+# and the ones that make up the trigger sequence
+SETUP_CALLS = ('setup_template', 'setup_long_drive', 'setup_template_matching_pair', 'setup_condition')
+LUT_CALLS = ('setup_scale_lut', 'setup_freq_lut')
+SEQUENCE_CALLS = ('select_frequency', 'select_scale', 'update_total_duration', 'output_pulse', 'store', 'match')
+
+
+def ns(time):
+    """
+    Convert a time in seconds to nanoseconds, rounded to hundredths of a nanosecond.
+    """
+    return round(time * 1e9, 2)
+
+
+class RecordedTemplate:
+    """
+    A template set up on the recording board. Long drives record it when their duration is updated.
+    """
+
+    def __init__(self, board, name):
+        self.board = board
+        self.name = name
+
+    def update_total_duration(self, duration):
+        self.board.calls.append(('update_total_duration', self.name, ns(duration)))
+
+    def __repr__(self):
+        return self.name
+
+
+class RecordingBoard:
+    """
+    A stand-in for a dry run connection to Vivace, which records the calls that are made to it.
+    """
+    dry_run = True
+    sampling_freq = SAMPLING_FREQ
+
+    def __init__(self):
+        self.calls = []
+        self.n_templates = 0
+
+    def new_template(self, prefix):
+        self.n_templates += 1
+        return RecordedTemplate(self, f'{prefix}{self.n_templates}')
+
+    def setup_template(self, port, points, carrier, use_scale=True):
+        template = self.new_template('T')
+        self.calls.append(('setup_template', port, carrier, len(points), template.name))
+        return template
+
+    def setup_long_drive(self, port, carrier, duration, use_scale=True):
+        template = self.new_template('L')
+        self.calls.append(('setup_long_drive', port, carrier, ns(duration), template.name))
+        return template
+
+    def setup_template_matching_pair(self, port, template_1, template_2, threshold, use_pair):
+        self.n_templates += 1
+        matching = (RecordedTemplate(self, f'M{self.n_templates}a'), RecordedTemplate(self, f'M{self.n_templates}b'))
+        self.calls.append(('setup_template_matching_pair', port, len(template_1), len(template_2), use_pair,
+                           [m.name for m in matching]))
+        return matching
+
+    def setup_condition(self, matches, true_templates, false_templates):
+        self.calls.append(('setup_condition', [repr(m) for m in matches],
+                           [repr(t) for t in true_templates], [repr(t) for t in false_templates]))
+
+    def set_store_duration(self, duration):
+        self.calls.append(('set_store_duration', ns(duration)))
+
+    def set_store_ports(self, ports):
+        self.calls.append(('set_store_ports', list(ports)))
+
+    def setup_scale_lut(self, port, amps):
+        self.calls.append(('setup_scale_lut', port, [round(float(amp), 6) for amp in amps]))
+
+    def setup_freq_lut(self, port, carrier, freqs, phases):
+        self.calls.append(('setup_freq_lut', port, carrier, [round(freq / 1e6, 6) for freq in freqs],
+                           [round(float(phase) / math.pi, 6) for phase in phases]))
+
+    def select_frequency(self, time, idx, port):
+        self.calls.append(('select_frequency', ns(time), idx, port))
+
+    def select_scale(self, time, idx, port):
+        self.calls.append(('select_scale', ns(time), idx, port))
+
+    def output_pulse(self, time, templates):
+        self.calls.append(('output_pulse', ns(time), [repr(t) for t in templates]))
+
+    def store(self, time):
+        self.calls.append(('store', ns(time)))
+
+    def match(self, time, matchings):
+        self.calls.append(('match', ns(time), [repr(m) for m in matchings]))
+
+
+class BoardMirror:
+    """
+    A stand-in for a session's mirror of the board, which starts out empty like a new session's.
+    """
+
+    def __init__(self):
+        self.state = {}
+        self.template_counts = {}
+
+    def is_loaded(self, key, value):
+        return key in self.state and self.state[key] == value
+
+    def set_loaded(self, key, value):
+        self.state[key] = value
+
+    def add_templates(self, port, carrier, count):
+        key = (port, carrier)
+        self.template_counts[key] = self.template_counts.get(key, 0) + count
+        return self.template_counts[key]
+
+
+def get_board_calls(values):
+    """
+    Compile a configuration with the given quant values, and set it up on a recording board
+    in the same order as a measurement does. Return the calls made to the board.
+    """
+    compiled = compilation.CompiledSequence(configuration.ConfigSnapshot(values), SAMPLING_FREQ, logger.Logger())
+    compiled.compile()
+    compiled.session = BoardMirror()
+
+    q = RecordingBoard()
+    pulses.setup_templates(compiled, q)
+    pulses.setup_sampling(compiled, q)
+    compiled.template_matchings = template_matching.setup_template_matchings(compiled, q)
+    conditionals.setup_conditionals(compiled, q)
+    luts.apply_LUTs(compiled, q)
+    scheduling.setup_sequence(compiled, q)
+    scheduling.setup_template_matches(compiled, q)
+    return q.calls
+
+
+def get_calls(calls, names):
+    """
+    Get the calls with the given names, in the order they were made.
+    """
+    return [call for call in calls if call[0] in names]
+
+
+def get_config(values):
+    """
+    Get the quant values of a configuration with two iterations and a single sample window on port 1,
+    updated with the given quant values.
+    """
+    config = {
+        'Iterations': 2,
+        'Trigger period': 2e-6,
+        'Envelope template count': '1',
+        'Envelope template 1: shape': 'Sin2',
+        'Envelope template 1: duration': 20e-9,
+        'Sampling on port 1': True,
+        'Sampling - start times': '1E-6',
+        'Sampling - duration': 100e-9,
+        'Number of matches': '0',
+    }
+    config.update(values)
+    return config
+
+
+def test_amplitude_sweep():
+    """
+    A pulse whose amplitude is swept, and whose start time moves between iterations.
+    """
+    calls = get_board_calls(get_config({
+        'Port 1 - mode': 'Define',
+        'Pulses for port 1': '1',
+        'Port 1 - def 1 - template': '1',
+        'Port 1 - def 1 - start times': '100E-9 + 50E-9*i',
+        'Port 1 - def 1 - sine generator': '1',
+        'Port 1 - def 1 - freq': 100e6,
+        'Port 1 - def 1 - phase': 0.25,
+        'Port 1 - def 1 - Sweep param': 'Amplitude scale',
+        'Port 1 - def 1 - Sweep linear start': 0.2,
+        'Port 1 - def 1 - Sweep linear end': 0.6,
+    }))
+    assert get_calls(calls, SETUP_CALLS) == [
+        ('setup_template', 1, 1, 80, 'T1'),
+    ]
+    assert get_calls(calls, LUT_CALLS) == [
+        ('setup_freq_lut', 1, 1, [100.0, 100.0], [0.25, 0.25]),
+        ('setup_freq_lut', 1, 2, [0.0, 0.0], [0.0, 0.0]),
+        ('setup_scale_lut', 1, [0.2, 0.6]),
+    ]
+    assert get_calls(calls, SEQUENCE_CALLS) == [
+        ('select_scale', 98.0, 0, 1),
+        ('select_frequency', 100.0, 0, 1),
+        ('output_pulse', 100.0, ['T1']),
+        ('store', 1000.0),
+        ('select_scale', 2148.0, 1, 1),
+        ('select_frequency', 2150.0, 1, 1),
+        ('output_pulse', 2150.0, ['T1']),
+        ('store', 3000.0),
+    ]
+
+
+def test_long_drive_flanks():
+    """
+    A long drive with gaussian flanks, whose duration grows between iterations.
+    It is output as a rise, a long part whose duration is updated before each output, and a fall.
+    """
+    calls = get_board_calls(get_config({
+        'Envelope template 1: shape': 'Long drive',
+        'Envelope template 1: long drive duration': '100E-9 + 20E-9*i',
+        'Envelope template 1: use gaussian rise and fall': True,
+        'Envelope template 1: gaussian rise and fall duration': 10e-9,
+        'Port 1 - mode': 'Define',
+        'Pulses for port 1': '1',
+        'Port 1 - def 1 - template': '1',
+        'Port 1 - def 1 - start times': '200E-9',
+        'Port 1 - def 1 - sine generator': '2',
+        'Port 1 - def 1 - amp': 0.5,
+        'Port 1 - def 1 - freq': 50e6,
+    }))
+    assert get_calls(calls, SETUP_CALLS) == [
+        ('setup_template', 1, 2, 40, 'T1'),
+        ('setup_template', 1, 2, 40, 'T2'),
+        ('setup_long_drive', 1, 2, 80.0, 'L3'),
+    ]
+    assert get_calls(calls, LUT_CALLS) == [
+        ('setup_freq_lut', 1, 1, [0.0, 0.0], [0.0, 0.0]),
+        ('setup_freq_lut', 1, 2, [50.0, 50.0], [0.0, 0.0]),
+        ('setup_scale_lut', 1, [0.5]),
+    ]
+    assert get_calls(calls, SEQUENCE_CALLS) == [
+        ('select_scale', 198.0, 0, 1),
+        ('select_frequency', 200.0, 0, 1),
+        ('update_total_duration', 'L3', 80.0),
+        ('output_pulse', 200.0, ['T1']),
+        ('output_pulse', 210.0, ['L3']),
+        ('output_pulse', 290.0, ['T2']),
+        ('store', 1000.0),
+        ('select_frequency', 2200.0, 1, 1),
+        ('update_total_duration', 'L3', 100.0),
+        ('output_pulse', 2200.0, ['T1']),
+        ('output_pulse', 2210.0, ['L3']),
+        ('output_pulse', 2310.0, ['T2']),
+        ('store', 3000.0),
+    ]
+
+
+def test_drag():
+    """
+    A DRAG pulse, which is output on both carriers of its own port and of its sibling port.
+    """
+    calls = get_board_calls(get_config({
+        'Port 1 - mode': 'Define',
+        'Pulses for port 1': '1',
+        'Port 1 - def 1 - template': '1',
+        'Port 1 - def 1 - start times': '100E-9',
+        'Port 1 - def 1 - sine generator': 'DRAG',
+        'Port 1 - def 1 - DRAG sibling port': '2',
+        'Port 1 - def 1 - DRAG scale': 2e-9,
+        'Port 1 - def 1 - DRAG detuning frequency': 5e6,
+        'Port 1 - def 1 - DRAG phase shift': 0.5,
+        'Port 1 - def 1 - amp': 0.4,
+        'Port 1 - def 1 - freq': 200e6,
+    }))
+    assert get_calls(calls, SETUP_CALLS) == [
+        ('setup_template', 1, 1, 80, 'T1'),
+        ('setup_template', 1, 2, 80, 'T2'),
+        ('setup_template', 2, 1, 80, 'T3'),
+        ('setup_template', 2, 2, 80, 'T4'),
+    ]
+    assert get_calls(calls, LUT_CALLS) == [
+        ('setup_freq_lut', 1, 1, [200.0, 200.0], [0.0, 2.0]),
+        ('setup_freq_lut', 1, 2, [200.0, 200.0], [1.5, 1.5]),
+        ('setup_scale_lut', 1, [0.4]),
+        ('setup_freq_lut', 2, 1, [200.0, 200.0], [0.5, 0.5]),
+        ('setup_freq_lut', 2, 2, [200.0, 200.0], [0.0, 2.0]),
+        ('setup_scale_lut', 2, [0.4]),
+    ]
+    assert get_calls(calls, SEQUENCE_CALLS) == [
+        ('select_scale', 98.0, 0, 1),
+        ('select_scale', 98.0, 0, 2),
+        ('select_frequency', 100.0, 0, 1),
+        ('select_frequency', 100.0, 0, 2),
+        ('output_pulse', 100.0, ['T1']),
+        ('output_pulse', 100.0, ['T2']),
+        ('output_pulse', 100.0, ['T3']),
+        ('output_pulse', 100.0, ['T4']),
+        ('store', 1000.0),
+        ('select_frequency', 2100.0, 1, 1),
+        ('select_frequency', 2100.0, 1, 2),
+        ('output_pulse', 2100.0, ['T1']),
+        ('output_pulse', 2100.0, ['T2']),
+        ('output_pulse', 2100.0, ['T3']),
+        ('output_pulse', 2100.0, ['T4']),
+        ('store', 3000.0),
+    ]
+
+
+def test_drag_long_drive():
+    """
+    A DRAG pulse on a long drive with gaussian flanks. DRAG pulses are set up as templates of
+    precomputed points, so the long drive is neither split into parts nor has its duration updated.
+    """
+    calls = get_board_calls(get_config({
+        'Envelope template 1: shape': 'Long drive',
+        'Envelope template 1: long drive duration': '100E-9',
+        'Envelope template 1: use gaussian rise and fall': True,
+        'Envelope template 1: gaussian rise and fall duration': 10e-9,
+        'Port 1 - mode': 'Define',
+        'Pulses for port 1': '1',
+        'Port 1 - def 1 - template': '1',
+        'Port 1 - def 1 - start times': '100E-9',
+        'Port 1 - def 1 - sine generator': 'DRAG',
+        'Port 1 - def 1 - DRAG sibling port': '2',
+        'Port 1 - def 1 - amp': 0.5,
+        'Port 1 - def 1 - freq': 100e6,
+    }))
+    assert get_calls(calls, SETUP_CALLS) == [
+        ('setup_template', 1, 1, 400, 'T1'),
+        ('setup_template', 1, 2, 400, 'T2'),
+        ('setup_template', 2, 1, 400, 'T3'),
+        ('setup_template', 2, 2, 400, 'T4'),
+    ]
+    assert get_calls(calls, LUT_CALLS) == [
+        ('setup_freq_lut', 1, 1, [100.0, 100.0], [0.0, 2.0]),
+        ('setup_freq_lut', 1, 2, [100.0, 100.0], [1.5, 1.5]),
+        ('setup_scale_lut', 1, [0.5]),
+        ('setup_freq_lut', 2, 1, [100.0, 100.0], [0.0, 2.0]),
+        ('setup_freq_lut', 2, 2, [100.0, 100.0], [1.5, 1.5]),
+        ('setup_scale_lut', 2, [0.5]),
+    ]
+    assert get_calls(calls, SEQUENCE_CALLS) == [
+        ('select_scale', 98.0, 0, 1),
+        ('select_scale', 98.0, 0, 2),
+        ('select_frequency', 100.0, 0, 1),
+        ('select_frequency', 100.0, 0, 2),
+        ('output_pulse', 100.0, ['T1']),
+        ('output_pulse', 100.0, ['T2']),
+        ('output_pulse', 100.0, ['T3']),
+        ('output_pulse', 100.0, ['T4']),
+        ('store', 1000.0),
+        ('select_frequency', 2100.0, 1, 1),
+        ('select_frequency', 2100.0, 1, 2),
+        ('output_pulse', 2100.0, ['T1']),
+        ('output_pulse', 2100.0, ['T2']),
+        ('output_pulse', 2100.0, ['T3']),
+        ('output_pulse', 2100.0, ['T4']),
+        ('store', 3000.0),
+    ]
+
+
+def test_copy():
+    """
+    A port that copies another port's pulses with a phase shift and a scaled amplitude.
+    """
+    calls = get_board_calls(get_config({
+        'Port 1 - mode': 'Define',
+        'Pulses for port 1': '2',
+        'Port 1 - def 1 - template': '1',
+        'Port 1 - def 1 - start times': '100E-9',
+        'Port 1 - def 1 - sine generator': '1',
+        'Port 1 - def 1 - amp': 0.8,
+        'Port 1 - def 1 - freq': 100e6,
+        'Port 1 - def 2 - template': '1',
+        'Port 1 - def 2 - start times': '300E-9 + 100E-9*i',
+        'Port 1 - def 2 - sine generator': '1',
+        'Port 1 - def 2 - amp': 0.4,
+        'Port 1 - def 2 - freq': 100e6,
+        'Port 1 - def 2 - phase': 0.5,
+        'Port 3 - mode': 'Copy',
+        'Port 3 - copy sequence from': '1',
+        'Port 3 - phase shift': 0.5,
+        'Port 3 - amplitude scale multiplier': 0.5,
+    }))
+    assert get_calls(calls, SETUP_CALLS) == [
+        ('setup_template', 1, 1, 80, 'T1'),
+        ('setup_template', 3, 1, 80, 'T2'),
+    ]
+    assert get_calls(calls, LUT_CALLS) == [
+        ('setup_freq_lut', 1, 1, [100.0, 100.0, 100.0, 100.0], [0.0, 0.5, 2.0, 0.5]),
+        ('setup_freq_lut', 1, 2, [0.0, 0.0, 0.0, 0.0], [0.0, 0.0, 0.0, 0.0]),
+        ('setup_scale_lut', 1, [0.8, 0.4]),
+        ('setup_freq_lut', 3, 1, [100.0, 100.0, 100.0, 100.0], [0.5, 1.0, 0.5, 1.0]),
+        ('setup_freq_lut', 3, 2, [0.0, 0.0, 0.0, 0.0], [0.0, 0.0, 0.0, 0.0]),
+        ('setup_scale_lut', 3, [0.4, 0.2]),
+    ]
+    assert get_calls(calls, SEQUENCE_CALLS) == [
+        ('select_scale', 98.0, 0, 1),
+        ('select_scale', 98.0, 0, 3),
+        ('select_frequency', 100.0, 0, 1),
+        ('select_frequency', 100.0, 0, 3),
+        ('output_pulse', 100.0, ['T1']),
+        ('output_pulse', 100.0, ['T2']),
+        ('select_scale', 298.0, 1, 1),
+        ('select_scale', 298.0, 1, 3),
+        ('select_frequency', 300.0, 1, 1),
+        ('select_frequency', 300.0, 1, 3),
+        ('output_pulse', 300.0, ['T1']),
+        ('output_pulse', 300.0, ['T2']),
+        ('store', 1000.0),
+        ('select_scale', 2098.0, 0, 1),
+        ('select_scale', 2098.0, 0, 3),
+        ('select_frequency', 2100.0, 2, 1),
+        ('select_frequency', 2100.0, 2, 3),
+        ('output_pulse', 2100.0, ['T1']),
+        ('output_pulse', 2100.0, ['T2']),
+        ('select_scale', 2398.0, 1, 1),
+        ('select_scale', 2398.0, 1, 3),
+        ('select_frequency', 2400.0, 3, 1),
+        ('select_frequency', 2400.0, 3, 3),
+        ('output_pulse', 2400.0, ['T1']),
+        ('output_pulse', 2400.0, ['T2']),
+        ('store', 3000.0),
+    ]
+
+
+def test_conditional():
+    """
+    A pulse that is only output if a template matching is above its threshold.
+    """
+    calls = get_board_calls(get_config({
+        'Port 1 - mode': 'Define',
+        'Pulses for port 1': '1',
+        'Port 1 - def 1 - template': '1',
+        'Port 1 - def 1 - start times': '1.5E-6',
+        'Port 1 - def 1 - sine generator': '1',
+        'Port 1 - def 1 - amp': 0.3,
+        'Port 1 - def 1 - freq': 50e6,
+        'Port 1 - def 1 - Condition comparator': '> threshold',
+        'Port 1 - def 1 - Template matching condition 1': '1',
+        'Number of matches': '1',
+        'Template matching 1 - template': 'Sin2',
+        'Template matching 1 - first sampling port': '1',
+        'Template matching 1 - match on two ports': False,
+        'Template matching 1 - matching start time': 1.02e-6,
+        'Template matching 1 - matching duration': 20e-9,
+        'Template matching 1 - frequency': 50e6,
+        'Template matching 1 - threshold': 1.0,
+    }))
+    assert get_calls(calls, SETUP_CALLS) == [
+        ('setup_template', 1, 1, 80, 'T1'),
+        ('setup_template_matching_pair', 1, 80, 80, False, ['M2a', 'M2b']),
+        ('setup_template_matching_pair', 1, 80, 80, False, ['M3a', 'M3b']),
+        ('setup_condition', ['M2a', 'M2b'], ['T1'], []),
+    ]
+    assert get_calls(calls, LUT_CALLS) == [
+        ('setup_freq_lut', 1, 1, [50.0, 50.0], [0.0, 0.0]),
+        ('setup_freq_lut', 1, 2, [0.0, 0.0], [0.0, 0.0]),
+        ('setup_scale_lut', 1, [0.3]),
+    ]
+    assert get_calls(calls, SEQUENCE_CALLS) == [
+        ('store', 1000.0),
+        ('select_scale', 1498.0, 0, 1),
+        ('select_frequency', 1500.0, 0, 1),
+        ('output_pulse', 1500.0, ['T1']),
+        ('store', 3000.0),
+        ('select_frequency', 3500.0, 1, 1),
+        ('output_pulse', 3500.0, ['T1']),
+        ('match', 1020.0, ['(M2a, M2b)', '(M3a, M3b)']),
+        ('match', 3020.0, ['(M2a, M2b)', '(M3a, M3b)']),
+    ]
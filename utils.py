@@ -4,46 +4,47 @@
 A collection of various utility functions used by different parts of the ViPS driver.
 """
 
-import math
 import numpy as np
 
 
-def template_def_to_points(vips, template_def, iteration):
+def template_def_to_segments(vips, template_def, iteration):
     """
-    Calculate X and Y point values for the given template definition and iteration.
-    Return X, Y.
+    Split the envelope of the given template definition in the given iteration into consecutive segments.
+    Each segment is either an array of points, or an int giving the number of points in a flat part at 1,
+    so that the flat parts of long drives never need to be expanded into points.
+    Return a list of the segments, which is empty if the envelope has no points.
     """
-    if 'Rise Points' in template_def:  # Gauss long drive
-        duration = template_def['Base'] + template_def['Delta'] * iteration
-        rise_p = template_def['Rise Points']
-        n_long_points = round((duration - 2 * template_def['Flank Duration']) * vips.sampling_freq)
-        if n_long_points >= 1e5:
-            raise ValueError('Your long drive template is too long to preview, '
-                             'it would take forever to create a list of >100 000 points!')
-        long_p = np.linspace(1, 1, n_long_points)
-        fall_p = template_def['Fall Points']
-        total_points = len(rise_p) + n_long_points + len(fall_p)
-        end_point = (total_points - 1) / vips.sampling_freq
-        x = np.linspace(0, end_point, total_points)
-        y = np.concatenate((rise_p, long_p, fall_p))
-        return x, y
-
     if 'Base' in template_def:  # Long drive
         duration = template_def['Base'] + template_def['Delta'] * iteration
+        if 'Rise Points' in template_def:  # Gauss long drive
+            n_long_points = round((duration - 2 * template_def['Flank Duration']) * vips.sampling_freq)
+            segments = [template_def['Rise Points'], n_long_points, template_def['Fall Points']]
+            return [segment for segment in segments if isinstance(segment, np.ndarray) or segment > 0]
         if duration <= 0:
-            return [], []
-        n_points = round(duration * vips.sampling_freq)
-        if n_points >= 1e5:
-            raise ValueError('Your long drive template is too long to preview, '
-                             'it would take forever to create a list of >100 000 points!')
-        end_point = (n_points - 1) / vips.sampling_freq
-        x = np.linspace(0, end_point, n_points)
-        y = np.linspace(1, 1, n_points)
-        return x, y
+            return []
+        return [round(duration * vips.sampling_freq)]
 
     if template_def['Duration'] <= 0:
+        return []
+    return [template_def['Points']]
+
+
+def get_segment_length(segment):
+    """
+    Get the number of points in an envelope segment from template_def_to_segments().
+    """
+    return segment if isinstance(segment, int) else len(segment)
+
+
+def template_def_to_points(vips, template_def, iteration):
+    """
+    Calculate X and Y point values for the given template definition and iteration.
+    Return X, Y.
+    """
+    segments = template_def_to_segments(vips, template_def, iteration)
+    if len(segments) == 0:
         return [], []
-    y = template_def['Points']
+    y = np.concatenate([np.ones(segment) if isinstance(segment, int) else segment for segment in segments])
     end_point = (len(y) - 1) / vips.sampling_freq
     x = np.linspace(0, end_point, len(y))
     return x, y
@@ -68,6 +69,42 @@ def get_amp_freq_phase(pulse, iteration):
     return p_amp, p_freq, p_phase
 
 
+def get_ticks(vips, seconds):
+    """
+    Convert a time in seconds, or an array of times, to a whole number of sample ticks
+    at the board's sampling frequency.
+    """
+    ticks = np.rint(np.multiply(seconds, vips.sampling_freq)).astype(np.int64)
+    return int(ticks) if ticks.ndim == 0 else ticks
+
+
+def ticks_to_time(vips, ticks):
+    """
+    Convert a number of sample ticks, or an array of them, to a time in seconds for use with Vivace's methods.
+    """
+    return ticks / vips.sampling_freq
+
+
+def get_absolute_ticks(vips, ticks, iteration):
+    """
+    Given a (base, delta) pair of tick values and the current iteration index, or an array of iteration indices,
+    compute and return the absolute time in sample ticks.
+    """
+    return (get_ticks(vips, vips.trigger_period) * iteration  # The current period's start time
+            + ticks[0]  # The constant part of the given time
+            + ticks[1] * iteration)  # The scaling part of the given time
+
+
+def get_duration_ticks(vips, template_def, iteration):
+    """
+    Compute the total duration in sample ticks of a template definition, for a given iteration
+    or for an array of iteration indices.
+    """
+    if 'Base' in template_def:  # Long drive
+        return get_ticks(vips, template_def['Base']) + get_ticks(vips, template_def['Delta']) * iteration
+    return np.full(np.shape(iteration), get_ticks(vips, template_def['Duration']), dtype=np.int64)
+
+
 def get_absolute_time(vips, base, delta, iteration):
     """
     Given a base, a delta and the current iteration index, compute and return an
@@ -78,19 +115,6 @@ def get_absolute_time(vips, base, delta, iteration):
             + delta * iteration)  # The scaling part of the given time
 
 
-def are_fp_pairs_close(tuptup1, tuptup2):
-    """
-    Compare two objects to see if their numerical values are identical within
-    a small margin of error. The objects each contain a pair of frequency-phase
-    tuples, so they each have 4 values that need to be compared against the
-    other object.
-    """
-    return (math.isclose(tuptup1[0][0], tuptup2[0][0]) and
-            math.isclose(tuptup1[0][1], tuptup2[0][1]) and
-            math.isclose(tuptup1[1][0], tuptup2[1][0]) and
-            math.isclose(tuptup1[1][1], tuptup2[1][1]))
-
-
 def combo_to_int(value, replace_string='None', replace_with=0):
     """
     Used for the values of combo quants with numerical values and one string value.